@@ -0,0 +1,102 @@
+""" Keep-alive connection pool benchmark against a local stub server
+
+Usage:
+    bench_keepalive.py [--pages=<n>] [--tls]
+
+Options:
+    --pages=<n>     Number of pages requested per run [default: 300]
+    --tls           Serve the stub over HTTPS with a throw away self-signed
+                    certificate (needs the openssl binary)
+"""
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import urllib3
+from docopt import docopt
+
+from fotocasa.fotocasa import FotocasaAPI
+
+FAKE_IMEI = '536449977880378'
+STUB_BODY = json.dumps({'d': {'DataLayer': 'search_results_number=0',
+                              'Properties': []}}).encode('utf-8')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(STUB_BODY)))
+        self.end_headers()
+        self.wfile.write(STUB_BODY)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def self_signed_context(tmp_dir):
+    cert_file = os.path.join(tmp_dir, 'cert.pem')
+    key_file = os.path.join(tmp_dir, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                           '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                           '-keyout', key_file, '-out', cert_file],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+def start_stub(tls):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    scheme = 'http'
+    if tls:
+        tmp_dir = tempfile.mkdtemp()
+        server.socket = self_signed_context(tmp_dir).wrap_socket(
+            server.socket, server_side=True)
+        scheme = 'https'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = '{}://127.0.0.1:{}/mobile/api/v3.asmx'.format(scheme,
+                                                         server.server_port)
+    return server, url
+
+
+def run(url, pages, keep_alive):
+    with FotocasaAPI(imei=FAKE_IMEI, keep_alive=keep_alive) as fapi:
+        fapi.url = url
+        fapi.session.trust_env = False
+        fapi.session.verify = False
+        start = time.perf_counter()
+        for page in range(1, pages + 1):
+            fapi.search_by_bounding_box(41.38, 2.15, 41.40, 2.18, page_num=page)
+        elapsed = time.perf_counter() - start
+    return pages / elapsed
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    pages = int(args['--pages'])
+    urllib3.disable_warnings()
+    server, url = start_stub(args['--tls'])
+    try:
+        results = {
+            'pages': pages,
+            'tls': bool(args['--tls']),
+            'no_keep_alive_pages_per_sec': run(url, pages, keep_alive=False),
+            'keep_alive_pages_per_sec': run(url, pages, keep_alive=True),
+        }
+    finally:
+        server.shutdown()
+    results['speedup'] = (results['keep_alive_pages_per_sec'] /
+                          results['no_keep_alive_pages_per_sec'])
+    print(json.dumps(results, indent=2))
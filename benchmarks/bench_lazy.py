@@ -0,0 +1,54 @@
+""" Eager vs lazy result pages for ids only change checks
+
+Usage:
+    bench_lazy.py [--pages=<n>] [--items=<n>]
+
+Options:
+    --pages=<n>     Number of pages per measure [default: 200]
+    --items=<n>     Listings per page [default: 200]
+"""
+import json
+import time
+
+from docopt import docopt
+
+from fotocasa.fotocasa import FotocasaSearchResult
+from idealista.idealista import IdealistaSearchResults
+from pyappapi.synthetic import fotocasa_search_page, idealista_search_page
+
+
+def measure(func, pages):
+    start = time.perf_counter()
+    for page in pages:
+        func(page)
+    return (time.perf_counter() - start) / len(pages) * 1000.0
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    n_pages = int(args['--pages'])
+    items = int(args['--items'])
+    fotocasa_page = json.dumps(fotocasa_search_page(items))
+    idealista_page = json.dumps(idealista_search_page(items))
+    fotocasa_pages = [json.loads(fotocasa_page) for _ in range(n_pages)]
+    idealista_pages = [json.loads(idealista_page) for _ in range(n_pages)]
+    results = {
+        'items_per_page': items,
+        'json_decode_ms_per_page': {
+            'fotocasa': measure(json.loads, [fotocasa_page] * n_pages),
+            'idealista': measure(json.loads, [idealista_page] * n_pages),
+        },
+        'ids_eager_ms_per_page': {
+            'fotocasa': measure(lambda p: FotocasaSearchResult(p).ids(),
+                                fotocasa_pages),
+            'idealista': measure(lambda p: IdealistaSearchResults(p).ids(),
+                                 idealista_pages),
+        },
+        'ids_lazy_ms_per_page': {
+            'fotocasa': measure(lambda p: FotocasaSearchResult(p, lazy=True).ids(),
+                                fotocasa_pages),
+            'idealista': measure(lambda p: IdealistaSearchResults(p, lazy=True).ids(),
+                                 idealista_pages),
+        },
+    }
+    print(json.dumps(results, indent=2))
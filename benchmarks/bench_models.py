@@ -0,0 +1,97 @@
+""" Result model memory and parse speed benchmark
+
+Compares the slotted models with the previous __dict__ based models (a
+setattr per field), on synthetic pages.
+
+Usage:
+    bench_models.py [--listings=<n>]
+
+Options:
+    --listings=<n>  Number of listings built per measure [default: 20000]
+"""
+import json
+import time
+import tracemalloc
+
+from docopt import docopt
+
+from fotocasa.fotocasa import FotocasaPropertyResult
+from idealista.idealista import (IdealistaSearchResultElement,
+                                 IdealistaContactInfo, IdealistaPhoneInfo,
+                                 IdealistaDetailedType, IdealistaImage)
+from pyappapi.synthetic import fotocasa_property, idealista_element
+
+
+class LegacyData(object):
+    def __init__(self, json_dict):
+        for field in self.required:
+            if field in json_dict:
+                setattr(self, field, json_dict[field])
+            else:
+                raise ValueError('missing required field {}'.format(field))
+        for field in self.optional:
+            if field in json_dict:
+                setattr(self, field, json_dict[field])
+            else:
+                setattr(self, field, None)
+
+
+def legacy_class(model):
+    return type('Legacy' + model.__name__, (LegacyData,),
+                {'required': model.required, 'optional': model.optional})
+
+
+LegacyFotocasaProperty = legacy_class(FotocasaPropertyResult)
+LegacyElement = legacy_class(IdealistaSearchResultElement)
+LegacyContactInfo = legacy_class(IdealistaContactInfo)
+LegacyPhoneInfo = legacy_class(IdealistaPhoneInfo)
+LegacyDetailedType = legacy_class(IdealistaDetailedType)
+LegacyImage = legacy_class(IdealistaImage)
+
+
+class LegacyMultimedia(object):
+    def __init__(self, json_data):
+        self.images = [LegacyImage(img) for img in json_data.get('images', [])]
+
+
+def legacy_element(json_dict):
+    element = LegacyElement(json_dict)
+    contact = LegacyContactInfo(json_dict['contactInfo'])
+    contact.phone1 = LegacyPhoneInfo(json_dict['contactInfo']['phone1'])
+    element.contactInfo = contact
+    element.multimedia = LegacyMultimedia(json_dict['multimedia'])
+    element.suggestedTexts = json_dict['suggestedTexts']
+    element.detailedType = LegacyDetailedType(json_dict['detailedType'])
+    return element
+
+
+def measure(build, raw_listings):
+    start = time.perf_counter()
+    for raw in raw_listings:
+        build(raw)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    kept = [build(raw) for raw in raw_listings]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return {'listings_per_sec': len(raw_listings) / elapsed,
+            'bytes_per_listing': current / float(len(raw_listings))}
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    count = int(args['--listings'])
+    # json round trip, so the values are shared like in a decoded page
+    fotocasa_raw = json.loads(json.dumps([fotocasa_property(i + 1)
+                                          for i in range(count)]))
+    idealista_raw = json.loads(json.dumps([idealista_element(i + 1)
+                                           for i in range(count)]))
+    results = {
+        'listings': count,
+        'fotocasa_before': measure(LegacyFotocasaProperty, fotocasa_raw),
+        'fotocasa_after': measure(FotocasaPropertyResult, fotocasa_raw),
+        'idealista_before': measure(legacy_element, idealista_raw),
+        'idealista_after': measure(IdealistaSearchResultElement, idealista_raw),
+    }
+    print(json.dumps(results, indent=2))
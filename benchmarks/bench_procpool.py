@@ -0,0 +1,120 @@
+""" Process pool crawler scaling benchmark against local fake api servers
+
+Crawls the whole fake server area with pyappapi.procpool.ProcessPoolCrawler
+for every number of processes, and with the threaded iter_bounding_box, and
+prints the listings per second of each as json. The fake servers run in
+their own processes (--servers of them, the workers are spread over them),
+so that serving the pages does not take the cores of the crawl.
+
+Usage:
+    bench_procpool.py [fotocasa|idealista] [--processes=<list>]
+                      [--servers=<n>] [--listings=<n>] [--page-size=<n>]
+                      [--rounds=<n>]
+
+Options:
+    --processes=<list>  Comma separated process counts [default: 1,2,4,8]
+    --servers=<n>       Fake server processes [default: 2]
+    --listings=<n>      Listings of the fake servers [default: 20000]
+    --page-size=<n>     Listings per page [default: 200]
+    --rounds=<n>        Crawls of the area per measure [default: 2]
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from docopt import docopt
+
+from fotocasa.fotocasa import FotocasaAPI
+from idealista.idealista import IdealistaAPI
+from pyappapi.procpool import ClientFactory, ProcessPoolCrawler
+from pyappapi.synthetic import DEFAULT_BOUNDING_BOX
+
+FAKE_IMEI = '536449977880378'
+
+
+class SpreadClientFactory(ClientFactory):
+    """ picks the server of each worker by its pid """
+
+    def __init__(self, client_class, base_urls, **kwargs):
+        super(SpreadClientFactory, self).__init__(client_class, **kwargs)
+        self.base_urls = base_urls
+
+    def __call__(self):
+        self.kwargs['base_url'] = self.base_urls[os.getpid() % len(self.base_urls)]
+        client = super(SpreadClientFactory, self).__call__()
+        client.session.trust_env = False
+        return client
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_servers(count, listings):
+    servers = []
+    for _ in range(count):
+        port = free_port()
+        process = subprocess.Popen([sys.executable, '-m', 'pyappapi.fakeserver',
+                                    '--port={}'.format(port),
+                                    '--listings={}'.format(listings)],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+        # 'Serving on port ...' once it listens
+        process.stdout.readline()
+        servers.append((process, 'http://127.0.0.1:{}'.format(port)))
+    return servers
+
+
+def client_kwargs(provider, page_size):
+    if provider == 'fotocasa':
+        return FotocasaAPI, dict(imei=FAKE_IMEI, page_size=page_size)
+    return IdealistaAPI, dict(page_size=page_size)
+
+
+def measure(crawl, rounds):
+    start = time.perf_counter()
+    listings = 0
+    for _ in range(rounds):
+        listings += crawl()
+    elapsed = time.perf_counter() - start
+    return {'listings': listings, 'seconds': elapsed,
+            'listings_per_sec': listings / elapsed}
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    provider = 'idealista' if args['idealista'] else 'fotocasa'
+    page_size = int(args['--page-size'])
+    rounds = int(args['--rounds'])
+    processes = [int(p) for p in args['--processes'].split(',')]
+    servers = start_servers(int(args['--servers']), int(args['--listings']))
+    base_urls = [url for _, url in servers]
+    client_class, kwargs = client_kwargs(provider, page_size)
+    results = {'provider': provider, 'cpus': os.cpu_count(), 'runs': {}}
+    try:
+        factory = SpreadClientFactory(client_class, base_urls, pool_maxsize=16,
+                                      **kwargs)
+        client = factory()
+        results['runs']['threads'] = measure(
+            lambda: sum(1 for _ in client.iter_bounding_box(
+                *DEFAULT_BOUNDING_BOX, prefetch=max(processes))), rounds)
+        client.close()
+        for count in processes:
+            with ProcessPoolCrawler(factory, processes=count) as crawler:
+                # the workers are started (and authorized) before measuring
+                sum(len(columns) for columns in crawler.crawl_bounding_box(
+                    *DEFAULT_BOUNDING_BOX))
+                results['runs']['processes_{}'.format(count)] = measure(
+                    lambda: sum(len(columns) for columns in
+                                crawler.crawl_bounding_box(*DEFAULT_BOUNDING_BOX)),
+                    rounds)
+    finally:
+        for process, _ in servers:
+            process.terminate()
+            process.wait()
+    print(json.dumps(results, indent=2, sort_keys=True))
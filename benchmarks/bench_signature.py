@@ -0,0 +1,53 @@
+""" Fotocasa request signature micro-benchmark
+
+Usage:
+    bench_signature.py [--count=<n>]
+
+Options:
+    --count=<n>     Number of signatures per measure [default: 20000]
+"""
+import json
+import time
+
+from docopt import docopt
+
+from fotocasa.fotocasa import Encryption, Signer, signature
+
+FAKE_IMEI = '536449977880378'
+
+
+def timestamps(count):
+    start = 1500000000000
+    return [str(start + i) for i in range(count)]
+
+
+def legacy_sign(imei, timestamp):
+    return Encryption().encrypt_to_hex(imei + timestamp)
+
+
+def measure(func, count):
+    start = time.perf_counter()
+    func()
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    count = int(args['--count'])
+    stamps = timestamps(count)
+    signer = Signer(FAKE_IMEI)
+    legacy = [legacy_sign(FAKE_IMEI, ts) for ts in stamps[:1000]]
+    assert legacy == [signer.sign(ts) for ts in stamps[:1000]]
+    assert legacy == signer.sign_timestamps(stamps[:1000])
+    results = {
+        'count': count,
+        'legacy_signatures_per_sec': measure(
+            lambda: [legacy_sign(FAKE_IMEI, ts) for ts in stamps], count),
+        'signer_signatures_per_sec': measure(
+            lambda: [signer.sign(ts) for ts in stamps], count),
+        'signer_batch_signatures_per_sec': measure(
+            lambda: signer.sign_timestamps(stamps), count),
+        'signature_now_per_sec': measure(
+            lambda: [signature(FAKE_IMEI) for _ in stamps], count),
+    }
+    print(json.dumps(results, indent=2))
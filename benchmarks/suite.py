@@ -0,0 +1,146 @@
+""" CPU hot paths micro-benchmark suite
+
+Runs offline on seeded synthetic fixtures and prints the results as json,
+so that runs of different releases can be compared.
+
+Usage:
+    suite.py [--quick] [--filter=<text>] [--repeat=<n>] [--output=<file>]
+             [--compare=<file>] [--tolerance=<pct>]
+
+Options:
+    --quick             Run every case about ten times shorter
+    --filter=<text>     Only run the cases whose name contains text
+    --repeat=<n>        Measures per case, the best and median are reported
+                        [default: 5]
+    --output=<file>     Also write the json results to file
+    --compare=<file>    Compare with the json results of a previous run, and
+                        exit with status 1 when a case got slower than the
+                        tolerance
+    --tolerance=<pct>   Slowdown allowed by --compare, in percent
+                        [default: 20]
+"""
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+import timeit
+
+from docopt import docopt
+
+from fotocasa.fotocasa import (Encryption, FotocasaMetaDataResult,
+                               FotocasaSearchResult, MapFilterRequestModel,
+                               Signer, generate_imei)
+from idealista.idealista import IdealistaSearchResults
+from pyappapi.synthetic import (fotocasa_data_layer, fotocasa_search_page,
+                                idealista_search_page)
+
+FAKE_IMEI = '536449977880378'
+PAGE_SIZES = (36, 72, 200)
+SEED = 1234
+
+
+def build_cases():
+    """ (name, function, calls per measure) of every case """
+    rnd = random.Random(SEED)
+    encryption = Encryption()
+    message = FAKE_IMEI + '1500000000000'
+    data_layer = fotocasa_data_layer(1834)
+    signer = Signer(FAKE_IMEI)
+    # distinct 13 digit timestamps, so that every call encrypts instead of
+    # taking the signature remembered for the last millisecond
+    stamps = itertools.cycle([str(1500000000000 + i) for i in range(1000)])
+
+    def bounding_box_payload():
+        mfrm = MapFilterRequestModel(estate_type=('2', '2'), offer_type='3')
+        mfrm.set_bounding_box(41.38, 2.15, 41.40, 2.18)
+        return vars(mfrm)
+
+    cases = [
+        ('signature', lambda: signer.sign(next(stamps)), 20000),
+        ('encrypt_to_hex', lambda: encryption.encrypt_to_hex(message), 20000),
+        ('generate_imei', lambda: generate_imei(rnd), 20000),
+        ('bounding_box_payload', bounding_box_payload, 20000),
+        ('fotocasa_metadata', lambda: FotocasaMetaDataResult(data_layer), 20000),
+    ]
+    for items in PAGE_SIZES:
+        fotocasa_page = fotocasa_search_page(items, seed=SEED)
+        idealista_page = idealista_search_page(items, seed=SEED,
+                                               page_size=items)
+        calls = max(10, 20000 // items)
+        cases.append(('fotocasa_search_result_{}'.format(items),
+                      lambda page=fotocasa_page: FotocasaSearchResult(page),
+                      calls))
+        cases.append(('idealista_search_results_{}'.format(items),
+                      lambda page=idealista_page: IdealistaSearchResults(page),
+                      calls))
+    return cases
+
+
+def measure(func, calls, repeat):
+    # timeit disables the garbage collector during the measures
+    times = timeit.Timer(func).repeat(repeat=repeat, number=calls)
+    per_call = sorted(t / calls for t in times)
+    median = per_call[len(per_call) // 2]
+    return {
+        'calls': calls,
+        'repeat': repeat,
+        'best_us': per_call[0] * 1e6,
+        'median_us': median * 1e6,
+        'ops_per_sec': 1.0 / median,
+    }
+
+
+def run(name_filter=None, repeat=5, quick=False):
+    results = {}
+    for name, func, calls in build_cases():
+        if name_filter and name_filter not in name:
+            continue
+        if quick:
+            calls = max(1, calls // 10)
+        func()  # warm up caches (compiled loaders)
+        results[name] = measure(func, calls, repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ the cases slower than the baseline by more than tolerance percent """
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline.get('results', {}):
+            continue
+        before = baseline['results'][name]['median_us']
+        change = (result['median_us'] - before) / before * 100.0
+        result['change_pct'] = change
+        if change > tolerance:
+            regressions[name] = change
+    return regressions
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    started = time.time()
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'timestamp': int(started),
+        'results': run(name_filter=args['--filter'],
+                       repeat=int(args['--repeat']),
+                       quick=args['--quick']),
+    }
+    regressions = {}
+    if args['--compare']:
+        with open(args['--compare']) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(report['results'], baseline,
+                              float(args['--tolerance']))
+        report['regressions'] = regressions
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args['--output']:
+        with open(args['--output'], 'w') as output_file:
+            output_file.write(output)
+    print(output)
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,91 @@
+# -*- encoding: utf8 -*-
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from fotocasa.fotocasa import BaseFotocasaAPI, fotocasa_log
+from pyappapi.aio import (AsyncSessionMixin, DEFAULT_MAX_CONCURRENCY,
+                          DEFAULT_CONNECTION_LIMIT)
+
+
+class AsyncFotocasaAPI(BaseFotocasaAPI, AsyncSessionMixin):
+    """
+        asyncio version of FotocasaAPI. Requests are built (and signed)
+        exactly like in the blocking client, and at most max_concurrency
+        of them are in flight at any time.
+
+        async with AsyncFotocasaAPI(imei) as fapi:
+            pages = await asyncio.gather(*[
+                fapi.search_by_bounding_box(*tile) for tile in tiles])
+    """
+
+    def __init__(self, imei, estate_type=None, offer_type=None, config=None,
+                 log=fotocasa_log, page_size=200, req_timeout=5.0,
+                 session=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 limit=DEFAULT_CONNECTION_LIMIT,
+                 limit_per_host=0,
+                 keep_alive=True,
+                 base_url=None):
+        super(AsyncFotocasaAPI, self).__init__(imei, estate_type=estate_type,
+                                               offer_type=offer_type,
+                                               config=config, log=log,
+                                               page_size=page_size,
+                                               req_timeout=req_timeout,
+                                               base_url=base_url)
+        self._init_async_session(session=session,
+                                 max_concurrency=max_concurrency,
+                                 limit=limit,
+                                 limit_per_host=limit_per_host,
+                                 keep_alive=keep_alive)
+
+    async def api_request(self, url, payload):
+        headers = self._headers()
+        async with self.semaphore:
+            try:
+                start_time = time.time()
+                async with self.session.post(url,
+                                             headers=headers,
+                                             json=payload,
+                                             timeout=self._client_timeout()) as res:
+                    text = await res.text()
+                end_time = time.time()
+                self.last_req_time = end_time - start_time
+                json_response = json.loads(text)
+            except asyncio.TimeoutError as tout:
+                self.log.exception('Request timeout url:%s payload:%s', str(url), str(payload))
+                return None
+            except aiohttp.ClientError as req_ex:
+                self.log.exception('Request exception url:%s payload:%s', str(url), str(payload))
+                return None
+            except json.decoder.JSONDecodeError as jde:
+                self.log.exception('Error decoding json: %s', str(text))
+                return None
+            except Exception as es:
+                self.log.exception('Unexpected exception')
+                return None
+        return json_response
+
+    async def search_by_bounding_box(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+        return await self.api_request(*self._bounding_box_request(lat_0, lon_0,
+                                                                  lat_1, lon_1,
+                                                                  page_num=page_num))
+
+    async def search_by_coordinates(self, lat, lon):
+        return await self.api_request(*self._coordinates_request(lat, lon))
+
+    async def search_by_location(self, location_text):
+        location = self._first_location(await self.get_locations(location_text))
+        if location is None:
+            return None
+        location_codes, lat, lon = location
+        return await self.search_by_location_codes(location_codes, lat, lon)
+
+    async def search_by_location_codes(self, location_codes, lat, lon):
+        return await self.api_request(*self._location_codes_request(location_codes,
+                                                                    lat, lon))
+
+    async def get_locations(self, location_text):
+        return await self.api_request(*self._locations_request(location_text))
@@ -3,28 +3,62 @@
 Usage:
     cmd.py bbox <min_lat> <min_lon> <max_lat> <max_lon>
     cmd.py loc  <location_name>
+    cmd.py batch <input_file> [--workers=<n>] [--fetch-workers=<n>]
+                 [--max-pages=<n>]
+
+Options:
+    --workers=<n>        Jobs run at the same time [default: 4]
+    --fetch-workers=<n>  Pages requested at the same time per job [default: 2]
+    --max-pages=<n>      Page cap of each job
+
+batch reads one `bbox <min_lat> <min_lon> <max_lat> <max_lon>` or
+`loc <location_name>` job per line of <input_file> (- for stdin), and
+writes NDJSON to stdout: a line per listing and a status line per job.
 """
 import json
+import sys
 import time
 from docopt import docopt
 from pprint import pprint as _p
-from fotocasa import FotocasaAPI, generate_imei
+from fotocasa.fotocasa import FotocasaAPI, generate_imei
+from pyappapi.batch import BatchRunner
 
 FAKE_IMEI = '536449977880378'
 
+
+def run_batch(args):
+    workers = int(args['--workers'])
+    fetch_workers = int(args['--fetch-workers'])
+    max_pages = args['--max-pages']
+    input_file = args['<input_file>']
+    with FotocasaAPI(imei=FAKE_IMEI, config=None, page_size=72,
+                     pool_maxsize=workers * fetch_workers) as fapi:
+        runner = BatchRunner(fapi, sys.stdout, workers=workers,
+                             fetch_workers=fetch_workers,
+                             max_pages=int(max_pages) if max_pages else None)
+        if input_file == '-':
+            counts = runner.run(sys.stdin)
+        else:
+            with open(input_file) as lines:
+                counts = runner.run(lines)
+    sys.stderr.write('jobs: {}\n'.format(json.dumps(counts, sort_keys=True)))
+
+
 if __name__ == '__main__':
     args = docopt(__doc__)
-    if args['loc']:
+    if args['batch']:
+        run_batch(args)
+    elif args['loc']:
         location_name = args['<location_name>']
-        fapi = FotocasaAPI(imei=FAKE_IMEI, config=None)
-        res = fapi.search_by_location(location_name)
+        with FotocasaAPI(imei=FAKE_IMEI, config=None) as fapi:
+            res = fapi.search_by_location(location_name)
         _p(res)
     elif args['bbox']:
         lat_0 = float(args['<min_lat>'])
         lon_0 = float(args['<min_lon>'])
         lat_1 = float(args['<max_lat>'])
         lon_1 = float(args['<max_lon>'])
-        fapi = FotocasaAPI(imei=FAKE_IMEI, config=None, page_size=72)
-        res = fapi.search_by_bounding_box(lat_0, lon_0, lat_1, lon_1)
+        with FotocasaAPI(imei=FAKE_IMEI, config=None, page_size=72) as fapi:
+            res = fapi.search_by_bounding_box(lat_0, lon_0, lat_1, lon_1)
         print(json.dumps(res))
         print('results : {}'.format( len( res['d']['Properties'])))
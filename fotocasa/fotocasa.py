@@ -9,13 +9,47 @@ import hashlib
 import random
 import struct
 import logging
+import math
 import time
+import functools
 
 from Crypto.Cipher import AES
 from calendar import timegm
 
+from pyappapi.cache import cache_key
+from pyappapi.columns import ResultColumns
+from pyappapi.incremental import fingerprint
+from pyappapi.lazy import LazyResultList
+from pyappapi.metrics import timed
+from pyappapi.models import SlottedDataMeta
+from pyappapi.prefetch import (iter_completed, iter_prefetched_pages,
+                               DEFAULT_PREFETCH, DEFAULT_WORKERS)
+from pyappapi.ratelimit import limited
+from pyappapi.session import (PooledSessionMixin, DEFAULT_POOL_CONNECTIONS,
+                              DEFAULT_POOL_MAXSIZE)
+
 fotocasa_log = logging.getLogger(__name__)
 
+# OfferTypeId to the operation names used by idealista
+OFFER_TYPE_OPERATIONS = {
+    1: u'sale',
+    3: u'rent',
+    4: u'transfer',
+    5: u'share',
+    7: u'rent_with_purchase_option',
+    8: u'holiday_rental',
+}
+
+
+def parse_price(price_description):
+    """ 1250.0 for '1.250 €/mes', None when there is no number """
+    if not price_description:
+        return None
+    digits = ''.join(c for c in price_description.split(',')[0] if c.isdigit())
+    if not digits:
+        return None
+    return float(digits)
+
 def generate_imei(rnd=None):
     def luhn_digit(partial_imei):
         # https://en.wikipedia.org/wiki/Luhn_algorithm
@@ -106,6 +140,108 @@ class Encryption(object):
         return self.decrypt(str(decoded_b64))
 
 
+def _timestamp_millis():
+    now = datetime.now()
+    return str(timegm(now.timetuple())) + '{:03d}'.format(now.microsecond // 1000)
+
+
+class Signer(object):
+    """
+        Signs requests for a single IMEI, producing exactly the same output
+        than Encryption().encrypt_to_hex(imei + timestamp).
+
+        The AES key is derived once, and CBC (with the zero IV used by the
+        app) is chained by hand over a reusable ECB cipher, so no cipher
+        object is built per signature. The signature of the last
+        millisecond is remembered, as every request signed in the same
+        millisecond gets the same value.
+    """
+    block_size = 16
+
+    def __init__(self, imei, key='ftcipanuntis2009', log=fotocasa_log):
+        if len(imei) != 15:
+            log.warning('Len IMEI != 15 : %s', str(imei))
+            raise ValueError('Imei should be 15 digits long')
+        self.imei = imei
+        self.log = log
+        self._cipher = AES.new(hashlib.md5(key.encode('utf-8')).digest(),
+                               AES.MODE_ECB)
+        self._last = (None, None)
+
+    def _to_sign(self, timestamp):
+        to_sign = self.imei + timestamp
+        if len(to_sign) != 28:
+            self.log.warning('Len to sign != 28 : %s', str(to_sign))
+            raise ValueError('To sign field should be 28 digits long')
+        message = to_sign.encode('utf-8')
+        # same padding than Encryption.encrypt
+        padd_byte = self.block_size - (len(message) % self.block_size)
+        return message + bytes((padd_byte,)) * padd_byte
+
+    def sign(self, timestamp=None):
+        """ signature for `timestamp` (13 digit milliseconds), or now """
+        if timestamp is None:
+            timestamp = _timestamp_millis()
+        last_timestamp, last_signature = self._last
+        if timestamp == last_timestamp:
+            return last_signature
+        message = self._to_sign(timestamp)
+        encrypt = self._cipher.encrypt
+        previous = bytes(self.block_size)
+        blocks = []
+        for start in range(0, len(message), self.block_size):
+            block = message[start:start + self.block_size]
+            chained = (int.from_bytes(block, 'big') ^
+                       int.from_bytes(previous, 'big')).to_bytes(self.block_size, 'big')
+            previous = encrypt(chained)
+            blocks.append(previous)
+        res = b''.join(blocks).hex()
+        self._last = (timestamp, res)
+        return res
+
+    def sign_timestamps(self, timestamps):
+        """
+            Signs many timestamps at once. Each CBC step of all the
+            messages goes through a single ECB call.
+        """
+        messages = [self._to_sign(ts) for ts in timestamps]
+        if not messages:
+            return []
+        bs = self.block_size
+        n_blocks = len(messages[0]) // bs
+        previous = [0] * len(messages)
+        encrypted = [[] for _ in messages]
+        for block_num in range(n_blocks):
+            start = block_num * bs
+            chained = b''.join(
+                (int.from_bytes(msg[start:start + bs], 'big') ^ prev).to_bytes(bs, 'big')
+                for msg, prev in zip(messages, previous))
+            cipher_text = self._cipher.encrypt(chained)
+            for idx in range(len(messages)):
+                block = cipher_text[idx * bs:(idx + 1) * bs]
+                encrypted[idx].append(block)
+                previous[idx] = int.from_bytes(block, 'big')
+        return [b''.join(blocks).hex() for blocks in encrypted]
+
+    def sign_batch(self, n):
+        """
+            Convenience for n requests about to be sent: the current
+            signature n times, as it only depends on the IMEI and the
+            millisecond. Signing many distinct timestamps is
+            sign_timestamps.
+        """
+        return [self.sign()] * n
+
+
+# signers kept, for the clients that generate an IMEI each
+MAX_SIGNERS = 64
+
+
+@functools.lru_cache(maxsize=MAX_SIGNERS)
+def _signer(imei, log=fotocasa_log):
+    return Signer(imei, log=log)
+
+
 def signature(imei=None, log=fotocasa_log):
     """
         The signature is composed of an IMEI number:
@@ -115,21 +251,13 @@ def signature(imei=None, log=fotocasa_log):
 
         and the milliseconds since 1970
         str(timegm()) + str(datetime.microsecond // 1000)
+
+        A Signer is kept for the last MAX_SIGNERS IMEIs, so the key is
+        derived only once.
     """
     if imei is None:
-        imei_gen = ImeiGen()
-        imei = imei_gen.random_imei()
-    if len(imei) != 15:
-        log.warning('Len IMEI != 15 : %s', str(imei))
-        raise ValueError('Imei should be 15 digits long')
-    now = datetime.now()
-    str_timestamp = str(timegm(now.timetuple())) + '{:03d}'.format(now.microsecond // 1000)
-    to_sign = imei + str_timestamp
-    if len(to_sign) != 28:
-        log.warning('Len to sign != 28 : %s', str(to_sign))
-        raise ValueError('To sign field should be 28 digits long')
-    enc = Encryption()
-    return enc.encrypt_to_hex(to_sign)
+        return Signer(generate_imei(), log=log).sign()
+    return _signer(imei, log).sign()
 
 
 class BaseFilterRequestModel(object):
@@ -178,7 +306,7 @@ class RadialFilterRequestModel(BaseFilterRequestModel):
 class MapFilterRequestModel(BaseFilterRequestModel):
     """
         disableClustering = True, seems to disable additional information
-            (only Id, and coordinates)
+            (only Id, and coordinates), used for the map pins
     """
     def __init__(self, estate_type=None, offer_type=None):
         super(self.__class__, self).__init__(estate_type, offer_type)
@@ -224,6 +352,7 @@ class GetPropertyRequestModel(object):
         self.propertyId = property_id
         self.longitude = 0.0
         self.latitude = 0.0
+        self.signature = ""
 
 class FotocasaMapSearchEndpoints(object):
     def __init__(self):
@@ -239,19 +368,19 @@ class FotocasaMapSearchEndpoints(object):
         endpoint = "/PolygonGetConvexHull"
 
 
-class FotocasaData(object):
+class FotocasaData(object, metaclass=SlottedDataMeta):
+    """
+        Base of the result models. Subclasses list their `required` and
+        `optional` json fields, which become the class `__slots__` and are
+        loaded by a `_load_fields` compiled for the class.
+    """
     def __init__(self, json_dict, log=fotocasa_log):
-        for field in self.required:
-            if field in json_dict:
-                setattr(self, field, json_dict[field])
-            else:
-                log.error('Missing required field %s', str(field))
-                raise ValueError('missing required field {}'.format(field))
-        for field in self.optional:
-            if field in json_dict:
-                setattr(self, field, json_dict[field])
-            else:
-                setattr(self, field, None)
+        try:
+            self._load_fields(json_dict)
+        except KeyError as ke:
+            field = ke.args[0]
+            log.error('Missing required field %s', str(field))
+            raise ValueError('missing required field {}'.format(field))
 
 
 class FotocasaDetailsResult(FotocasaData):
@@ -382,6 +511,10 @@ class FotocasaMetaDataResult(FotocasaData):
     str_fields = ['transaction',
                   'property',
                  ]
+    extra_fields = int_fields + str_fields
+    _int_fields = frozenset(int_fields)
+    _str_fields = frozenset(str_fields)
+
     def __init__(self, url_encoded_data, log=fotocasa_log):
         params = url_encoded_data.split('&')
         for ifk in self.int_fields:
@@ -391,17 +524,23 @@ class FotocasaMetaDataResult(FotocasaData):
         for kv_pair in params:
             try:
                 pk, pv = kv_pair.split('=')
-                if pk in self.int_fields:
+                if pk in self._int_fields:
                     setattr(self, pk, int(pv))
-                if pk in self.str_fields:
+                elif pk in self._str_fields:
                     setattr(self, pk, pv)
             except Exception as ex:
                 log.exception('Error parsing METADATA: %s', str(url_encoded_data))
 
 
 class FotocasaSearchResult(FotocasaData):
+    """
+        With lazy=True the properties are a LazyResultList: every
+        FotocasaPropertyResult is only built when it is accessed, and ids()
+        or coords() do not build any.
+    """
+    extra_fields = ['properties', 'metadata']
 
-    def __init__(self, json_dict, log=fotocasa_log):
+    def __init__(self, json_dict, log=fotocasa_log, lazy=False):
         self.properties = []
         self.metadata = None
         if json_dict is None:
@@ -412,14 +551,68 @@ class FotocasaSearchResult(FotocasaData):
             j_data = json_dict['d']
             self.metadata = FotocasaMetaDataResult(j_data['DataLayer'], log=log)
             if 'Properties' in j_data:
+                if lazy:
+                    self.properties = LazyResultList(
+                        j_data['Properties'],
+                        lambda prop_result: FotocasaPropertyResult(prop_result, log=log),
+                        'Id', 'Y', 'X')
+                    return
                 for prop_result in j_data['Properties']:
                     fc_res = FotocasaPropertyResult(prop_result, log=log)
                     self.properties.append(fc_res)
         except Exception as ex:
             log.exception('Error parsing result %s', str(json_dict))
 
+    def __len__(self):
+        return len(self.properties)
+
+    def ids(self):
+        if isinstance(self.properties, LazyResultList):
+            return self.properties.ids()
+        return [prop.Id for prop in self.properties]
 
-class FotocasaAPI(object):
+    def coords(self):
+        """ (latitude, longitude) of every property """
+        if isinstance(self.properties, LazyResultList):
+            return self.properties.coords()
+        return [(prop.Y, prop.X) for prop in self.properties]
+
+    def to_columns(self, columns=None):
+        """
+            Appends the properties to a ResultColumns batch (a new one by
+            default). Price comes from PriceDescription, operation from
+            OfferTypeId, municipality from LocationDescription, and the
+            province is not known.
+        """
+        if columns is None:
+            columns = ResultColumns()
+        if isinstance(self.properties, LazyResultList):
+            rows = [(p.get('Id'), p.get('Y'), p.get('X'), p.get('PriceDescription'),
+                     p.get('Surface'), p.get('NRooms'), p.get('Bathrooms'),
+                     p.get('LocationDescription'), p.get('OfferTypeId'))
+                    for p in self.properties.raw_elements()]
+        else:
+            rows = [(p.Id, p.Y, p.X, p.PriceDescription, p.Surface, p.NRooms,
+                     p.Bathrooms, p.LocationDescription, p.OfferTypeId)
+                    for p in self.properties]
+        append = columns.append
+        for (prop_id, lat, lon, price_description, surface, rooms, bathrooms,
+             location, offer_type) in rows:
+            try:
+                offer_type = int(offer_type)
+            except (TypeError, ValueError):
+                pass
+            append(prop_id, lat, lon, parse_price(price_description), surface,
+                   rooms, bathrooms, None, location,
+                   OFFER_TYPE_OPERATIONS.get(offer_type))
+        return columns
+
+
+class BaseFotocasaAPI(object):
+    """
+        Client configuration and request building, shared by the blocking
+        FotocasaAPI and the asyncio AsyncFotocasaAPI.
+    """
     # The tuples correspond to the (categoryTypeId, purchaseTypeId)
     HOME = ('2', '2')
     NEW_HOME = ('2', '1')
@@ -459,8 +652,16 @@ class FotocasaAPI(object):
     handler_CALABASH = "http://prews.fotocasa.es/mobile/api"
     handler_PRO = "https://ws.fotocasa.es/mobile/api"
 
+    API_PATH = "/mobile/api/v3.asmx"
+    HANDLER_PATH = "/mobile/api"
+
+    PROVIDER = 'fotocasa'
+    PHOTO_SIZES = ('Photo', 'PhotoSmall', 'PhotoMedium', 'PhotoLarge')
+    USER_AGENT = "AndroidApp/5.63 (6.0.1/23; Samsung; Samsung_S8; 3.10.48-g1abae1a; 4.0.0.04_20181125-1352)"
+
     def __init__(self, imei, estate_type=None, offer_type=None, config=None,
-                 log=fotocasa_log, page_size=200, req_timeout=5.0):
+                 log=fotocasa_log, page_size=200, req_timeout=5.0,
+                 base_url=None):
         self.log = log
         self.page_size = page_size
         self.last_req_time = 0.0
@@ -472,6 +673,7 @@ class FotocasaAPI(object):
         if not self.offer_type:
             self.offer_type = self.OFFER_RENT
         self.imei = imei
+        self.metrics = None
         if not config:
             config = 'PRO'
         else:
@@ -484,42 +686,27 @@ class FotocasaAPI(object):
             self.url_handler = getattr(self, 'handler_' + config)
         else:
             self.url_handler = self.handler_PRO
+        if base_url:
+            # any other host serving the same api, like pyappapi.fakeserver
+            base_url = base_url.rstrip('/')
+            self.url = base_url + self.API_PATH
+            self.url_handler = base_url + self.HANDLER_PATH
 
-    def api_request(self, url, payload):
-        headers = {
-            "User-Agent" : "AndroidApp/5.63 (6.0.1/23; Samsung; Samsung_S8; 3.10.48-g1abae1a; 4.0.0.04_20181125-1352)"
-        }
-        try:
-            data_payload = json.dumps(payload)
-            start_time = time.time()
-            res = requests.post(url,
-                                headers=headers,
-                                json=payload,
-                                timeout=self.req_timeout)
-            end_time = time.time()
-            self.last_req_time = end_time - start_time
-            json_response = json.loads(res.text)
-        except requests.ConnectionError as conn_err:
-            self.log.exception('Connection Error url:%s payload:%s', str(url), str(payload))
-            return None
-        except requests.Timeout as tout:
-            self.log.exception('Request timeout url:%s payload:%s', str(url), str(payload))
-            return None
-        except requests.exceptions.RequestException as req_ex:
-            self.log.exception('Request exception url:%s payload:%s', str(url), str(payload))
-            return None
-        except json.decoder.JSONDecodeError as jde:
-            self.log.exception('Error decoding json: %s', str(res.text))
-            return None
-        except Exception as es:
-            self.log.exception('Unexpected exception')
-            return None
-        return json_response
+    def _headers(self):
+        return {"User-Agent": self.USER_AGENT}
 
-    def search_by_bounding_box(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+    def _endpoint_name(self, url):
+        """ 'fotocasa/BoundingBoxSearchV2' for the metrics """
+        return 'fotocasa/' + url.rsplit('/', 1)[-1]
+
+    def _bounding_box_request(self, lat_0, lon_0, lat_1, lon_1, page_num=1,
+                              pins=False):
+        """ with pins, the properties only come with their Id, X and Y """
         mfrm = MapFilterRequestModel(estate_type=self.estate_type,
                                      offer_type=self.offer_type)
         mfrm.set_bounding_box(lat_0, lon_0, lat_1, lon_1)
+        if pins:
+            mfrm.disableClustering = "true"
         mfrm.pageSize = self.page_size
         if page_num < 1:
             page_num = 1
@@ -527,9 +714,9 @@ class FotocasaAPI(object):
                   page_num, lat_0, lon_0, lat_1, lon_1)
         mfrm.page = page_num
         mfrm.signature = signature(imei=self.imei)
-        return self.api_request(self.url + "/BoundingBoxSearchV2", vars(mfrm))
+        return self.url + "/BoundingBoxSearchV2", vars(mfrm)
 
-    def search_by_coordinates(self, lat, lon):
+    def _coordinates_request(self, lat, lon):
         endpoint = self.url + '/Search'
         frm = FilterRequestModel(estate_type=self.estate_type,
                                  offer_type=self.offer_type)
@@ -539,34 +726,454 @@ class FotocasaAPI(object):
         frm.sort = '1'
         frm.signature = signature(imei=self.imei)
         self.log.info('search_by_coordinates page:  1 coords:(%f, %f)', lat, lon)
-        return self.api_request(endpoint, vars(frm))
-
-    def search_by_location(self, location_text):
-        locations = self.get_locations(location_text)
-        if 'd' not in locations or 'Suggest' not in locations['d']:
-            return None
-        if len(locations['d']['Suggest']) == 0:
-            return None
-        location = locations['d']['Suggest'][0]
-        location_codes = [location['LocationLevel' + str(i)] for i in range(1,6)]
-        lat = location['Y']
-        lon = location['X']
-        return self.search_by_location_codes(location_codes, lat, lon)
+        return endpoint, vars(frm)
 
-    def search_by_location_codes(self, location_codes, lat, lon):
+    def _location_codes_request(self, location_codes, lat, lon, page_num=1):
         endpoint = self.url + '/Search'
         frm = FilterRequestModel(estate_type=self.estate_type,
                                  offer_type=self.offer_type)
         frm.locations = ','.join(location_codes)
         frm.pageSize = self.page_size
+        frm.page = max(1, page_num)
         frm.latitude = lat
         frm.longitude = lon
         frm.signature = signature(imei=self.imei)
-        return self.api_request(endpoint, vars(frm))
+        return endpoint, vars(frm)
 
-    def get_locations(self, location_text):
+    def _locations_request(self, location_text):
         endpoint = self.url + '/GetSuggest'
         glsrm = GetLocationSuggestionsRequestModel()
         glsrm.text = location_text
         glsrm.signature = signature(imei=self.imei)
-        return self.api_request(endpoint, vars(glsrm))
+        return endpoint, vars(glsrm)
+
+    def _detail_request(self, property_id):
+        endpoint = self.url + '/GetProperty'
+        gprm = GetPropertyRequestModel(property_id)
+        gprm.signature = signature(imei=self.imei)
+        return endpoint, vars(gprm)
+
+    def _parse_detail(self, json_response):
+        """ FotocasaDetailsResult of a GetProperty response, or None """
+        if json_response is None or not json_response.get('d'):
+            return None
+        with timed(self.metrics, 'fotocasa/GetProperty', 'build'):
+            return FotocasaDetailsResult(json_response['d'], log=self.log)
+
+    def _locations_kind(self):
+        """ the (categoryTypeId, offerTypeId) of the GetSuggest requests """
+        glsrm = GetLocationSuggestionsRequestModel()
+        return glsrm.categoryTypeId, glsrm.offerTypeId
+
+    def _first_location(self, locations):
+        """
+            Picks the best suggestion of a GetSuggest response, returns
+            the (location_codes, lat, lon) tuple or None.
+        """
+        if not locations:
+            return None
+        if 'd' not in locations or 'Suggest' not in locations['d']:
+            return None
+        if len(locations['d']['Suggest']) == 0:
+            return None
+        location = locations['d']['Suggest'][0]
+        location_codes = [location['LocationLevel' + str(i)] for i in range(1,6)]
+        lat = location['Y']
+        lon = location['X']
+        return location_codes, lat, lon
+
+    def page_endpoint(self, kind):
+        """ metrics name of the 'bbox' or 'loc' search pages """
+        if kind == 'loc':
+            return 'fotocasa/Search'
+        return 'fotocasa/BoundingBoxSearchV2'
+
+    def _parse_bounding_box_page(self, json_response, endpoint=None):
+        """
+            Returns the (properties, total_pages) of a bounding box (or
+            location) search page, the number of pages comes from the
+            DataLayer search_results_number. None for responses that are
+            not a search page, like the error bodies.
+        """
+        if json_response is None or 'd' not in json_response:
+            return None
+        with timed(self.metrics, endpoint or self.page_endpoint('bbox'), 'build'):
+            result = FotocasaSearchResult(json_response, log=self.log)
+        return result.properties, self._total_pages(self._results_number(result))
+
+    def _parse_pins_page(self, json_response):
+        """
+            Returns the ([(Id, lat, lon), ...], total_pages) of a pins
+            page, read from the json without building any model.
+        """
+        if json_response is None or 'd' not in json_response:
+            return None
+        j_data = json_response['d']
+        pins = [(prop['Id'], prop['Y'], prop['X'])
+                for prop in j_data.get('Properties') or ()]
+        results_number = len(pins)
+        if j_data.get('DataLayer'):
+            metadata = FotocasaMetaDataResult(j_data['DataLayer'], log=self.log)
+            results_number = metadata.search_results_number or results_number
+        return pins, self._total_pages(results_number)
+
+    def decode_page(self, text_response, endpoint=None):
+        """
+            json of a search page response (pipeline decode stage),
+            timed under endpoint (a page_endpoint, the bounding box one
+            by default)
+        """
+        with timed(self.metrics, endpoint or self.page_endpoint('bbox'), 'decode'):
+            return json.loads(text_response)
+
+    def build_page(self, json_response, endpoint=None):
+        """ (properties, total_pages) of a decoded page (pipeline build stage) """
+        return self._parse_bounding_box_page(json_response, endpoint=endpoint)
+
+    def build_page_columns(self, json_response, endpoint=None):
+        """ (ResultColumns, total_pages) of a decoded page """
+        if json_response is None or 'd' not in json_response:
+            return None
+        with timed(self.metrics, endpoint or self.page_endpoint('bbox'), 'build'):
+            result = FotocasaSearchResult(json_response, log=self.log)
+            columns = result.to_columns()
+        return columns, self._total_pages(self._results_number(result))
+
+    def _results_number(self, result):
+        if result.metadata is not None and result.metadata.search_results_number:
+            return result.metadata.search_results_number
+        return len(result.properties)
+
+    def _total_pages(self, results_number):
+        return max(1, int(math.ceil(results_number / float(self.page_size))))
+
+    def listing_key(self, element):
+        return element.Id
+
+    def listing_coords(self, element):
+        return element.Y, element.X
+
+    def listing_features(self, element):
+        """ (price, size, rooms), the price read from PriceDescription """
+        return (parse_price(element.PriceDescription), element.Surface,
+                element.NRooms)
+
+    def listing_fingerprint(self, element):
+        """ changes when the price, size or number of photos change """
+        return fingerprint(parse_price(element.PriceDescription),
+                           element.PriceDescription, element.Surface,
+                           len(element.MediaList or ()))
+
+    def listing_image_urls(self, element, size=None):
+        """
+            Image urls of a listing (or details result). size is one of
+            the PHOTO_SIZES fields for the main photo at that size, or None
+            for the whole MediaList (the main photo when it is empty).
+        """
+        if size is not None:
+            if size not in self.PHOTO_SIZES:
+                raise ValueError('unknown photo size {!r}'.format(size))
+            url = getattr(element, size, None)
+            return [url] if url else []
+        urls = [media['Url'] for media in getattr(element, 'MediaList', None) or ()
+                if isinstance(media, dict) and media.get('Url')]
+        if not urls:
+            main = getattr(element, 'Photo', None) or getattr(element, 'MainPhoto', None)
+            if main:
+                urls.append(main)
+        return urls
+
+
+class FotocasaAPI(BaseFotocasaAPI, PooledSessionMixin):
+
+    def __init__(self, imei, estate_type=None, offer_type=None, config=None,
+                 log=fotocasa_log, page_size=200, req_timeout=5.0,
+                 session=None,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False,
+                 keep_alive=True,
+                 cache=None,
+                 rate_limiter=None,
+                 retry_policy=None,
+                 metrics=None,
+                 base_url=None,
+                 location_cache=None,
+                 detail_cache=None):
+        super(FotocasaAPI, self).__init__(imei, estate_type=estate_type,
+                                          offer_type=offer_type,
+                                          config=config, log=log,
+                                          page_size=page_size,
+                                          req_timeout=req_timeout,
+                                          base_url=base_url)
+        self._init_session(session=session,
+                           pool_connections=pool_connections,
+                           pool_maxsize=pool_maxsize,
+                           pool_block=pool_block,
+                           keep_alive=keep_alive)
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.metrics = metrics
+        self.location_cache = location_cache
+        self.detail_cache = detail_cache
+        self.last_error = None
+
+    def _limited_post(self, url, payload):
+        start_time = time.perf_counter()
+        with limited(self.rate_limiter) as slot:
+            res = self.session.post(url,
+                                    headers=self._headers(),
+                                    json=payload,
+                                    timeout=self.req_timeout)
+            slot.record_status(res.status_code)
+        if self.metrics is not None:
+            self.metrics.record_request(self._endpoint_name(url),
+                                        time.perf_counter() - start_time,
+                                        len(res.content), res.status_code)
+        return res
+
+    def _post(self, url, payload):
+        """
+            Posts the payload, through the retry policy when there is one.
+            Retries and hedged requests are signed again, as the signature
+            is time based.
+        """
+        if self.retry_policy is None:
+            return self._limited_post(url, payload)
+
+        def attempt(n):
+            signed = payload
+            if n > 0 and 'signature' in payload:
+                signed = dict(payload, signature=signature(imei=self.imei))
+            return self._limited_post(url, signed)
+        return self.retry_policy.call(attempt, log=self.log)
+
+    def _request_failed(self, url, error):
+        self.last_error = error
+        if self.metrics is not None:
+            self.metrics.record_error(self._endpoint_name(url),
+                                      type(error).__name__)
+
+    def api_request_text(self, url, payload, cache=None):
+        """
+            Posts the payload and returns the response text, or None on
+            errors, leaving the exception in last_error. With a cache
+            (pyappapi.cache, the client one unless another is given),
+            responses to the same request (the signature aside) are
+            reused.
+        """
+        self.last_error = None
+        cache = self.cache if cache is None else cache
+        key = None
+        if cache is not None:
+            key = cache_key(url, payload=payload)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+        try:
+            start_time = time.time()
+            res = self._post(url, payload)
+            end_time = time.time()
+            self.last_req_time = end_time - start_time
+            text = res.text
+        except requests.ConnectionError as conn_err:
+            self._request_failed(url, conn_err)
+            self.log.exception('Connection Error url:%s payload:%s', str(url), str(payload))
+            return None
+        except requests.Timeout as tout:
+            self._request_failed(url, tout)
+            self.log.exception('Request timeout url:%s payload:%s', str(url), str(payload))
+            return None
+        except requests.exceptions.RequestException as req_ex:
+            self._request_failed(url, req_ex)
+            self.log.exception('Request exception url:%s payload:%s', str(url), str(payload))
+            return None
+        except Exception as es:
+            self._request_failed(url, es)
+            self.log.exception('Unexpected exception')
+            return None
+        if key is not None and res.status_code == 200:
+            cache.set(key, text)
+        return text
+
+    def api_request(self, url, payload, cache=None):
+        """
+            Posts the payload and returns the decoded json response, or
+            None on errors, leaving the exception in last_error.
+        """
+        text = self.api_request_text(url, payload, cache=cache)
+        if text is None:
+            return None
+        try:
+            with timed(self.metrics, self._endpoint_name(url), 'decode'):
+                return json.loads(text)
+        except json.decoder.JSONDecodeError as jde:
+            self._request_failed(url, jde)
+            self.log.exception('Error decoding json: %s', str(text))
+            return None
+
+    def search_by_bounding_box(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+        return self.api_request(*self._bounding_box_request(lat_0, lon_0,
+                                                            lat_1, lon_1,
+                                                            page_num=page_num))
+
+    def bounding_box_page_text(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+        """ undecoded response of a bounding box page, for pyappapi.pipeline """
+        return self.api_request_text(*self._bounding_box_request(lat_0, lon_0,
+                                                                 lat_1, lon_1,
+                                                                 page_num=page_num))
+
+    def probe_bounding_box(self, lat_0, lon_0, lat_1, lon_1):
+        """
+            Returns the (count, first_page) of a bounding box: the DataLayer
+            search_results_number, and the parsed (properties, total_pages)
+            of page 1, so it does not need to be requested again.
+        """
+        json_response = self.search_by_bounding_box(lat_0, lon_0, lat_1, lon_1,
+                                                    page_num=1)
+        if json_response is None or 'd' not in json_response:
+            return None
+        with timed(self.metrics, 'fotocasa/BoundingBoxSearchV2', 'build'):
+            result = FotocasaSearchResult(json_response, log=self.log)
+        count = self._results_number(result)
+        return count, (result.properties, self._total_pages(count))
+
+    def iter_bounding_box(self, lat_0, lon_0, lat_1, lon_1,
+                          prefetch=DEFAULT_PREFETCH, max_pages=None,
+                          first_page=None, report=None):
+        """
+            Yields every FotocasaPropertyResult in the bounding box, going
+            through all the result pages. Up to `prefetch` pages are
+            requested in background while the current one is consumed.
+            first_page is an already parsed page 1, as returned by
+            probe_bounding_box, and report an optional
+            pyappapi.prefetch.PageReport.
+        """
+        def fetch_page(page_num):
+            return self.search_by_bounding_box(lat_0, lon_0, lat_1, lon_1,
+                                               page_num=page_num)
+        return iter_prefetched_pages(fetch_page,
+                                     self._parse_bounding_box_page,
+                                     prefetch=prefetch,
+                                     max_pages=max_pages,
+                                     first_page=first_page,
+                                     report=report)
+
+    def iter_bounding_box_pins(self, lat_0, lon_0, lat_1, lon_1,
+                               prefetch=DEFAULT_PREFETCH, max_pages=None,
+                               report=None):
+        """
+            Yields the (Id, lat, lon) of every property in the bounding
+            box, from the map search without clustering, which leaves out
+            the rest of the listing data. Pages like iter_bounding_box.
+        """
+        def fetch_page(page_num):
+            return self.api_request(*self._bounding_box_request(lat_0, lon_0,
+                                                                lat_1, lon_1,
+                                                                page_num=page_num,
+                                                                pins=True))
+        return iter_prefetched_pages(fetch_page,
+                                     self._parse_pins_page,
+                                     prefetch=prefetch,
+                                     max_pages=max_pages,
+                                     report=report)
+
+    def search_by_coordinates(self, lat, lon):
+        return self.api_request(*self._coordinates_request(lat, lon))
+
+    def search_by_location(self, location_text):
+        location = self.resolve_location(location_text)
+        if location is None:
+            return None
+        location_codes, lat, lon = location
+        return self.search_by_location_codes(location_codes, lat, lon)
+
+    def search_by_location_codes(self, location_codes, lat, lon, page_num=1):
+        return self.api_request(*self._location_codes_request(location_codes,
+                                                              lat, lon,
+                                                              page_num=page_num))
+
+    def iter_location(self, location_text, prefetch=DEFAULT_PREFETCH,
+                      max_pages=None, report=None):
+        """
+            Yields every FotocasaPropertyResult of a location search, going
+            through all the result pages, like iter_bounding_box.
+        """
+        location = self.resolve_location(location_text)
+        if location is None:
+            return iter(())
+        location_codes, lat, lon = location
+
+        def fetch_page(page_num):
+            return self.search_by_location_codes(location_codes, lat, lon,
+                                                 page_num=page_num)
+
+        def parse_page(json_response):
+            return self._parse_bounding_box_page(json_response,
+                                                 endpoint=self.page_endpoint('loc'))
+        return iter_prefetched_pages(fetch_page,
+                                     parse_page,
+                                     prefetch=prefetch,
+                                     max_pages=max_pages,
+                                     report=report)
+
+    def location_page_fetcher(self, location_text):
+        """
+            The page_num -> undecoded response function of a location
+            search, for pyappapi.pipeline. None when the location is not
+            found.
+        """
+        location = self.resolve_location(location_text)
+        if location is None:
+            return None
+        location_codes, lat, lon = location
+
+        def fetch_page(page_num):
+            return self.api_request_text(*self._location_codes_request(
+                location_codes, lat, lon, page_num=page_num))
+        return fetch_page
+
+    def get_locations(self, location_text):
+        return self.api_request(*self._locations_request(location_text))
+
+    def get_detail(self, property_id):
+        """
+            FotocasaDetailsResult of a property, or None. Responses are
+            kept in the detail_cache (or else the cache), and requested
+            again once they expire.
+        """
+        return self._parse_detail(self.api_request(
+            *self._detail_request(property_id), cache=self.detail_cache))
+
+    def get_details(self, property_ids, workers=DEFAULT_WORKERS):
+        """
+            Yields the (property_id, FotocasaDetailsResult or None) of
+            every id as they complete, with `workers` concurrent requests.
+            Ids with a fresh cached detail are answered without a request.
+        """
+        return iter_completed(self.get_detail, property_ids, workers=workers)
+
+    def resolve_location(self, location_text):
+        """
+            The (location_codes, lat, lon) of the first suggestion for the
+            text, or None. With a location_cache
+            (pyappapi.locations.LocationCache) the suggestion is only
+            requested when it is not cached or expired, and an expired one
+            is still used when the refresh fails.
+        """
+        if self.location_cache is None:
+            return self._first_location(self.get_locations(location_text))
+        category, offer = self._locations_kind()
+        location = self.location_cache.get(location_text, category, offer)
+        if location is not None:
+            return location
+        location = self._first_location(self.get_locations(location_text))
+        if location is not None:
+            self.location_cache.set(location_text, category, offer, location)
+            return location
+        location = self.location_cache.get(location_text, category, offer,
+                                           stale=True)
+        if location is not None:
+            self.log.warning('Using an expired location for %s', location_text)
+        return location
@@ -0,0 +1,105 @@
+# -*- encoding: utf8 -*-
+import asyncio
+import time
+
+import aiohttp
+
+from idealista.idealista import BaseIdealistaAPI, idealista_log
+from pyappapi.aio import (AsyncSessionMixin, DEFAULT_MAX_CONCURRENCY,
+                          DEFAULT_CONNECTION_LIMIT)
+
+
+class AsyncIdealistaAPI(BaseIdealistaAPI, AsyncSessionMixin):
+    """
+        asyncio version of IdealistaAPI, including the OAuth flow. At most
+        max_concurrency requests are in flight at any time.
+
+        async with AsyncIdealistaAPI() as iapi:
+            iapi.load_authorization(await iapi.authorize())
+            res = await iapi.search_by_bounding_box(lat_0, lon_0, lat_1, lon_1)
+    """
+
+    def __init__(self, locale='en',
+                       user_id='5b85c03c16bbb85d96e232b112ee85dc', # this is hardcoded in the app
+                       property_type=u'homes',
+                       operation=u'rent',
+                       log=idealista_log,
+                       page_size=50,
+                       req_timeout=10.0,
+                       session=None,
+                       max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                       limit=DEFAULT_CONNECTION_LIMIT,
+                       limit_per_host=0,
+                       keep_alive=True,
+                       base_url=None):
+        super(AsyncIdealistaAPI, self).__init__(locale=locale,
+                                                user_id=user_id,
+                                                property_type=property_type,
+                                                operation=operation,
+                                                log=log,
+                                                page_size=page_size,
+                                                req_timeout=req_timeout,
+                                                base_url=base_url)
+        self._init_async_session(session=session,
+                                 max_concurrency=max_concurrency,
+                                 limit=limit,
+                                 limit_per_host=limit_per_host,
+                                 keep_alive=keep_alive)
+
+    async def _post(self, url, params=None, data=None, headers=None):
+        async with self.semaphore:
+            start_time = time.time()
+            async with self.session.post(url, params=params, data=data,
+                                         headers=headers,
+                                         timeout=self._client_timeout()) as res:
+                text = await res.text()
+            end_time = time.time()
+            self.last_req_time = end_time - start_time
+        return text
+
+    async def authorize(self):
+        oauth_token_url, headers, data_payload = self._authorize_request()
+        try:
+            return await self._post(oauth_token_url, data=data_payload,
+                                    headers=headers)
+        except asyncio.TimeoutError as tout:
+            self.log.exception('IDEALISTA Auth # Request timeout url:%s payload:%s',
+                                str(oauth_token_url), str(data_payload))
+            return None
+        except aiohttp.ClientError as req_ex:
+            self.log.exception('IDEALISTA Auth # Request exception url:%s payload:%s',
+                                str(oauth_token_url), str(data_payload))
+            return None
+        except Exception as es:
+            self.log.exception('IDEALISTA Auth # Unexpected exception')
+            return None
+
+    async def _search_post(self, url, url_params, form_params):
+        """ search request returning the response text, or None on errors """
+        headers = self._common_headers(self._token_auth())
+        try:
+            return await self._post(url, params=url_params, data=form_params,
+                                    headers=headers)
+        except asyncio.TimeoutError as tout:
+            self.log.exception('IDEALISTA API # Request timeout url:%s payload:%s',
+                                str(url), str(form_params))
+            return None
+        except aiohttp.ClientError as req_ex:
+            self.log.exception('IDEALISTA API # Request exception url:%s payload:%s',
+                                str(url), str(form_params))
+            return None
+        except Exception as es:
+            self.log.exception('IDEALISTA API # Unexpected exception')
+            return None
+
+    async def search_by_bounding_box(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+        return await self._search_post(*self._bounding_box_request(lat_0, lon_0,
+                                                                   lat_1, lon_1,
+                                                                   page_num=page_num))
+
+    async def search_by_location(self, location_name, save_to_file=None, page=1):
+        text = await self._search_post(*self._location_request(location_name,
+                                                               page=page))
+        if save_to_file and text is not None:
+            self._save_result(save_to_file, text)
+        return text
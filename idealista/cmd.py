@@ -3,24 +3,67 @@
 Usage:
     cmd.py bbox <min_lat> <min_lon> <max_lat> <max_lon> [<token_file>]
     cmd.py loc  <location_name> [<token_file>]
+    cmd.py batch <input_file> [<token_file>] [--workers=<n>]
+                 [--fetch-workers=<n>] [--max-pages=<n>]
+
+Options:
+    --workers=<n>        Jobs run at the same time [default: 4]
+    --fetch-workers=<n>  Pages requested at the same time per job [default: 2]
+    --max-pages=<n>      Page cap of each job
+
+batch reads one `bbox <min_lat> <min_lon> <max_lat> <max_lon>` or
+`loc <location_name>` job per line of <input_file> (- for stdin), and
+writes NDJSON to stdout: a line per listing and a status line per job.
+The client authorizes once for the whole batch.
 """
 import json
+import os
+import sys
 import time
 from docopt import docopt
 from pprint import pprint as _p
-from idealista import IdealistaAPI, IdealistaSearchResults
+from idealista.idealista import (IdealistaAPI, IdealistaSearchResults,
+                                 IdealistaLocalStorage, IdealistaTokenManager)
+from pyappapi.batch import BatchRunner
+
+
+def run_batch(iapi, args):
+    workers = int(args['--workers'])
+    fetch_workers = int(args['--fetch-workers'])
+    max_pages = args['--max-pages']
+    input_file = args['<input_file>']
+    runner = BatchRunner(iapi, sys.stdout, workers=workers,
+                         fetch_workers=fetch_workers,
+                         max_pages=int(max_pages) if max_pages else None)
+    if input_file == '-':
+        counts = runner.run(sys.stdin)
+    else:
+        with open(input_file) as lines:
+            counts = runner.run(lines)
+    sys.stderr.write('jobs: {}\n'.format(json.dumps(counts, sort_keys=True)))
+
 
 if __name__ == '__main__':
     args = docopt(__doc__)
-    _p(args)
-    iapi = IdealistaAPI()
+    if not args['batch']:
+        # stdout only carries NDJSON in batch mode
+        _p(args)
+    pool = {}
+    if args['batch']:
+        pool['pool_maxsize'] = int(args['--workers']) * int(args['--fetch-workers'])
     token_file = args['<token_file>']
     if token_file:
-        iapi.load_authorization(token_store_file=token_file)
+        storage = IdealistaLocalStorage(storage_dir=os.path.dirname(token_file) or '.',
+                                        token_file=os.path.basename(token_file))
+        iapi = IdealistaAPI(token_manager=IdealistaTokenManager(storage), **pool)
     else:
+        iapi = IdealistaAPI(**pool)
         res = iapi.authorize()
         iapi.load_authorization(res)
-    if args['loc']:
+    if args['batch']:
+        with iapi:
+            run_batch(iapi, args)
+    elif args['loc']:
         location_name = args['<location_name>']
         res = iapi.search_by_location(location_name)
         _p(res)
@@ -8,7 +8,27 @@ import os
 import logging
 import time
 import random
+import re
 import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from pyappapi.cache import cache_key
+from pyappapi.columns import ResultColumns
+from pyappapi.incremental import fingerprint
+from pyappapi.lazy import LazyResultList
+from pyappapi.metrics import timed
+from pyappapi.models import SlottedDataMeta
+from pyappapi.prefetch import (iter_completed, iter_prefetched_pages,
+                               DEFAULT_PREFETCH, DEFAULT_WORKERS)
+from pyappapi.ratelimit import limited
+from pyappapi.session import (PooledSessionMixin, DEFAULT_POOL_CONNECTIONS,
+                              DEFAULT_POOL_MAXSIZE)
 
 """
 About Images:
@@ -25,19 +45,30 @@ TODO: look if we can request bigger images to the search api
 
 idealista_log = logging.getLogger(__name__)
 
-class IdealistaData(object):
+# image url variants, the search one and the (watermarked) detail one
+IMAGE_LISTING = u'WEB_LISTING-M'
+IMAGE_DETAIL = u'WEB_DETAIL-L-L'
+_IMAGE_VARIANT = re.compile(r'/blur/[^/]+/')
+
+DEFAULT_REFRESH_MARGIN = 300.0
+
+
+class IdealistaAuthorizationError(Exception):
+    """ no access token could be obtained for a request """
+
+
+class IdealistaData(object, metaclass=SlottedDataMeta):
+    """
+        The required / optional lists of each model (plus its
+        extra_fields) are turned into slots by SlottedDataMeta.
+    """
     def __init__(self, json_dict, log=idealista_log):
-        for field in self.required:
-            if field in json_dict:
-                setattr(self, field, json_dict[field])
-            else:
-                log.error('Missing required field %s', str(field))
-                raise ValueError('missing required field {}'.format(field))
-        for field in self.optional:
-            if field in json_dict:
-                setattr(self, field, json_dict[field])
-            else:
-                setattr(self, field, None)
+        try:
+            self._load_fields(json_dict)
+        except KeyError as ke:
+            field = ke.args[0]
+            log.error('Missing required field %s', str(field))
+            raise ValueError('missing required field {}'.format(field))
 
 
 class IdealistaImage(IdealistaData):
@@ -49,6 +80,8 @@ class IdealistaImage(IdealistaData):
 
 
 class IdealistaMultimedia(object):
+    __slots__ = ('images',)
+
     def __init__(self, json_data):
         self.images = []
         if 'images' in json_data:
@@ -75,6 +108,7 @@ class IdealistaContactInfo(IdealistaData):
             "contactName",
             "userType",
         ]
+    extra_fields = ['phone1']
 
     def __init__(self, json_dict):
         super(IdealistaContactInfo, self).__init__(json_dict)
@@ -131,13 +165,15 @@ class IdealistaSearchResultElement(IdealistaData):
         "district",
         'thumbnail',
     ]
+    extra_fields = [
+        'contactInfo',
+        'multimedia',
+        'suggestedTexts',
+        'detailedType',
+    ]
 
     def __init__(self, json_dict):
         super(IdealistaSearchResultElement, self).__init__(json_dict)
-        self.contactInfo = None
-        self.multimedia = None
-        self.suggestedTexts = None
-        self.detailedType = None
         if 'contactInfo' in json_dict:
             self.contactInfo = IdealistaContactInfo(json_dict['contactInfo'])
         else:
@@ -165,17 +201,108 @@ class IdealistaSearchResults(IdealistaData):
         "actualPage",
         "upperRangePosition",
         ]
+    extra_fields = ['element_list']
 
-    def __init__(self, json_dict):
+    def __init__(self, json_dict, lazy=False):
+        """
+            With lazy=True element_list is a LazyResultList, that builds
+            each IdealistaSearchResultElement only when it is accessed.
+        """
         super(self.__class__, self).__init__(json_dict)
         self.element_list = []
         if "elementList" in json_dict:
+            if lazy:
+                self.element_list = LazyResultList(json_dict['elementList'],
+                                                   IdealistaSearchResultElement,
+                                                   'propertyCode',
+                                                   'latitude', 'longitude')
+                return
             for el in json_dict['elementList']:
                 idealista_element = IdealistaSearchResultElement(el)
                 self.element_list.append(idealista_element)
 
+    def __len__(self):
+        return len(self.element_list)
+
+    def ids(self):
+        if isinstance(self.element_list, LazyResultList):
+            return self.element_list.ids()
+        return [el.propertyCode for el in self.element_list]
+
+    def coords(self):
+        """ (latitude, longitude) of every element """
+        if isinstance(self.element_list, LazyResultList):
+            return self.element_list.coords()
+        return [(el.latitude, el.longitude) for el in self.element_list]
+
+    def to_columns(self, columns=None):
+        """ Appends the elements to a ResultColumns batch (a new one by default) """
+        if columns is None:
+            columns = ResultColumns()
+        append = columns.append
+        if isinstance(self.element_list, LazyResultList):
+            for el in self.element_list.raw_elements():
+                get = el.get
+                append(get('propertyCode'), get('latitude'), get('longitude'),
+                       get('price'), get('size'), get('rooms'), get('bathrooms'),
+                       get('province'), get('municipality'), get('operation'))
+        else:
+            for el in self.element_list:
+                append(el.propertyCode, el.latitude, el.longitude, el.price,
+                       el.size, el.rooms, el.bathrooms, el.province,
+                       el.municipality, el.operation)
+        return columns
+
+
+class IdealistaPropertyDetail(IdealistaData):
+    required = []
+    optional = [
+        "adid",
+        "propertyCode",
+        "price",
+        "priceInfo",
+        "operation",
+        "propertyType",
+        "extendedPropertyType",
+        "homeType",
+        "state",
+        "country",
+        "ubication",
+        "moreCharacteristics",
+        "propertyComment",
+        "detailWebLink",
+        "modificationDate",
+        "suggestedTexts",
+    ]
+    extra_fields = [
+        'contactInfo',
+        'multimedia',
+        'detailedType',
+    ]
+
+    def __init__(self, json_dict):
+        super(IdealistaPropertyDetail, self).__init__(json_dict)
+        if 'contactInfo' in json_dict:
+            self.contactInfo = IdealistaContactInfo(json_dict['contactInfo'])
+        else:
+            self.contactInfo = None
+        if 'multimedia' in json_dict:
+            self.multimedia = IdealistaMultimedia(json_dict['multimedia'])
+        else:
+            self.multimedia = None
+        if 'detailedType' in json_dict:
+            self.detailedType = IdealistaDetailedType(json_dict['detailedType'])
+        else:
+            self.detailedType = None
+
+
+class BaseIdealistaAPI(object):
+    """
+        Client configuration and request building, shared by the blocking
+        IdealistaAPI and the asyncio AsyncIdealistaAPI.
+    """
+    PROVIDER = 'idealista'
 
-class IdealistaAPI(object):
     OPERATION_RENT = u"rent"
     OPERATION_SALE = u"sale"
 
@@ -188,6 +315,7 @@ class IdealistaAPI(object):
     PROPERTY_LANDS = u"lands"
     PROPERTY_BEDROOMS = u"bedrooms"
 
+    BASE_URL = u"https://secure.idealista.com"
     URL_OAUTH_TOKEN = u"https://secure.idealista.com/api/oauth/token"
     URL_SEARCH = u"https://secure.idealista.com/api/3.5/es/search"
     URL_DETAIL = u"https://secure.idealista.com/api/3/es/detail/{property_id}"
@@ -195,7 +323,8 @@ class IdealistaAPI(object):
     # TODO: implement the locations requests:
     # can get points of interest
     URL_LOCATIONS = u"https://secure.idealista.com/api/3/es/locations?coordinates=41.4389239%2C2.195738&showPois=true"
-    URL_MAP_SEARCH = u"https://secure.idealista.com/api/3.5/es/map/search?t=14566605368570.7027966808362714&k=5b85c03c16bbb85d96e232b112ee85dc"
+    # only the code and coordinates of every property, the map pins
+    URL_MAP_SEARCH = u"https://secure.idealista.com/api/3.5/es/map/search"
 
     def __init__(self, locale='en',
                        user_id='5b85c03c16bbb85d96e232b112ee85dc', # this is hardcoded in the app
@@ -203,7 +332,8 @@ class IdealistaAPI(object):
                        operation=u'rent',
                        log=idealista_log,
                        page_size=50,
-                       req_timeout=10.0):
+                       req_timeout=10.0,
+                       base_url=None):
         self.log = log
         self.locale = locale
         self.user_id = user_id
@@ -213,6 +343,14 @@ class IdealistaAPI(object):
         self.page_size = page_size
         self.last_req_time = 0.0
         self.req_timeout = req_timeout
+        self.metrics = None
+        if base_url:
+            # any other host serving the same api, like pyappapi.fakeserver
+            for name in ('URL_OAUTH_TOKEN', 'URL_SEARCH', 'URL_DETAIL',
+                         'URL_LOCATIONS', 'URL_MAP_SEARCH'):
+                url = getattr(self, name).replace(self.BASE_URL,
+                                                  base_url.rstrip('/'), 1)
+                setattr(self, name, url)
 
 
         # # The Basic auth is always the same because uses the api key and the api
@@ -237,11 +375,10 @@ class IdealistaAPI(object):
         self.t_param = self._t_param()
         self.user_agent = random.choice(user_agents)
         self.app_version = "7.3.7"
+        self.android_device_identifier = hashlib.sha256(self.t_param.encode('utf-8')).hexdigest()[-16:]
 
-    def authorize(self):
-        oauth_token_url = self.URL_OAUTH_TOKEN
+    def _authorize_request(self):
         self._create_terminal()
-        self.android_device_identifier = hashlib.sha256(self.t_param.encode('utf-8')).hexdigest()[-16:]
         headers = {
             "User-Agent": self.user_agent, # "Dalvik/2.1.0 (Linux; U; Android 6.0.1; Aquaris E5 Build/MMB29M)",
             "app_version": self.app_version,
@@ -253,28 +390,7 @@ class IdealistaAPI(object):
             "grant_type": "client_credentials",
             "scope": "write",
         }
-        try:
-            res = requests.post(oauth_token_url,
-                                headers=headers,
-                                data=data_payload,
-                                timeout=self.req_timeout)
-            token_body = res.text
-            return token_body
-        except requests.ConnectionError as conn_err:
-            self.log.exception('IDEALISTA Auth # Connection Error url:%s payload:%s',
-                                str(url), str(payload))
-            return None
-        except requests.Timeout as tout:
-            self.log.exception('IDEALISTA Auth # Request timeout url:%s payload:%s',
-                                str(url), str(payload))
-            return None
-        except requests.exceptions.RequestException as req_ex:
-            self.log.exception('IDEALISTA Auth # Request exception url:%s payload:%s',
-                                str(url), str(payload))
-            return None
-        except Exception as es:
-            self.log.exception('IDEALISTA Auth # Unexpected exception')
-            return None
+        return self.URL_OAUTH_TOKEN, headers, data_payload
 
     def load_authorization(self, token_response):
         """ loads a previously acquired token from file """
@@ -317,19 +433,23 @@ class IdealistaAPI(object):
         }
         return headers
 
+    def _endpoint_name(self, url):
+        """ 'idealista/search', 'idealista/detail' or 'idealista/oauth' for the metrics """
+        if url == self.URL_OAUTH_TOKEN:
+            return 'idealista/oauth'
+        if url.startswith(self.URL_DETAIL.split('{', 1)[0]):
+            return 'idealista/detail'
+        if url == self.URL_MAP_SEARCH:
+            return 'idealista/map'
+        return 'idealista/' + url.split('?')[0].rsplit('/', 1)[-1]
+
     def _t_param(self):
         # terminal_id param
         n = datetime.now()
         return str(n.timestamp() * 10000.0)
 
-    def get_detail(self, property_id):
-        url = self.DETAIL_URL.format(property_id=property_id)
-        url_params = { 'language' : self.lang,
-                       'k' : self.user_id,
-                       't' : self.t_param, # self._t_param(),
-                     }
-
-    def search_by_bounding_box(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+    def _bounding_box_request(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+        """ returns the (url, url_params, form_params) of a bounding box search """
         url = self.URL_SEARCH
         shape = self._create_shape(lat_0, lon_0, lat_1, lon_1)
         url_params = {
@@ -337,20 +457,6 @@ class IdealistaAPI(object):
                     'k' : self.user_id,
                     't' : self.t_param, # self._t_param(),
                     }
-        # TODO:
-        # check if this kind of request works as expected:
-        form_params = {
-            u"shape": shape,
-            u"propertyType": self.property_type,
-            u"locale":       self.lang,
-            u"maxItems":     0,
-            u"numPage":      0,
-            u"country":      "es",
-            u"operation":    self.operation,
-            u"distance":     0,
-        }
-        # it looks like this call is made to fetch the number of items in the bounding
-        # box
         form_params = {
                 u"shape":        shape,
                 u"order":        u"distance",
@@ -360,7 +466,7 @@ class IdealistaAPI(object):
                 u"isPoi":        u"true",
                 u"maxItems":     self.page_size,
                 u"locationName": u"",
-                u"numPage":      1,
+                u"numPage":      page_num,
                 u"operation":    self.operation,
                 u"distance":     2000,
                 u"sort":         u"asc",
@@ -369,31 +475,72 @@ class IdealistaAPI(object):
                 u"gallery":      u"true",
                 u"quality":      u"high",
                       }
-        headers = self._common_headers(self._token_auth())
-        try:
-            start_time = time.time()
-            res = requests.post(url, params=url_params, data=form_params,
-                                headers=headers, timeout=self.req_timeout)
-            end_time = time.time()
-            self.last_req_time = end_time - start_time
-        except requests.ConnectionError as conn_err:
-            self.log.exception('IDEALISTA API # Connection Error url:%s payload:%s',
-                                str(url), str(payload))
-            return None
-        except requests.Timeout as tout:
-            self.log.exception('IDEALISTA API # Request timeout url:%s payload:%s',
-                                str(url), str(payload))
-            return None
-        except requests.exceptions.RequestException as req_ex:
-            self.log.exception('IDEALISTA API # Request exception url:%s payload:%s',
-                                str(url), str(payload))
+        return url, url_params, form_params
+
+    def _pins_request(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+        """ returns the (url, url_params, form_params) of a map pins search """
+        url = self.URL_MAP_SEARCH
+        shape = self._create_shape(lat_0, lon_0, lat_1, lon_1)
+        url_params = {
+                    'numPage' : page_num,
+                    'k' : self.user_id,
+                    't' : self.t_param,
+                    }
+        form_params = {
+                u"shape":        shape,
+                u"propertyType": self.property_type,
+                u"locale":       self.locale,
+                u"maxItems":     self.page_size,
+                u"numPage":      page_num,
+                u"operation":    self.operation,
+                      }
+        return url, url_params, form_params
+
+    def _parse_pins_page(self, text_response):
+        """
+            Returns the ([(propertyCode, lat, lon), ...], totalPages) of a
+            map pins page, read from the json without building any model.
+        """
+        if text_response is None:
             return None
-        except Exception as es:
-            self.log.exception('IDEALISTA API # Unexpected exception')
+        try:
+            with timed(self.metrics, 'idealista/map', 'decode'):
+                json_response = json.loads(text_response)
+            pins = [(element['propertyCode'], element['latitude'],
+                     element['longitude'])
+                    for element in json_response.get('elementList') or ()]
+            return pins, json_response['totalPages']
+        except Exception as ex:
+            self.log.exception('Error parsing pins %s', str(text_response))
             return None
-        return res.text
 
-    def search_by_location(self, location_name, save_to_file=None, page=1):
+    def _count_request(self, lat_0, lon_0, lat_1, lon_1):
+        """
+            returns the (url, url_params, form_params) of the zero items
+            search the app makes to fetch the number of items in the
+            bounding box
+        """
+        url = self.URL_SEARCH
+        shape = self._create_shape(lat_0, lon_0, lat_1, lon_1)
+        url_params = {
+                    'numPage' : 0,
+                    'k' : self.user_id,
+                    't' : self.t_param,
+                    }
+        form_params = {
+            u"shape": shape,
+            u"propertyType": self.property_type,
+            u"locale":       self.lang,
+            u"maxItems":     0,
+            u"numPage":      0,
+            u"country":      "es",
+            u"operation":    self.operation,
+            u"distance":     0,
+        }
+        return url, url_params, form_params
+
+    def _location_request(self, location_name, page=1):
+        """ returns the (url, url_params, form_params) of a location search """
         url = self.URL_SEARCH
         url_params = {
                     'numPage' : page,
@@ -401,7 +548,6 @@ class IdealistaAPI(object):
                     't' : self._t_param(),
                     }
         form_params = {
-                u"shape":        shape,
                 u"order":        u"distance",
                 u"mPolygons":    u"[com.idealista.android.domain.model.polygon.Polygon@d58f746]",
                 u"propertyType": u"premises",
@@ -409,7 +555,7 @@ class IdealistaAPI(object):
                 u"isPoi":        u"true",
                 u"maxItems":     self.page_size,
                 u"locationName": location_name,
-                u"numPage":      1,
+                u"numPage":      page,
                 u"operation":    self.operation,
                 u"distance":     2000,
                 u"sort":         u"asc",
@@ -418,26 +564,460 @@ class IdealistaAPI(object):
                 u"gallery":      u"true",
                 u"quality":      u"high",
                       }
-        headers = self._common_headers(self._token_auth())
-        res = requests.post(url, params=url_params, data=form_params,
-                            headers=headers)
-        if save_to_file:
-            output_file = '{}_{}'.format(save_to_file,
-                                         datetime.now().strftime('%m%d_%H%M'))
-            with io.open(output_file, 'w', encoding='utf-8') as of:
-                of.write(res.text)
+        return url, url_params, form_params
+
+    def _detail_request(self, property_id):
+        """ returns the (url, url_params) of a property detail request """
+        url = self.URL_DETAIL.format(property_id=property_id)
+        url_params = {
+                    'language' : self.lang,
+                    'k' : self.user_id,
+                    't' : self.t_param,
+                    }
+        return url, url_params
+
+    def _parse_detail(self, text_response):
+        """
+            IdealistaPropertyDetail of a detail response, or None, also
+            for bodies without propertyCode / adid, like the error ones
+        """
+        if text_response is None:
+            return None
+        try:
+            with timed(self.metrics, 'idealista/detail', 'decode'):
+                json_response = json.loads(text_response)
+            if (not isinstance(json_response, dict) or
+                    (json_response.get('propertyCode') is None and
+                     json_response.get('adid') is None)):
+                self.log.warning('Not a detail response %s', str(text_response)[:200])
+                return None
+            with timed(self.metrics, 'idealista/detail', 'build'):
+                return IdealistaPropertyDetail(json_response)
+        except Exception as ex:
+            self.log.exception('Error parsing detail %s', str(text_response))
+            return None
+
+    def _parse_search_results(self, text_response):
+        if text_response is None:
+            return None
+        try:
+            json_response = self.decode_page(text_response)
+            with timed(self.metrics, 'idealista/search', 'build'):
+                return IdealistaSearchResults(json_response)
+        except Exception as ex:
+            self.log.exception('Error parsing result %s', str(text_response))
+            return None
+
+    def page_endpoint(self, kind):
+        """ metrics name of the 'bbox' or 'loc' search pages, both searches """
+        return 'idealista/search'
+
+    def decode_page(self, text_response, endpoint=None):
+        """ json of a search page response (pipeline decode stage) """
+        with timed(self.metrics, endpoint or self.page_endpoint('bbox'), 'decode'):
+            return json.loads(text_response)
+
+    def build_page(self, json_response, endpoint=None):
+        """ (element_list, totalPages) of a decoded page (pipeline build stage) """
+        with timed(self.metrics, endpoint or self.page_endpoint('bbox'), 'build'):
+            results = IdealistaSearchResults(json_response)
+        return results.element_list, results.totalPages
+
+    def build_page_columns(self, json_response, endpoint=None):
+        """ (ResultColumns, totalPages) of a decoded page """
+        with timed(self.metrics, endpoint or self.page_endpoint('bbox'), 'build'):
+            results = IdealistaSearchResults(json_response)
+            columns = results.to_columns()
+        return columns, results.totalPages
+
+    def _parse_search_page(self, text_response):
+        """ Returns the (element_list, totalPages) of a search page """
+        results = self._parse_search_results(text_response)
+        if results is None:
+            return None
+        return results.element_list, results.totalPages
+
+    def listing_key(self, element):
+        return element.propertyCode
+
+    def listing_coords(self, element):
+        return element.latitude, element.longitude
+
+    def listing_features(self, element):
+        """ (price, size, rooms) """
+        return element.price, element.size, element.rooms
+
+    def listing_fingerprint(self, element):
+        """ changes when the price, size or number of photos change """
+        return fingerprint(element.price, element.size, element.numPhotos)
+
+    def listing_image_urls(self, element, size=None):
+        """
+            Image urls of a listing (or property detail): the multimedia
+            images, or the thumbnail when there are none. size is the url
+            variant (IMAGE_LISTING, IMAGE_DETAIL, see the notes about
+            images on top), None keeps the urls as they come.
+        """
+        multimedia = getattr(element, 'multimedia', None)
+        urls = [image.url for image in multimedia.images] if multimedia else []
+        if not urls:
+            thumbnail = getattr(element, 'thumbnail', None)
+            if thumbnail:
+                urls.append(thumbnail)
+        if size is not None:
+            urls = [_IMAGE_VARIANT.sub(u'/blur/{}/'.format(size), url, count=1)
+                    for url in urls]
+        return urls
+
+    def _save_result(self, save_to_file, text):
+        output_file = '{}_{}'.format(save_to_file,
+                                     datetime.now().strftime('%m%d_%H%M'))
+        with io.open(output_file, 'w', encoding='utf-8') as of:
+            of.write(text)
+
+
+class IdealistaAPI(BaseIdealistaAPI, PooledSessionMixin):
+
+    def __init__(self, locale='en',
+                       user_id='5b85c03c16bbb85d96e232b112ee85dc', # this is hardcoded in the app
+                       property_type=u'homes',
+                       operation=u'rent',
+                       log=idealista_log,
+                       page_size=50,
+                       req_timeout=10.0,
+                       session=None,
+                       pool_connections=DEFAULT_POOL_CONNECTIONS,
+                       pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                       pool_block=False,
+                       keep_alive=True,
+                       token_manager=None,
+                       cache=None,
+                       rate_limiter=None,
+                       retry_policy=None,
+                       metrics=None,
+                       base_url=None,
+                       detail_cache=None):
+        super(IdealistaAPI, self).__init__(locale=locale,
+                                           user_id=user_id,
+                                           property_type=property_type,
+                                           operation=operation,
+                                           log=log,
+                                           page_size=page_size,
+                                           req_timeout=req_timeout,
+                                           base_url=base_url)
+        self._init_session(session=session,
+                           pool_connections=pool_connections,
+                           pool_maxsize=pool_maxsize,
+                           pool_block=pool_block,
+                           keep_alive=keep_alive)
+        self.token_manager = token_manager
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.metrics = metrics
+        self.detail_cache = detail_cache
+        self.last_error = None
+
+    def authorize(self):
+        """
+            Requests a new token, returns the response text or None. It goes
+            through the rate limiter and the retry policy like the searches.
+        """
+        oauth_token_url, headers, data_payload = self._authorize_request()
+        try:
+            res = self._post(oauth_token_url, None, data_payload, headers=headers)
+            if res.status_code != 200:
+                self.log.warning('IDEALISTA Auth # %s answered %d',
+                                 str(oauth_token_url), res.status_code)
+            token_body = res.text
+            return token_body
+        except requests.ConnectionError as conn_err:
+            self._request_failed(oauth_token_url, conn_err)
+            self.log.exception('IDEALISTA Auth # Connection Error url:%s payload:%s',
+                                str(oauth_token_url), str(data_payload))
+            return None
+        except requests.Timeout as tout:
+            self._request_failed(oauth_token_url, tout)
+            self.log.exception('IDEALISTA Auth # Request timeout url:%s payload:%s',
+                                str(oauth_token_url), str(data_payload))
+            return None
+        except requests.exceptions.RequestException as req_ex:
+            self._request_failed(oauth_token_url, req_ex)
+            self.log.exception('IDEALISTA Auth # Request exception url:%s payload:%s',
+                                str(oauth_token_url), str(data_payload))
+            return None
+        except Exception as es:
+            self._request_failed(oauth_token_url, es)
+            self.log.exception('IDEALISTA Auth # Unexpected exception')
+            return None
+
+    def get_detail(self, property_id):
+        """
+            IdealistaPropertyDetail of a property, or None. Responses are
+            kept in the detail_cache (or else the cache), and requested
+            again once they expire.
+        """
+        url, url_params = self._detail_request(property_id)
+        return self._parse_detail(self._search_post(url, url_params, None,
+                                                    cache=self.detail_cache,
+                                                    ok_only=True))
+
+    def get_details(self, property_ids, workers=DEFAULT_WORKERS):
+        """
+            Yields the (property_id, IdealistaPropertyDetail or None) of
+            every id as they complete, with `workers` concurrent requests.
+            Ids with a fresh cached detail are answered without a request.
+        """
+        return iter_completed(self.get_detail, property_ids, workers=workers)
+
+    def ensure_authorization(self, rejected_token=None):
+        """
+            Takes a valid access token from the token manager, which
+            refreshes it when it is about to expire or was rejected.
+        """
+        token = self.token_manager.get_token(self, rejected_token=rejected_token)
+        if token is None:
+            return False
+        self.access_token = token
+        return True
+
+    def _authorized_post(self, url, url_params, form_params):
+        """
+            Performs a search request. With a token manager, the token is
+            refreshed before it expires, and a request answered with a 401
+            is replayed once with a new token. None when the token manager
+            has no token, leaving the error in last_error.
+        """
+        if self.token_manager is not None and not self.ensure_authorization():
+            self._request_failed(url, IdealistaAuthorizationError(
+                'no access token for {}'.format(url)))
+            self.log.error('IDEALISTA API # Authorization failed, not sending %s',
+                           str(url))
+            return None
+        start_time = time.time()
+        res = self._post(url, url_params, form_params)
+        end_time = time.time()
+        self.last_req_time = end_time - start_time
+        if res.status_code == 401 and self.token_manager is not None:
+            self.log.warning('IDEALISTA API # Token rejected, refreshing it')
+            if self.ensure_authorization(rejected_token=self.access_token):
+                res = self._post(url, url_params, form_params)
+        return res
+
+    def _post(self, url, url_params, form_params, headers=None):
+        """
+            posts the request, through the retry policy when there is one.
+            Without headers, the ones of the searches are used.
+        """
+        if self.retry_policy is None:
+            return self._limited_post(url, url_params, form_params, headers)
+
+        def attempt(n):
+            # the headers are built on every attempt, with the current token
+            return self._limited_post(url, url_params, form_params, headers)
+        return self.retry_policy.call(attempt, log=self.log)
+
+    def _limited_post(self, url, url_params, form_params, headers=None):
+        """ a GET when there are no form_params (the detail requests) """
+        if headers is None:
+            headers = self._common_headers(self._token_auth())
+        start_time = time.perf_counter()
+        with limited(self.rate_limiter) as slot:
+            if form_params is None:
+                res = self.session.get(url, params=url_params, headers=headers,
+                                       timeout=self.req_timeout)
+            else:
+                res = self.session.post(url, params=url_params, data=form_params,
+                                        headers=headers, timeout=self.req_timeout)
+            slot.record_status(res.status_code)
+        self._record_response(url, start_time, res)
+        return res
+
+    def _record_response(self, url, start_time, res):
+        if self.metrics is not None:
+            self.metrics.record_request(self._endpoint_name(url),
+                                        time.perf_counter() - start_time,
+                                        len(res.content), res.status_code)
+
+    def _request_failed(self, url, error):
+        self.last_error = error
+        if self.metrics is not None:
+            self.metrics.record_error(self._endpoint_name(url),
+                                      type(error).__name__)
+
+    def _search_post(self, url, url_params, form_params, cache=None,
+                     ok_only=False):
+        """
+            Search request returning the response text, or None on errors,
+            leaving the exception in last_error. With a cache
+            (pyappapi.cache, the client one unless another is given),
+            responses to the same search (the `t` param aside) are reused.
+            With ok_only, responses other than a 200 are errors too.
+        """
+        self.last_error = None
+        cache = self.cache if cache is None else cache
+        key = None
+        if cache is not None:
+            key = cache_key(url, params=url_params, payload=form_params)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+        try:
+            res = self._authorized_post(url, url_params, form_params)
+            if res is None:
+                return None
+        except requests.ConnectionError as conn_err:
+            self._request_failed(url, conn_err)
+            self.log.exception('IDEALISTA API # Connection Error url:%s payload:%s',
+                                str(url), str(form_params))
+            return None
+        except requests.Timeout as tout:
+            self._request_failed(url, tout)
+            self.log.exception('IDEALISTA API # Request timeout url:%s payload:%s',
+                                str(url), str(form_params))
+            return None
+        except requests.exceptions.RequestException as req_ex:
+            self._request_failed(url, req_ex)
+            self.log.exception('IDEALISTA API # Request exception url:%s payload:%s',
+                                str(url), str(form_params))
+            return None
+        except Exception as es:
+            self._request_failed(url, es)
+            self.log.exception('IDEALISTA API # Unexpected exception')
+            return None
+        if ok_only and res.status_code != 200:
+            self.last_error = requests.HTTPError(
+                '{} answered {}'.format(url, res.status_code), response=res)
+            self.log.warning('IDEALISTA API # %s answered %d', str(url),
+                             res.status_code)
+            return None
+        if key is not None and res.status_code == 200:
+            cache.set(key, res.text)
         return res.text
 
+    def search_by_bounding_box(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+        return self._search_post(*self._bounding_box_request(lat_0, lon_0,
+                                                             lat_1, lon_1,
+                                                             page_num=page_num))
+
+    def bounding_box_page_text(self, lat_0, lon_0, lat_1, lon_1, page_num=1):
+        """ undecoded response of a bounding box page, for pyappapi.pipeline """
+        return self.search_by_bounding_box(lat_0, lon_0, lat_1, lon_1,
+                                           page_num=page_num)
+
+    def count_bounding_box(self, lat_0, lon_0, lat_1, lon_1):
+        """ number of items in the bounding box, using a zero items search """
+        results = self._parse_search_results(
+            self._search_post(*self._count_request(lat_0, lon_0, lat_1, lon_1)))
+        if results is None:
+            return None
+        return results.total
+
+    def probe_bounding_box(self, lat_0, lon_0, lat_1, lon_1, count_only=False):
+        """
+            Returns the (count, first_page) of a bounding box, where
+            first_page is the parsed (element_list, totalPages) of page 1,
+            so it does not need to be requested again. With count_only the
+            cheaper zero items search is used, and first_page is None.
+        """
+        if count_only:
+            count = self.count_bounding_box(lat_0, lon_0, lat_1, lon_1)
+            if count is None:
+                return None
+            return count, None
+        results = self._parse_search_results(
+            self.search_by_bounding_box(lat_0, lon_0, lat_1, lon_1, page_num=1))
+        if results is None:
+            return None
+        count = results.total
+        if count is None:
+            count = len(results.element_list)
+        return count, (results.element_list, results.totalPages)
+
+    def iter_bounding_box(self, lat_0, lon_0, lat_1, lon_1,
+                          prefetch=DEFAULT_PREFETCH, max_pages=None,
+                          first_page=None, report=None):
+        """
+            Yields every IdealistaSearchResultElement in the bounding box,
+            going through all the result pages (up to totalPages). Up to
+            `prefetch` pages are requested in background while the current
+            one is consumed. first_page is an already parsed page 1, as
+            returned by probe_bounding_box, and report an optional
+            pyappapi.prefetch.PageReport.
+        """
+        def fetch_page(page_num):
+            return self.search_by_bounding_box(lat_0, lon_0, lat_1, lon_1,
+                                               page_num=page_num)
+        return iter_prefetched_pages(fetch_page,
+                                     self._parse_search_page,
+                                     prefetch=prefetch,
+                                     max_pages=max_pages,
+                                     first_page=first_page,
+                                     report=report)
+
+    def iter_bounding_box_pins(self, lat_0, lon_0, lat_1, lon_1,
+                               prefetch=DEFAULT_PREFETCH, max_pages=None,
+                               report=None):
+        """
+            Yields the (propertyCode, lat, lon) of every property in the
+            bounding box, from the map search, which leaves out the rest of
+            the listing data. Pages like iter_bounding_box.
+        """
+        def fetch_page(page_num):
+            return self._search_post(*self._pins_request(lat_0, lon_0,
+                                                         lat_1, lon_1,
+                                                         page_num=page_num))
+        return iter_prefetched_pages(fetch_page,
+                                     self._parse_pins_page,
+                                     prefetch=prefetch,
+                                     max_pages=max_pages,
+                                     report=report)
+
+    def iter_location(self, location_name, prefetch=DEFAULT_PREFETCH,
+                      max_pages=None, report=None):
+        """
+            Yields every IdealistaSearchResultElement of a location search,
+            going through all the result pages, like iter_bounding_box.
+        """
+        def fetch_page(page_num):
+            return self.search_by_location(location_name, page=page_num)
+        return iter_prefetched_pages(fetch_page,
+                                     self._parse_search_page,
+                                     prefetch=prefetch,
+                                     max_pages=max_pages,
+                                     report=report)
+
+    def location_page_fetcher(self, location_name):
+        """
+            The page_num -> undecoded response function of a location
+            search, for pyappapi.pipeline.
+        """
+        def fetch_page(page_num):
+            return self.search_by_location(location_name, page=page_num)
+        return fetch_page
+
+    def search_by_location(self, location_name, save_to_file=None, page=1):
+        url, url_params, form_params = self._location_request(location_name,
+                                                              page=page)
+        text = self._search_post(url, url_params, form_params)
+        if save_to_file and text is not None:
+            self._save_result(save_to_file, text)
+        return text
+
 
 class IdealistaLocalStorage(object):
-    def __init__(self, storage_dir=".", log=idealista_log):
+    def __init__(self, storage_dir=".", log=idealista_log,
+                 token_file="oauth_token.json"):
         self.log = log
         self.storage_dir = storage_dir
-        self.token_file = "oauth_token.json"
+        self.token_file = token_file
+
+    def _token_path(self):
+        return os.path.join(self.storage_dir, self.token_file)
 
     def load_token(self):
         try:
-            fullpath_file = os.path.join(self.storage_dir, self.token_file)
+            fullpath_file = self._token_path()
             with open(fullpath_file, 'r') as tsf:
                 res = tsf.read()
             return res
@@ -446,17 +1026,61 @@ class IdealistaLocalStorage(object):
 
     def token_date(self):
         try:
-            fullpath_file = os.path.join(self.storage_dir, self.token_file)
+            fullpath_file = self._token_path()
             fstat = os.stat(fullpath_file)
             dt = datetime.utcfromtimestamp(fstat.st_ctime)
             return dt
         except Exception as ex:
             return None
 
+    def token_expiry(self):
+        """
+            Epoch time when the stored token expires, from the expires_at
+            added by store_token, or the file mtime plus expires_in for
+            tokens stored as they came. None when it is unknown.
+        """
+        try:
+            oauth_response = json.loads(self.load_token())
+            if 'expires_at' in oauth_response:
+                return float(oauth_response['expires_at'])
+            if 'expires_in' in oauth_response:
+                fstat = os.stat(self._token_path())
+                return fstat.st_mtime + float(oauth_response['expires_in'])
+        except Exception as ex:
+            pass
+        return None
+
     def store_token(self, json_token_response):
-        fullpath_file = os.path.join(self.storage_dir, self.token_file)
-        with open(fullpath_file, 'w') as tsf:
+        """
+            Stores the token response, adding its expires_at. The file is
+            replaced atomically, so other processes never read it half
+            written.
+        """
+        try:
+            oauth_response = json.loads(json_token_response)
+            if 'expires_in' in oauth_response:
+                oauth_response['expires_at'] = time.time() + float(oauth_response['expires_in'])
+                json_token_response = json.dumps(oauth_response)
+        except Exception as ex:
+            self.log.warning('Storing a token response that is not json')
+        fullpath_file = self._token_path()
+        tmp_file = '{}.{}.tmp'.format(fullpath_file, os.getpid())
+        with open(tmp_file, 'w') as tsf:
             tsf.write(json_token_response)
+        os.replace(tmp_file, fullpath_file)
+
+    @contextmanager
+    def token_lock(self):
+        """ exclusive lock on the token file, shared by all processes """
+        if fcntl is None:
+            yield
+            return
+        with open(self._token_path() + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
     def load_stored_result(self, filename):
         fullpath_file = os.path.join(self.storage_dir, filename)
@@ -474,3 +1098,86 @@ class IdealistaLocalStorage(object):
         fullpath_file = os.path.join(self.storage_dir, filename)
         with open(fullpath_file, 'w') as tsf:
             tsf.write(result)
+
+
+class IdealistaTokenManager(object):
+    """
+        Keeps a valid OAuth token, shared by all the clients of a process
+        and by all the processes using the same token file.
+
+        The token is refreshed `refresh_margin` seconds before its
+        expires_in runs out. Refreshing happens under an exclusive file
+        lock, and the token file is read again once the lock is taken, so
+        when many workers start at once only the first one authorizes, and
+        the others pick up its token.
+
+            manager = IdealistaTokenManager(IdealistaLocalStorage('/var/tmp'))
+            iapi = IdealistaAPI(token_manager=manager)
+    """
+
+    def __init__(self, storage=None, refresh_margin=DEFAULT_REFRESH_MARGIN,
+                 log=idealista_log):
+        if storage is None:
+            storage = IdealistaLocalStorage(log=log)
+        self.storage = storage
+        self.refresh_margin = refresh_margin
+        self.log = log
+        self.access_token = None
+        self.expires_at = None
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, expires_at):
+        if expires_at is None:
+            # unknown expiry, it is used until the api rejects it
+            return True
+        return time.time() < expires_at - self.refresh_margin
+
+    def valid(self):
+        return self.access_token is not None and self._is_fresh(self.expires_at)
+
+    def _load_stored(self, rejected_token):
+        stored = self.storage.load_token()
+        if not stored:
+            return False
+        try:
+            token = json.loads(stored)['access_token']
+        except Exception as ex:
+            self.log.warning('Can not read the stored token')
+            return False
+        expires_at = self.storage.token_expiry()
+        if token == rejected_token or not self._is_fresh(expires_at):
+            return False
+        self.access_token = token
+        self.expires_at = expires_at
+        return True
+
+    def get_token(self, api, rejected_token=None):
+        """
+            Returns a valid access token, authorizing through `api` when
+            neither this manager nor the token file have one. A token
+            rejected by the api is never returned again.
+        """
+        with self._lock:
+            if rejected_token is None and self.valid():
+                return self.access_token
+            if rejected_token is not None and self.access_token != rejected_token \
+                    and self.valid():
+                # another thread already refreshed it
+                return self.access_token
+            with self.storage.token_lock():
+                if self._load_stored(rejected_token):
+                    return self.access_token
+                self.log.info('Requesting a new idealista token')
+                token_response = api.authorize()
+                if not token_response:
+                    return None
+                try:
+                    oauth_response = json.loads(token_response)
+                    token = oauth_response['access_token']
+                except Exception as ex:
+                    self.log.exception('Can not load access token')
+                    return None
+                self.storage.store_token(token_response)
+                self.access_token = token
+                self.expires_at = self.storage.token_expiry()
+                return self.access_token
@@ -0,0 +1 @@
+""" Helpers shared by the fotocasa and idealista clients """
@@ -0,0 +1,56 @@
+# -*- encoding: utf8 -*-
+import asyncio
+
+import aiohttp
+
+DEFAULT_MAX_CONCURRENCY = 100
+DEFAULT_CONNECTION_LIMIT = 100
+
+
+class AsyncSessionMixin(object):
+    """
+        asyncio counterpart of PooledSessionMixin: gives an async API client
+        its own aiohttp session and a semaphore that bounds the number of
+        requests in flight.
+
+        The aiohttp session is created on first use, so the client can be
+        built outside of a running event loop.
+    """
+
+    def _init_async_session(self, session=None,
+                            max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                            limit=DEFAULT_CONNECTION_LIMIT,
+                            limit_per_host=0,
+                            keep_alive=True):
+        self._owns_session = session is None
+        self._session = session
+        self._connector_options = {
+            'limit': limit,
+            'limit_per_host': limit_per_host,
+            'force_close': not keep_alive,
+        }
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(**self._connector_options)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._owns_session = True
+        return self._session
+
+    def _client_timeout(self):
+        return aiohttp.ClientTimeout(total=self.req_timeout)
+
+    async def close(self):
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
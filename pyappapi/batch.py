@@ -0,0 +1,157 @@
+# -*- encoding: utf8 -*-
+import json
+import logging
+import threading
+import time
+
+from pyappapi.pipeline import ListingPipeline, NDJSONSink
+
+batch_log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_FETCH_WORKERS = 2
+
+JOB_OK = 'ok'
+JOB_INCOMPLETE = 'incomplete'
+JOB_FAILED = 'failed'
+JOB_INVALID = 'invalid'
+
+
+class BatchJob(object):
+    """ a bbox or loc query of a job list, numbered by its line """
+    __slots__ = ('number', 'line', 'kind', 'args')
+
+    def __init__(self, number, line, kind, args):
+        self.number = number
+        self.line = line
+        self.kind = kind
+        self.args = args
+
+
+def parse_job(number, line):
+    """
+        A job line is written like the single query commands:
+
+            bbox <min_lat> <min_lon> <max_lat> <max_lon>
+            loc <location_name>
+
+        Raises ValueError on anything else.
+    """
+    parts = line.split(None, 1)
+    kind = parts[0] if parts else ''
+    rest = parts[1].strip() if len(parts) > 1 else ''
+    if kind == 'bbox':
+        coords = rest.split()
+        if len(coords) != 4:
+            raise ValueError('bbox needs 4 coordinates')
+        return BatchJob(number, line, kind, [float(coord) for coord in coords])
+    if kind == 'loc':
+        if not rest:
+            raise ValueError('loc needs a location name')
+        return BatchJob(number, line, kind, [rest])
+    raise ValueError('unknown job {!r}'.format(kind))
+
+
+def job_lines(lines):
+    """ (number, line) of the job lines, without blank lines and # comments """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield number, line
+
+
+class BatchRunner(object):
+    """
+        Runs a list of bbox / loc jobs with one client, `workers` jobs at
+        a time, streaming NDJSON to `output`: a line per listing (the
+        pyappapi.pipeline.NDJSONSink one, plus its "job" number) and a
+        status line per job once it ends:
+
+            {"type": "status", "job": 3, "query": "loc Gracia",
+             "status": "ok", "listings": 412, "pages": 12,
+             "total_pages": 12, "seconds": 1.9}
+
+        The status is ok when every page was read, incomplete when some
+        failed, failed when none did (or the location was not found) and
+        invalid for lines that are not a job. Jobs are read from `lines`
+        as workers get free, so a job list can be streamed from stdin.
+    """
+
+    def __init__(self, client, output, workers=DEFAULT_WORKERS,
+                 fetch_workers=DEFAULT_FETCH_WORKERS, max_pages=None,
+                 log=batch_log):
+        self.client = client
+        self.output = output
+        self.workers = max(1, workers)
+        self.fetch_workers = fetch_workers
+        self.max_pages = max_pages
+        self.log = log
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def _status(self, job_number, query, status, **fields):
+        record = {'type': 'status', 'job': job_number, 'query': query,
+                  'status': status}
+        record.update(fields)
+        with self._lock:
+            self.output.write(json.dumps(record) + '\n')
+            self.output.flush()
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def run_job(self, job):
+        sink = NDJSONSink(self.output, extra={'type': 'listing',
+                                              'job': job.number},
+                          lock=self._lock)
+        pipeline = ListingPipeline(self.client, sink,
+                                   fetch_workers=self.fetch_workers,
+                                   max_pages=self.max_pages, log=self.log)
+        start_time = time.time()
+        error = None
+        try:
+            if job.kind == 'bbox':
+                report = pipeline.run_bounding_box(*job.args)
+            else:
+                report = pipeline.run_location(job.args[0])
+        except Exception as ex:
+            self.log.exception('Job %d failed: %s', job.number, job.line)
+            report = None
+            error = '{}: {}'.format(type(ex).__name__, ex)
+        if report is not None and report.complete:
+            status = JOB_OK
+        elif report is not None and report.pages > 0:
+            status = JOB_INCOMPLETE
+        else:
+            status = JOB_FAILED
+        self._status(job.number, job.line, status,
+                     listings=pipeline.stats.get('listings', 0),
+                     pages=report.pages if report is not None else 0,
+                     total_pages=report.total_pages if report is not None else None,
+                     seconds=round(time.time() - start_time, 3),
+                     error=error)
+
+    def run(self, lines):
+        """ runs every job of the lines, returns the job counts by status """
+        jobs = job_lines(lines)
+        next_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with next_lock:
+                    item = next(jobs, None)
+                if item is None:
+                    return
+                number, line = item
+                try:
+                    job = parse_job(number, line)
+                except ValueError as ve:
+                    self._status(number, line, JOB_INVALID, error=str(ve))
+                    continue
+                self.run_job(job)
+
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return dict(self.counts)
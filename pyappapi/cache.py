@@ -0,0 +1,162 @@
+# -*- encoding: utf8 -*-
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+cache_log = logging.getLogger(__name__)
+
+# request fields that change on every request without changing the response:
+# the fotocasa time based signature and the idealista terminal `t` param
+VOLATILE_FIELDS = frozenset(['signature', 't'])
+DEFAULT_TTL = 300.0
+DEFAULT_MAX_ENTRIES = 1024
+
+
+def cache_key(url, params=None, payload=None, ignore=VOLATILE_FIELDS):
+    """
+        Key of a request, from its url, url params and payload, leaving
+        out the `ignore` fields. Headers (like the random user agent) are
+        never part of the key.
+    """
+    def normalize(fields):
+        if not fields:
+            return {}
+        return dict((str(k), str(v)) for k, v in fields.items()
+                    if k not in ignore)
+    key = json.dumps([url, normalize(params), normalize(payload)],
+                     sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class ResponseCache(object):
+    """
+        Base of the response caches: raw response texts by request key,
+        expiring `ttl` seconds after being stored, and evicting the least
+        recently used entries beyond `max_entries`.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / float(lookups) if lookups else 0.0,
+            'expirations': self.expirations,
+            'evictions': self.evictions,
+            'entries': len(self),
+            'max_entries': self.max_entries,
+        }
+
+    def get(self, key):
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value, time.time())
+
+
+class MemoryCache(ResponseCache):
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        super(MemoryCache, self).__init__(ttl=ttl, max_entries=max_entries)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if now - stored_at > self.ttl:
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, now):
+        self._entries[key] = (now, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache(ResponseCache):
+    """ sqlite backed cache, that survives between runs """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        super(DiskCache, self).__init__(ttl=ttl, max_entries=max_entries)
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         ' key TEXT PRIMARY KEY,'
+                         ' value TEXT NOT NULL,'
+                         ' stored_at REAL NOT NULL,'
+                         ' accessed_at REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at'
+                         ' ON responses (accessed_at)')
+        self._db.commit()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def _get(self, key, now):
+        row = self._db.execute('SELECT value, stored_at FROM responses WHERE key = ?',
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        value, stored_at = row
+        if now - stored_at > self.ttl:
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self._db.commit()
+            self.expirations += 1
+            return None
+        self._db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?',
+                         (now, key))
+        self._db.commit()
+        return value
+
+    def _set(self, key, value, now):
+        self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                         (key, value, now, now))
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self._db.execute('DELETE FROM responses WHERE key IN ('
+                             ' SELECT key FROM responses'
+                             ' ORDER BY accessed_at LIMIT ?)', (excess,))
+            self.evictions += excess
+        self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,126 @@
+# -*- encoding: utf8 -*-
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MISSING_INT = -1
+
+
+class DictionaryColumn(object):
+    """
+        Dictionary encoded string column: an array('i') of codes into the
+        list of distinct values.
+    """
+    __slots__ = ('codes', 'values', '_index')
+
+    def __init__(self):
+        self.codes = array('i')
+        self.values = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _code(self, value):
+        code = self._index.get(value)
+        if code is None:
+            code = len(self.values)
+            self._index[value] = code
+            self.values.append(value)
+        return code
+
+    def append(self, value):
+        self.codes.append(self._code(value))
+
+    def extend(self, other):
+        """ appends another column, only its distinct values are remapped """
+        remap = array('i', [self._code(value) for value in other.values])
+        if list(remap) == list(range(len(other.values))):
+            self.codes.extend(other.codes)
+        else:
+            self.codes.extend(array('i', [remap[code] for code in other.codes]))
+
+    def __getitem__(self, index):
+        return self.values[self.codes[index]]
+
+    def to_list(self):
+        values = self.values
+        return [values[code] for code in self.codes]
+
+
+class ResultColumns(object):
+    """
+        Typed contiguous columns of a batch of listings, for analytics:
+
+        - array('d'): latitude, longitude, price, size (nan when missing)
+        - array('q'): rooms, bathrooms (-1 when missing)
+        - DictionaryColumn: province, municipality, operation
+        - ids: list with the listing ids
+
+        Batches of many pages are joined with extend() or concat(), and
+        to_numpy() exposes the arrays to numpy without copying them.
+    """
+    FLOAT_COLUMNS = ('latitude', 'longitude', 'price', 'size')
+    INT_COLUMNS = ('rooms', 'bathrooms')
+    STR_COLUMNS = ('province', 'municipality', 'operation')
+
+    def __init__(self):
+        self.ids = []
+        for name in self.FLOAT_COLUMNS:
+            setattr(self, name, array('d'))
+        for name in self.INT_COLUMNS:
+            setattr(self, name, array('q'))
+        for name in self.STR_COLUMNS:
+            setattr(self, name, DictionaryColumn())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, listing_id, latitude, longitude, price, size, rooms,
+               bathrooms, province, municipality, operation):
+        nan = float('nan')
+        self.ids.append(listing_id)
+        self.latitude.append(nan if latitude is None else float(latitude))
+        self.longitude.append(nan if longitude is None else float(longitude))
+        self.price.append(nan if price is None else float(price))
+        self.size.append(nan if size is None else float(size))
+        self.rooms.append(MISSING_INT if rooms is None else int(rooms))
+        self.bathrooms.append(MISSING_INT if bathrooms is None else int(bathrooms))
+        self.province.append(province or u'')
+        self.municipality.append(municipality or u'')
+        self.operation.append(operation or u'')
+
+    def extend(self, other):
+        self.ids.extend(other.ids)
+        for name in self.FLOAT_COLUMNS + self.INT_COLUMNS + self.STR_COLUMNS:
+            getattr(self, name).extend(getattr(other, name))
+        return self
+
+    @classmethod
+    def concat(cls, batches):
+        res = cls()
+        for batch in batches:
+            res.extend(batch)
+        return res
+
+    def to_numpy(self):
+        """
+            dict of numpy arrays sharing the memory of the columns (so the
+            batch must not grow while they are in use). String columns
+            come as a (codes, values) tuple.
+        """
+        if numpy is None:
+            raise ImportError('numpy is required for to_numpy()')
+        res = {'ids': self.ids}
+        for name in self.FLOAT_COLUMNS:
+            res[name] = numpy.frombuffer(getattr(self, name), dtype=numpy.float64)
+        for name in self.INT_COLUMNS:
+            res[name] = numpy.frombuffer(getattr(self, name), dtype=numpy.int64)
+        for name in self.STR_COLUMNS:
+            column = getattr(self, name)
+            res[name] = (numpy.frombuffer(column.codes, dtype=numpy.int32),
+                         column.values)
+        return res
@@ -0,0 +1,219 @@
+# -*- encoding: utf8 -*-
+import logging
+import math
+
+dedup_log = logging.getLogger(__name__)
+
+# meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+DEFAULT_MAX_DISTANCE = 75.0
+DEFAULT_PRICE_TOLERANCE = 0.05
+DEFAULT_SIZE_TOLERANCE = 0.1
+DEFAULT_THRESHOLD = 0.7
+
+
+class UnionFind(object):
+    """ disjoint sets of integer ids, with path halving and union by size """
+
+    def __init__(self):
+        self.parent = []
+        self.size = []
+
+    def add(self):
+        self.parent.append(len(self.parent))
+        self.size.append(1)
+        return len(self.parent) - 1
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return root_a
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+        return root_a
+
+
+def _bucket(value, tolerance):
+    """
+        log scale bucket: values within tolerance fall in the same or the
+        next. Tolerance is relative to the larger value (as in score), so
+        the ratio of two such values is up to 1 / (1 - tolerance), which is
+        the width of the buckets.
+    """
+    if not value or value <= 0:
+        return None
+    return int(math.floor(math.log(value) / -math.log1p(-tolerance)))
+
+
+class DuplicateMatcher(object):
+    """
+        Finds the same property listed several times, across providers.
+
+        Listings are blocked by a spatial hash of cells of about
+        `max_distance` meters, and by log scale price buckets (so only
+        prices within `price_tolerance` are compared). Each new listing is
+        only scored against the listings of its neighbour cells and price
+        buckets, which keeps the whole run near linear; a listing without
+        price is compared with every bucket of its neighbour cells, and
+        listings without price with every new one. The score mixes
+        distance, price and size closeness, and rules out different known
+        numbers of rooms; pairs over `threshold` are joined in a
+        union-find, whose sets are the clusters. Listings can be added as
+        they are streamed:
+
+            matcher = DuplicateMatcher()
+            for listing in fapi.iter_bounding_box(*bbox):
+                matcher.add_listing(fapi, listing)
+            for element in iapi.iter_bounding_box(*bbox):
+                matcher.add_listing(iapi, element)
+            for cluster in matcher.clusters():
+                print(cluster)     # [('fotocasa', 123), ('idealista', '456')]
+
+        With cross_provider (the default) listings of the same provider
+        are never matched between them.
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE,
+                 price_tolerance=DEFAULT_PRICE_TOLERANCE,
+                 size_tolerance=DEFAULT_SIZE_TOLERANCE,
+                 threshold=DEFAULT_THRESHOLD, cross_provider=True,
+                 log=dedup_log):
+        self.max_distance = max_distance
+        self.price_tolerance = price_tolerance
+        self.size_tolerance = size_tolerance
+        self.threshold = threshold
+        self.cross_provider = cross_provider
+        self.log = log
+        self.cell_size = max_distance / METERS_PER_DEGREE
+        # (provider, key, lat, lon, price, size, rooms) by record id
+        self.records = []
+        self.ids = {}
+        self.blocks = {}
+        self._widths = {}
+        self.sets = UnionFind()
+        self.comparisons = 0
+        self.matches = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def _column(self, row, lon):
+        """
+            column of a longitude in a row; columns are widened by the
+            latitude of the row border nearest to the pole, so that they
+            are at least max_distance wide
+        """
+        width = self._widths.get(row)
+        if width is None:
+            lat = max(abs(row), abs(row + 1)) * self.cell_size
+            width = self.cell_size / max(math.cos(math.radians(min(lat, 89.0))),
+                                         1e-6)
+            self._widths[row] = width
+        return int(math.floor(lon / width))
+
+    def _distance(self, lat_0, lon_0, lat_1, lon_1):
+        x = (lon_1 - lon_0) * math.cos(math.radians((lat_0 + lat_1) / 2.0))
+        y = lat_1 - lat_0
+        return math.sqrt(x * x + y * y) * METERS_PER_DEGREE
+
+    def score(self, record, other):
+        """ 0 for different properties, up to 1 for the same one """
+        distance = self._distance(record[2], record[3], other[2], other[3])
+        if distance > self.max_distance:
+            return 0.0
+        score = 0.4 * (1.0 - distance / self.max_distance)
+        price, other_price = record[4], other[4]
+        if price and other_price:
+            diff = abs(price - other_price) / max(price, other_price)
+            if diff > self.price_tolerance:
+                return 0.0
+            score += 0.3 * (1.0 - diff / self.price_tolerance)
+        rooms, other_rooms = record[6], other[6]
+        if rooms is not None and other_rooms is not None and rooms != other_rooms:
+            return 0.0
+        size, other_size = record[5], other[5]
+        if size and other_size:
+            diff = abs(size - other_size) / max(size, other_size)
+            if diff > self.size_tolerance:
+                return 0.0
+            score += 0.3 * (1.0 - diff / self.size_tolerance)
+        else:
+            # unknown size, the rest has to be very close
+            score += 0.15
+        return score
+
+    def add(self, provider, key, lat, lon, price=None, size=None, rooms=None):
+        """
+            Adds a listing and returns its [(provider, key, score)]
+            matches among the listings added before.
+        """
+        if (provider, key) in self.ids or lat is None or lon is None:
+            return []
+        record = (provider, key, lat, lon, price, size, rooms)
+        record_id = self.sets.add()
+        self.records.append(record)
+        self.ids[(provider, key)] = record_id
+        row = int(math.floor(lat / self.cell_size))
+        bucket = _bucket(price, self.price_tolerance)
+        matches = []
+        blocks = self.blocks
+        # the neighbour buckets hold every price within tolerance, and the
+        # None bucket the listings without price
+        near_buckets = None if bucket is None else (bucket - 1, bucket, bucket + 1, None)
+        for near_row in (row - 1, row, row + 1):
+            col = self._column(near_row, lon)
+            for near_col in (col - 1, col, col + 1):
+                cell = blocks.get((near_row, near_col))
+                if not cell:
+                    continue
+                if near_buckets is None:
+                    block_list = cell.values()
+                else:
+                    block_list = [cell[b] for b in near_buckets if b in cell]
+                for block in block_list:
+                    for other_id in block:
+                        other = self.records[other_id]
+                        if self.cross_provider and other[0] == provider:
+                            continue
+                        self.comparisons += 1
+                        score = self.score(record, other)
+                        if score >= self.threshold:
+                            self.sets.union(record_id, other_id)
+                            matches.append((other[0], other[1], score))
+        col = self._column(row, lon)
+        blocks.setdefault((row, col), {}).setdefault(bucket, []).append(record_id)
+        self.matches += len(matches)
+        return matches
+
+    def add_listing(self, client, listing):
+        """ adds a listing model, reading its fields with the client """
+        lat, lon = client.listing_coords(listing)
+        price, size, rooms = client.listing_features(listing)
+        return self.add(client.PROVIDER, client.listing_key(listing), lat, lon,
+                        price=price, size=size, rooms=rooms)
+
+    def cluster_of(self, provider, key):
+        """ the (provider, key) listings of the cluster of a listing """
+        record_id = self.ids.get((provider, key))
+        if record_id is None:
+            return []
+        root = self.sets.find(record_id)
+        return [record[:2] for i, record in enumerate(self.records)
+                if self.sets.find(i) == root]
+
+    def clusters(self, min_size=2):
+        """ lists of (provider, key), of the clusters of min_size or more """
+        groups = {}
+        for record_id, record in enumerate(self.records):
+            groups.setdefault(self.sets.find(record_id), []).append(record[:2])
+        return [group for group in groups.values() if len(group) >= min_size]
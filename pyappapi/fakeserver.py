@@ -0,0 +1,367 @@
+# -*- encoding: utf8 -*-
+""" Local fake Fotocasa and Idealista api server, for offline load tests
+
+Serves the Fotocasa v3 BoundingBoxSearchV2, Search, GetSuggest and
+GetProperty endpoints (BoundingBoxSearchV2 with disableClustering answers
+only the Id, X and Y), and the Idealista oauth token, search, map search and
+detail endpoints, with synthetic listings scattered over a bounding box.
+
+Usage:
+    fakeserver.py [--port=<n>] [--listings=<n>] [--seed=<n>]
+                  [--latency=<s>] [--jitter=<s>] [--error-rate=<r>]
+                  [--max-pages=<n>]
+
+Options:
+    --port=<n>          Port to listen on [default: 8000]
+    --listings=<n>      Number of listings [default: 20000]
+    --seed=<n>          Seed of the listings [default: 0]
+    --latency=<s>       Seconds added to every response [default: 0]
+    --jitter=<s>        Random seconds added on top of latency [default: 0]
+    --error-rate=<r>    Ratio of requests answered with a 503 [default: 0]
+    --max-pages=<n>     Last page served, later pages come empty
+"""
+import bisect
+import json
+import logging
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+from fotocasa.fotocasa import parse_price
+from pyappapi.synthetic import (DEFAULT_BOUNDING_BOX, fotocasa_data_layer,
+                                fotocasa_details, fotocasa_property,
+                                idealista_detail, idealista_element)
+
+fakeserver_log = logging.getLogger(__name__)
+
+FOTOCASA_PATH = '/mobile/api/v3.asmx'
+IDEALISTA_OAUTH_PATH = '/api/oauth/token'
+IDEALISTA_SEARCH_PATH = '/api/3.5/es/search'
+IDEALISTA_MAP_SEARCH_PATH = '/api/3.5/es/map/search'
+IDEALISTA_DETAIL_PATH = '/api/3/es/detail'
+# half side, in degrees, of the area around a /Search point
+SEARCH_RADIUS = 0.01
+
+
+class SyntheticListings(object):
+    """
+        A set of listings, with ids from 1 to `count`, scattered over the
+        bounding box. The data of a listing only depends on its id and the
+        seed, so it is the same in every page and tile it shows up, until
+        churn() adds, removes and reprices some of them.
+    """
+
+    def __init__(self, count, bounding_box=DEFAULT_BOUNDING_BOX, seed=0):
+        self.count = count
+        self.bounding_box = bounding_box
+        self.seed = seed
+        self.rnd = random.Random(seed)
+        self.price_changes = {}
+        self._set_points([self._new_point(listing_id)
+                          for listing_id in range(1, count + 1)])
+
+    def _new_point(self, listing_id):
+        lat_0, lon_0, lat_1, lon_1 = self.bounding_box
+        return (round(self.rnd.uniform(lat_0, lat_1), 7),
+                round(self.rnd.uniform(lon_0, lon_1), 7), listing_id)
+
+    def _set_points(self, points):
+        points.sort()
+        self.points = points
+        self.lats = [point[0] for point in points]
+        self.by_id = dict((listing_id, (lat, lon))
+                          for lat, lon, listing_id in points)
+
+    def churn(self, ratio):
+        """
+            Removes, reprices and adds `ratio` / 3 of the listings each,
+            returns the (added, removed, repriced) ids.
+        """
+        changes = max(1, int(len(self.points) * ratio / 3))
+        ids = sorted(self.by_id)
+        removed = set(self.rnd.sample(ids, changes))
+        kept = [listing_id for listing_id in ids if listing_id not in removed]
+        repriced = self.rnd.sample(kept, changes)
+        for listing_id in repriced:
+            self.price_changes[listing_id] = self.price_changes.get(listing_id, 0) + 50
+        added = list(range(self.count + 1, self.count + changes + 1))
+        self.count += changes
+        self._set_points([point for point in self.points
+                          if point[2] not in removed] +
+                         [self._new_point(listing_id) for listing_id in added])
+        return added, sorted(removed), sorted(repriced)
+
+    def in_bounding_box(self, lat_0, lon_0, lat_1, lon_1):
+        """ ids of the listings in the bounding box, sorted """
+        lat_0, lat_1 = min(lat_0, lat_1), max(lat_0, lat_1)
+        lon_0, lon_1 = min(lon_0, lon_1), max(lon_0, lon_1)
+        start = bisect.bisect_left(self.lats, lat_0)
+        end = bisect.bisect_right(self.lats, lat_1)
+        return sorted(listing_id for _, lon, listing_id in self.points[start:end]
+                      if lon_0 <= lon <= lon_1)
+
+    def _rnd(self, listing_id):
+        return random.Random(self.seed * 1000003 + listing_id)
+
+    def fotocasa(self, listing_id):
+        lat, lon = self.by_id[listing_id]
+        listing = fotocasa_property(listing_id, self._rnd(listing_id),
+                                    (lat, lon, lat, lon))
+        if listing_id in self.price_changes:
+            price = parse_price(listing['PriceDescription'])
+            price += self.price_changes[listing_id]
+            listing['PriceDescription'] = u'{:,} €/mes'.format(int(price)).replace(',', '.')
+        return listing
+
+    def idealista(self, listing_id):
+        lat, lon = self.by_id[listing_id]
+        element = idealista_element(listing_id, self._rnd(listing_id),
+                                    (lat, lon, lat, lon))
+        element['propertyCode'] = str(listing_id)
+        element['price'] += self.price_changes.get(listing_id, 0)
+        return element
+
+
+def parse_map_bounding_box(map_bounding_box):
+    """ (lat_0, lon_0, lat_1, lon_1) of a fotocasa 'lon,lat;...' polygon """
+    points = [[float(v) for v in point.split(',')]
+              for point in map_bounding_box.split(';')]
+    lons = [point[0] for point in points]
+    lats = [point[1] for point in points]
+    return min(lats), min(lons), max(lats), max(lons)
+
+
+def parse_shape(shape):
+    """ (lat_0, lon_0, lat_1, lon_1) of an idealista MultiPolygon shape """
+    points = json.loads(shape)['coordinates'][0][0]
+    lons = [point[0] for point in points]
+    lats = [point[1] for point in points]
+    return min(lats), min(lons), max(lats), max(lons)
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        status, response = fake.respond(urlsplit(self.path).path, body)
+        self._send_json(status, response)
+
+    def do_GET(self):
+        status, response = self.server.fake.respond(urlsplit(self.path).path, '')
+        self._send_json(status, response)
+
+
+class FakeAPIServer(object):
+    """
+        The fake api server, running in a background thread:
+
+            with FakeAPIServer(listings=5000, latency=0.05) as server:
+                fapi = FotocasaAPI(imei, base_url=server.base_url)
+                iapi = IdealistaAPI(base_url=server.base_url)
+
+        latency (plus a random jitter) is added to every response, and
+        `error_rate` of the requests are answered with `error_status`.
+        Pages after `max_pages` come empty, like the page limits of the
+        real apis. `requests` counts the requests by path.
+    """
+
+    def __init__(self, listings=20000, bounding_box=DEFAULT_BOUNDING_BOX,
+                 seed=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=503, max_pages=None, host='127.0.0.1', port=0,
+                 log=fakeserver_log):
+        self.listings = SyntheticListings(listings, bounding_box, seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_pages = max_pages
+        self.host = host
+        self.port = port
+        self.log = log
+        self.requests = {}
+        self.rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.host, self.port), FakeAPIHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self.port = self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _delay_and_fail(self):
+        with self._lock:
+            delay = self.latency + self.rnd.uniform(0, self.jitter)
+            failed = self.rnd.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        return failed
+
+    def respond(self, path, body):
+        """ the (status, json body) answering a request """
+        # the detail requests are counted together
+        counted = (IDEALISTA_DETAIL_PATH if path.startswith(IDEALISTA_DETAIL_PATH + '/')
+                   else path)
+        with self._lock:
+            self.requests[counted] = self.requests.get(counted, 0) + 1
+        if self._delay_and_fail():
+            return self.error_status, {'error': 'synthetic failure'}
+        try:
+            if path.startswith(FOTOCASA_PATH + '/'):
+                return self._fotocasa(path[len(FOTOCASA_PATH) + 1:],
+                                      json.loads(body or '{}'))
+            if path == IDEALISTA_OAUTH_PATH:
+                return 200, self._idealista_token()
+            if path == IDEALISTA_SEARCH_PATH:
+                return self._idealista_search(dict(parse_qsl(body)))
+            if path == IDEALISTA_MAP_SEARCH_PATH:
+                return self._idealista_search(dict(parse_qsl(body)), pins=True)
+            if path.startswith(IDEALISTA_DETAIL_PATH + '/'):
+                return self._idealista_detail(path[len(IDEALISTA_DETAIL_PATH) + 1:])
+        except (ValueError, KeyError, IndexError):
+            self.log.exception('Bad request to %s', path)
+            return 400, {'error': 'bad request'}
+        return 404, {'error': 'not found'}
+
+    def _page(self, ids, page, page_size):
+        if self.max_pages is not None and page > self.max_pages:
+            return []
+        start = (page - 1) * page_size
+        return ids[start:start + page_size]
+
+    def _fotocasa(self, method, payload):
+        if method == 'GetSuggest':
+            lat_0, lon_0, lat_1, lon_1 = self.listings.bounding_box
+            suggestion = dict(('LocationLevel{}'.format(i), str(i))
+                              for i in range(1, 6))
+            suggestion.update({'Text': payload.get('text', ''),
+                               'X': (lon_0 + lon_1) / 2.0,
+                               'Y': (lat_0 + lat_1) / 2.0})
+            return 200, {'d': {'Suggest': [suggestion]}}
+        if method == 'GetProperty':
+            listing_id = int(payload['propertyId'])
+            if listing_id not in self.listings.by_id:
+                return 404, {'error': 'not found'}
+            return 200, {'d': fotocasa_details(self.listings.fotocasa(listing_id))}
+        if method == 'BoundingBoxSearchV2':
+            bbox = parse_map_bounding_box(payload['mapBoundingBox'])
+        elif method == 'Search':
+            lat = float(payload['latitude'])
+            lon = float(payload['longitude'])
+            bbox = (lat - SEARCH_RADIUS, lon - SEARCH_RADIUS,
+                    lat + SEARCH_RADIUS, lon + SEARCH_RADIUS)
+        else:
+            return 404, {'error': 'not found'}
+        ids = self.listings.in_bounding_box(*bbox)
+        page_ids = self._page(ids, int(payload.get('page') or 1),
+                              int(payload.get('pageSize') or 36))
+        if payload.get('disableClustering') == 'true':
+            properties = [self._pin(self.listings.fotocasa(i), 'Id', 'Y', 'X')
+                          for i in page_ids]
+        else:
+            properties = [self.listings.fotocasa(i) for i in page_ids]
+        return 200, {'d': {
+            'DataLayer': fotocasa_data_layer(len(ids)),
+            'Properties': properties,
+        }}
+
+    def _pin(self, listing, *fields):
+        return dict((field, listing[field]) for field in fields)
+
+    def _idealista_token(self):
+        token = '{:032x}'.format(self.rnd.getrandbits(128))
+        return {'access_token': token, 'token_type': 'bearer',
+                'expires_in': 43199, 'scope': 'write',
+                'jti': str(zlib.crc32(token.encode('ascii')))}
+
+    def _idealista_detail(self, property_code):
+        listing_id = int(property_code)
+        if listing_id not in self.listings.by_id:
+            return 404, {'error': 'not found'}
+        return 200, idealista_detail(self.listings.idealista(listing_id))
+
+    def _idealista_search(self, form, pins=False):
+        if 'shape' in form:
+            bbox = parse_shape(form['shape'])
+        else:
+            bbox = self.listings.bounding_box
+        ids = self.listings.in_bounding_box(*bbox)
+        page = max(1, int(form.get('numPage') or 1))
+        page_size = int(form.get('maxItems') or 0)
+        page_ids = []
+        total_pages = 0
+        if page_size > 0:
+            page_ids = self._page(ids, page, page_size)
+            total_pages = -(-len(ids) // page_size)
+        if pins:
+            elements = [self._pin(self.listings.idealista(i), 'propertyCode',
+                                  'latitude', 'longitude') for i in page_ids]
+        else:
+            elements = [self.listings.idealista(i) for i in page_ids]
+        return 200, {
+            'elementList': elements,
+            'total': len(ids),
+            'totalPages': total_pages,
+            'actualPage': page,
+            'upperRangePosition': min(len(ids), page * max(page_size, 0)),
+        }
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    max_pages = args['--max-pages']
+    server = FakeAPIServer(listings=int(args['--listings']),
+                           seed=int(args['--seed']),
+                           latency=float(args['--latency']),
+                           jitter=float(args['--jitter']),
+                           error_rate=float(args['--error-rate']),
+                           max_pages=int(max_pages) if max_pages else None,
+                           host='0.0.0.0', port=int(args['--port']))
+    server.start()
+    print('Serving on port {}'.format(server.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,198 @@
+# -*- encoding: utf8 -*-
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import threading
+from urllib.parse import urlsplit
+
+from pyappapi.prefetch import iter_completed, DEFAULT_WORKERS
+from pyappapi.session import PooledSessionMixin
+
+images_log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+MANIFEST_FILE = 'manifest.ndjson'
+
+DOWNLOADED = 'downloaded'
+DUPLICATE = 'duplicate'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class ImageDownloader(PooledSessionMixin):
+    """
+        Downloads the images of listings to a directory:
+
+            with ImageDownloader('images', workers=8) as downloader:
+                for record in downloader.download(iapi, listings,
+                                                  size=IMAGE_DETAIL):
+                    ...
+
+        The urls of a listing come from client.listing_image_urls(listing,
+        size), so size is the variant of the provider (idealista
+        IMAGE_LISTING / IMAGE_DETAIL, a fotocasa PHOTO_SIZES field).
+        `workers` images are downloaded at the same time over the pooled
+        session, and each body is streamed to disk in `chunk_size` chunks
+        while it is hashed, so memory does not grow with the image size.
+
+        Images are stored once by the sha256 of their content
+        (<directory>/ab/abcdef....jpg): an url already seen in the run
+        is not requested again, and a body already stored is dropped. Every
+        stored url is appended to <directory>/manifest.ndjson, which is read
+        back on start, so an interrupted run resumes with the urls it did
+        not get (failed urls are not in the manifest, and are retried).
+    """
+
+    def __init__(self, directory, workers=DEFAULT_WORKERS,
+                 chunk_size=DEFAULT_CHUNK_SIZE, req_timeout=10.0,
+                 session=None, log=images_log):
+        self.directory = directory
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.req_timeout = req_timeout
+        self.log = log
+        self.stats = {}
+        self._init_session(session, pool_connections=workers, pool_maxsize=workers)
+        self._lock = threading.Lock()
+        # url -> manifest record, sha256 -> relative path, url -> Event set
+        # once its download ends
+        self._urls = {}
+        self._hashes = {}
+        self._pending = {}
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            # bodies of an interrupted run
+            if name.endswith('.part'):
+                os.remove(os.path.join(directory, name))
+        self.manifest_path = os.path.join(directory, MANIFEST_FILE)
+        self._load_manifest()
+        self._manifest = io.open(self.manifest_path, 'a', encoding='utf-8')
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        with io.open(self.manifest_path, encoding='utf-8') as lines:
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted run
+                    continue
+                if os.path.exists(os.path.join(self.directory, record['path'])):
+                    self._urls[record['url']] = record
+                    self._hashes[record['sha256']] = record['path']
+
+    def close(self):
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+        super(ImageDownloader, self).close()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def iter_images(self, client, listings, size=None):
+        """ (provider, listing key, url) of the images of listings """
+        for listing in listings:
+            key = client.listing_key(listing)
+            for url in client.listing_image_urls(listing, size):
+                yield client.PROVIDER, key, url
+
+    def download(self, client, listings, size=None):
+        """
+            Yields a record per image url of the listings, as they
+            complete: {"url", "provider", "key", "status", "sha256", "path",
+            "bytes"}, status being 'downloaded', 'duplicate' (same content
+            as a stored image), 'skipped' (url already stored, maybe for
+            another listing of the run, whose download is waited for) or
+            'failed'.
+            Listings are read lazily, stats counts the statuses.
+        """
+        stats = dict((status, 0) for status in (DOWNLOADED, DUPLICATE,
+                                                SKIPPED, FAILED))
+        stats['bytes'] = 0
+        self.stats = stats
+        for image, record in iter_completed(self._fetch,
+                                            self.iter_images(client, listings, size),
+                                            workers=self.workers):
+            stats[record['status']] += 1
+            if record['status'] == DOWNLOADED:
+                stats['bytes'] += record['bytes']
+            yield record
+
+    def _fetch(self, image):
+        provider, key, url = image
+        record = {'url': url, 'provider': provider, 'key': key}
+        while True:
+            with self._lock:
+                stored = self._urls.get(url)
+                if stored is not None:
+                    record.update(sha256=stored['sha256'], path=stored['path'],
+                                  bytes=stored['bytes'], status=SKIPPED)
+                    return record
+                downloading = self._pending.get(url)
+                if downloading is None:
+                    downloading = self._pending[url] = threading.Event()
+                    break
+            # being downloaded for another listing: its record is taken
+            # when it ends, or the download is retried when it failed
+            downloading.wait()
+        try:
+            return self._download(url, record)
+        finally:
+            with self._lock:
+                del self._pending[url]
+            downloading.set()
+
+    def _download(self, url, record):
+        part = os.path.join(self.directory, '.{}.part'.format(
+            hashlib.sha1(url.encode('utf-8')).hexdigest()))
+        try:
+            digest = hashlib.sha256()
+            length = 0
+            with self.session.get(url, stream=True, timeout=self.req_timeout) as res:
+                if res.status_code != 200:
+                    self.log.warning('Image %s answered %d', url, res.status_code)
+                    record['status'] = FAILED
+                    return record
+                extension = self._extension(url, res.headers.get('Content-Type'))
+                with io.open(part, 'wb') as output:
+                    for chunk in res.iter_content(self.chunk_size):
+                        digest.update(chunk)
+                        output.write(chunk)
+                        length += len(chunk)
+        except Exception:
+            self.log.exception('Error downloading image %s', url)
+            if os.path.exists(part):
+                os.remove(part)
+            record['status'] = FAILED
+            return record
+        sha256 = digest.hexdigest()
+        record.update(sha256=sha256, bytes=length)
+        with self._lock:
+            path = self._hashes.get(sha256)
+            if path is not None:
+                os.remove(part)
+                record['status'] = DUPLICATE
+            else:
+                path = os.path.join(sha256[:2], sha256 + extension)
+                os.makedirs(os.path.join(self.directory, sha256[:2]), exist_ok=True)
+                os.replace(part, os.path.join(self.directory, path))
+                self._hashes[sha256] = path
+                record['status'] = DOWNLOADED
+            record['path'] = path
+            self._urls[url] = record
+            self._manifest.write(json.dumps(record) + '\n')
+            self._manifest.flush()
+        return record
+
+    def _extension(self, url, content_type):
+        extension = os.path.splitext(urlsplit(url).path)[1]
+        if extension:
+            return extension.lower()
+        if content_type:
+            return mimetypes.guess_extension(content_type.split(';')[0].strip()) or ''
+        return ''
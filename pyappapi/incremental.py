@@ -0,0 +1,253 @@
+# -*- encoding: utf8 -*-
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+
+from pyappapi.prefetch import PageReport, DEFAULT_WORKERS
+
+incremental_log = logging.getLogger(__name__)
+
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+
+def fingerprint(*values):
+    """ signed 64 bits hash of the values, small enough for a sqlite INTEGER """
+    digest = hashlib.blake2b(json.dumps(values).encode('utf-8'),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class ListingChange(object):
+    """ an added, changed or removed listing; removed ones have no listing """
+    __slots__ = ('kind', 'key', 'listing')
+
+    def __init__(self, kind, key, listing=None):
+        self.kind = kind
+        self.key = key
+        self.listing = listing
+
+    def __repr__(self):
+        return 'ListingChange({!r}, {!r})'.format(self.kind, self.key)
+
+
+class MemorySnapshots(object):
+    """ listing fingerprints by listing key, of every crawled area """
+
+    def __init__(self):
+        self._areas = {}
+        self._lock = threading.Lock()
+
+    def load(self, area):
+        with self._lock:
+            return dict(self._areas.get(area, {}))
+
+    def save(self, area, fingerprints):
+        with self._lock:
+            self._areas[area] = dict(fingerprints)
+
+    def areas(self):
+        with self._lock:
+            return list(self._areas)
+
+
+class DiskSnapshots(object):
+    """ sqlite backed snapshots, one row per listing of each area """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                         ' area TEXT NOT NULL,'
+                         ' listing_key TEXT NOT NULL,'
+                         ' fingerprint INTEGER NOT NULL,'
+                         ' PRIMARY KEY (area, listing_key)) WITHOUT ROWID')
+        self._db.commit()
+
+    def load(self, area):
+        with self._lock:
+            rows = self._db.execute('SELECT listing_key, fingerprint'
+                                    ' FROM snapshots WHERE area = ?', (area,))
+            return dict(rows.fetchall())
+
+    def save(self, area, fingerprints):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM snapshots WHERE area = ?', (area,))
+            self._db.executemany('INSERT INTO snapshots VALUES (?, ?, ?)',
+                                 ((area, key, value)
+                                  for key, value in fingerprints.items()))
+
+    def areas(self):
+        with self._lock:
+            rows = self._db.execute('SELECT DISTINCT area FROM snapshots')
+            return [row[0] for row in rows.fetchall()]
+
+    def close(self):
+        self._db.close()
+
+
+class IncrementalCrawler(object):
+    """
+        Emits only what changed in an area since the previous crawl.
+
+        Every crawl of an area (a bounding box or a location search) is
+        compared with the snapshot of the previous one: the fingerprints
+        (client listing_fingerprint: price, size, number of photos) by
+        listing key (Fotocasa Id, Idealista propertyCode). Added and
+        changed listings are yielded as they are found, removed ones once
+        every page was read, and then the snapshot is replaced:
+
+            crawler = IncrementalCrawler(fapi, DiskSnapshots('snapshots.db'))
+            for change in crawler.crawl_bounding_box(lat_0, lon_0, lat_1, lon_1):
+                print(change.kind, change.key)
+
+        When some page could not be read (or the search was capped) there
+        is no way to tell a removed listing from an unread one, so no
+        removals are emitted, and the unseen listings are kept in the
+        snapshot. The snapshot is only written when the generator is
+        consumed to the end.
+    """
+
+    def __init__(self, client, snapshots=None, log=incremental_log):
+        self.client = client
+        self.snapshots = snapshots if snapshots is not None else MemorySnapshots()
+        self.log = log
+        self.stats = {}
+
+    def area_key(self, kind, *args):
+        """ 'fotocasa:bbox:41.35,2.1,41.45,2.22' """
+        return '{}:{}:{}'.format(self.client.PROVIDER, kind,
+                                 ','.join(str(arg) for arg in args))
+
+    def crawl_bounding_box(self, lat_0, lon_0, lat_1, lon_1, **kwargs):
+        report = PageReport()
+        listings = self.client.iter_bounding_box(lat_0, lon_0, lat_1, lon_1,
+                                                 report=report, **kwargs)
+        area = self.area_key('bbox', lat_0, lon_0, lat_1, lon_1)
+        return self.diff(area, listings, report)
+
+    def crawl_location(self, location_name, **kwargs):
+        report = PageReport()
+        listings = self.client.iter_location(location_name, report=report,
+                                             **kwargs)
+        return self.diff(self.area_key('location', location_name), listings,
+                         report)
+
+    def diff(self, area, listings, report=None):
+        """
+            Yields the ListingChange of the listings against the area
+            snapshot. report is the PageReport of the listings, without it
+            they are taken as complete.
+        """
+        previous = self.snapshots.load(area)
+        current = {}
+        stats = {ADDED: 0, CHANGED: 0, REMOVED: 0, 'unchanged': 0}
+        for listing in listings:
+            key = str(self.client.listing_key(listing))
+            if key in current:
+                continue
+            current[key] = self.client.listing_fingerprint(listing)
+            before = previous.get(key)
+            if before is None:
+                stats[ADDED] += 1
+                yield ListingChange(ADDED, key, listing)
+            elif before != current[key]:
+                stats[CHANGED] += 1
+                yield ListingChange(CHANGED, key, listing)
+            else:
+                stats['unchanged'] += 1
+        for change in self._removed(area, previous, current, report, stats):
+            yield change
+
+    def _removed(self, area, previous, current, report, stats):
+        """
+            Yields the removals of a complete crawl (keeps the unseen
+            listings of an incomplete one) and saves the snapshot.
+        """
+        complete = report is None or report.complete
+        if complete:
+            for key in previous:
+                if key not in current:
+                    stats[REMOVED] += 1
+                    yield ListingChange(REMOVED, key)
+        else:
+            self.log.warning('Incomplete crawl of %s (%d of %s pages), not '
+                             'looking for removed listings', area,
+                             report.pages, str(report.total_pages))
+            for key, value in previous.items():
+                current.setdefault(key, value)
+        self.snapshots.save(area, current)
+        stats['complete'] = complete
+        stats['listings'] = len(current)
+        self.stats = stats
+
+
+class IdsFirstCrawler(IncrementalCrawler):
+    """
+        Two phase crawl of an area, for the daily refreshes. First the ids
+        and coordinates of every listing are read from the map pins
+        (client iter_bounding_box_pins: the Fotocasa search without
+        clustering, the Idealista map search), a fraction of the size of
+        the listings. Then the full data is requested only for the ids
+        not in the snapshot of the area (client get_details, `workers`
+        requests at a time):
+
+            crawler = IdsFirstCrawler(fapi, DiskSnapshots('snapshots.db'))
+            for change in crawler.crawl_bounding_box(lat_0, lon_0, lat_1, lon_1):
+                print(change.kind, change.key, change.listing)
+
+        Added listings come with their details (FotocasaDetailsResult,
+        IdealistaPropertyDetail), removed ones as in IncrementalCrawler.
+        Known listings are not requested again, so their changes are not
+        seen: crawl with IncrementalCrawler for those. A listing whose
+        details fail is left out of the snapshot, and is added by the next
+        crawl.
+    """
+
+    def __init__(self, client, snapshots=None, workers=DEFAULT_WORKERS,
+                 log=incremental_log):
+        super(IdsFirstCrawler, self).__init__(client, snapshots=snapshots,
+                                              log=log)
+        self.workers = workers
+
+    def crawl_bounding_box(self, lat_0, lon_0, lat_1, lon_1, **kwargs):
+        report = PageReport()
+        pins = self.client.iter_bounding_box_pins(lat_0, lon_0, lat_1, lon_1,
+                                                  report=report, **kwargs)
+        area = self.area_key('pins', lat_0, lon_0, lat_1, lon_1)
+        return self.diff_pins(area, pins, report)
+
+    def diff_pins(self, area, pins, report=None):
+        """
+            Yields the ListingChange of the (key, lat, lon) pins against
+            the area snapshot, requesting the details of the new keys
+            once every pin was read.
+        """
+        previous = self.snapshots.load(area)
+        current = {}
+        new_keys = []
+        stats = {ADDED: 0, REMOVED: 0, 'known': 0, 'failed': 0}
+        for key, lat, lon in pins:
+            str_key = str(key)
+            if str_key in current:
+                continue
+            current[str_key] = fingerprint(lat, lon)
+            if str_key in previous:
+                stats['known'] += 1
+            else:
+                new_keys.append(key)
+        stats['pins'] = len(current)
+        for key, details in self.client.get_details(new_keys, workers=self.workers):
+            # a details without key is an error body that got through
+            if details is None or self.client.listing_key(details) is None:
+                stats['failed'] += 1
+                del current[str(key)]
+                continue
+            stats[ADDED] += 1
+            yield ListingChange(ADDED, str(key), details)
+        for change in self._removed(area, previous, current, report, stats):
+            yield change
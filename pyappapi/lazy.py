@@ -0,0 +1,61 @@
+# -*- encoding: utf8 -*-
+
+
+class LazyResultList(object):
+    """
+        Read only sequence over the decoded json elements of a result page.
+        The model of an element is only built when it is indexed or
+        iterated, and then kept.
+
+        ids(), coords() and len() read the json directly and never build
+        a model.
+    """
+    __slots__ = ('_raw', '_built', '_factory', 'id_field', 'lat_field',
+                 'lon_field')
+
+    def __init__(self, raw, factory, id_field, lat_field, lon_field):
+        self._raw = raw
+        self._built = [None] * len(raw)
+        self._factory = factory
+        self.id_field = id_field
+        self.lat_field = lat_field
+        self.lon_field = lon_field
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._raw)))]
+        element = self._built[index]
+        if element is None:
+            element = self._factory(self._raw[index])
+            self._built[index] = element
+        return element
+
+    def __iter__(self):
+        for index in range(len(self._raw)):
+            yield self[index]
+
+    def __bool__(self):
+        return len(self._raw) > 0
+
+    def built(self):
+        """ number of elements already built """
+        return len(self._built) - self._built.count(None)
+
+    def raw(self, index):
+        return self._raw[index]
+
+    def raw_elements(self):
+        return self._raw
+
+    def ids(self):
+        id_field = self.id_field
+        return [el[id_field] for el in self._raw]
+
+    def coords(self):
+        """ (latitude, longitude) of every element """
+        lat_field = self.lat_field
+        lon_field = self.lon_field
+        return [(el[lat_field], el[lon_field]) for el in self._raw]
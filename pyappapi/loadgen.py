@@ -0,0 +1,171 @@
+""" Load generator driving the real api clients
+
+Crawls random tiles (every page of each) with a number of concurrent
+workers sharing one client, and prints the throughput, the request latency
+percentiles, the errors and the memory used as json. Without --base-url a
+local fake api server (pyappapi.fakeserver) is started, with the given
+listings, latency, jitter, error rate and max pages.
+
+Usage:
+    loadgen.py (fotocasa|idealista) [--base-url=<url>] [--concurrency=<n>]
+               [--duration=<s>] [--page-size=<n>] [--seed=<n>]
+               [--listings=<n>] [--latency=<s>] [--jitter=<s>]
+               [--error-rate=<r>] [--max-pages=<n>]
+
+Options:
+    --base-url=<url>    Api server, instead of a local fake server
+    --concurrency=<n>   Concurrent workers [default: 8]
+    --duration=<s>      Seconds of load [default: 10]
+    --page-size=<n>     Listings per page [default: 36]
+    --seed=<n>          Seed of the tiles and listings [default: 0]
+    --listings=<n>      Listings of the fake server [default: 20000]
+    --latency=<s>       Latency of the fake server [default: 0.02]
+    --jitter=<s>        Latency jitter of the fake server [default: 0.01]
+    --error-rate=<r>    Error rate of the fake server [default: 0]
+    --max-pages=<n>     Page cap of the fake server
+"""
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from docopt import docopt
+
+from fotocasa.fotocasa import FotocasaAPI
+from idealista.idealista import IdealistaAPI
+from pyappapi.fakeserver import FakeAPIServer
+from pyappapi.metrics import Metrics
+from pyappapi.synthetic import DEFAULT_BOUNDING_BOX
+
+FAKE_IMEI = '536449977880378'
+PERCENTILES = (50, 90, 95, 99)
+
+
+def random_tiles(rnd, count, bounding_box=DEFAULT_BOUNDING_BOX,
+                 min_side=0.005, max_side=0.03):
+    lat_0, lon_0, lat_1, lon_1 = bounding_box
+    tiles = []
+    for _ in range(count):
+        side = rnd.uniform(min_side, max_side)
+        lat = rnd.uniform(lat_0, lat_1 - side)
+        lon = rnd.uniform(lon_0, lon_1 - side)
+        tiles.append((lat, lon, lat + side, lon + side))
+    return tiles
+
+
+def percentiles(values, points=PERCENTILES):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    res = dict(('p{}'.format(p),
+                ordered[min(len(ordered) - 1, len(ordered) * p // 100)])
+               for p in points)
+    res['max'] = ordered[-1]
+    return res
+
+
+def max_rss_bytes():
+    if resource is None:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def create_client(provider, base_url, concurrency, page_size, metrics):
+    pool = dict(pool_connections=2, pool_maxsize=concurrency * 2,
+                metrics=metrics, base_url=base_url, page_size=page_size)
+    if provider == 'fotocasa':
+        client = FotocasaAPI(imei=FAKE_IMEI, **pool)
+    else:
+        client = IdealistaAPI(**pool)
+    client.session.trust_env = False
+    if provider == 'idealista':
+        client.load_authorization(client.authorize())
+    return client
+
+
+def run_load(client, tiles, concurrency, duration):
+    """ crawls the tiles until duration, returns the listings and tiles done """
+    deadline = time.time() + duration
+    lock = threading.Lock()
+    counters = {'listings': 0, 'tiles': 0}
+    next_tile = [0]
+
+    def worker():
+        while time.time() < deadline:
+            with lock:
+                tile = tiles[next_tile[0] % len(tiles)]
+                next_tile[0] += 1
+            listings = sum(1 for _ in client.iter_bounding_box(*tile,
+                                                               prefetch=1))
+            with lock:
+                counters['listings'] += listings
+                counters['tiles'] += 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return counters
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    provider = 'fotocasa' if args['fotocasa'] else 'idealista'
+    concurrency = int(args['--concurrency'])
+    duration = float(args['--duration'])
+    seed = int(args['--seed'])
+    server = None
+    base_url = args['--base-url']
+    if not base_url:
+        max_pages = args['--max-pages']
+        server = FakeAPIServer(listings=int(args['--listings']), seed=seed,
+                               latency=float(args['--latency']),
+                               jitter=float(args['--jitter']),
+                               error_rate=float(args['--error-rate']),
+                               max_pages=int(max_pages) if max_pages else None)
+        base_url = server.start()
+    latencies = []
+
+    def collect(endpoint, metric, value):
+        if metric == 'latency':
+            latencies.append(value)
+
+    metrics = Metrics(hooks=[collect])
+    try:
+        client = create_client(provider, base_url, concurrency,
+                               int(args['--page-size']), metrics)
+        del latencies[:]
+        tiles = random_tiles(random.Random(seed), 1000)
+        start = time.time()
+        counters = run_load(client, tiles, concurrency, duration)
+        elapsed = time.time() - start
+        client.close()
+    finally:
+        if server is not None:
+            server.stop()
+    snapshot = metrics.snapshot()
+    errors = {}
+    for endpoint, endpoint_metrics in snapshot.items():
+        for kind, count in endpoint_metrics['errors'].items():
+            errors['{} {}'.format(endpoint, kind)] = count
+    report = {
+        'provider': provider,
+        'base_url': base_url,
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'requests': len(latencies),
+        'requests_per_sec': len(latencies) / elapsed,
+        'listings': counters['listings'],
+        'listings_per_sec': counters['listings'] / elapsed,
+        'tiles': counters['tiles'],
+        'latency_seconds': percentiles(latencies),
+        'errors': errors,
+        'max_rss_bytes': max_rss_bytes(),
+    }
+    print(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,179 @@
+# -*- encoding: utf8 -*-
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+locations_log = logging.getLogger(__name__)
+
+# a day, location codes are very stable
+DEFAULT_LOCATION_TTL = 86400.0
+_SEPARATORS = re.compile(r"[\s,.;:'\"()/-]+")
+
+
+def normalize_location_text(text):
+    """ 'Gràcia,  Barcelona' -> 'gracia barcelona' """
+    text = text or u''
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = u''.join(c for c in text if not unicodedata.combining(c))
+    return _SEPARATORS.sub(u' ', text.lower()).strip()
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'entries')
+
+    def __init__(self):
+        self.children = {}
+        # (category, offer) -> (codes, lat, lon, stored_at)
+        self.entries = None
+
+
+class LocationCache(object):
+    """
+        Resolved location suggestions: the LocationLevel1..5 codes and the
+        X / Y center of the first GetSuggest suggestion, by normalized
+        text (lower case, no accents, punctuation as single spaces) and
+        categoryTypeId / offerTypeId.
+
+        The entries live in a character trie, so a lookup walks the
+        characters of the text and takes a few microseconds, and a prefix
+        lists every cached location under it (complete()). A prefix alone
+        is never taken as a resolution, as a shorter text can name a
+        different location ('barcelona' is not 'barcelona gracia').
+        With a `path`, entries are also kept in a sqlite file and loaded
+        again by the next process.
+
+        Entries older than `ttl` are refreshed by the client, and kept to
+        answer while the refresh fails (get(..., stale=True)).
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_LOCATION_TTL, log=locations_log):
+        self.path = path
+        self.ttl = ttl
+        self.log = log
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._root = _TrieNode()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS locations ('
+                             ' text TEXT NOT NULL,'
+                             ' category TEXT NOT NULL,'
+                             ' offer TEXT NOT NULL,'
+                             ' codes TEXT NOT NULL,'
+                             ' lat REAL, lon REAL,'
+                             ' stored_at REAL NOT NULL,'
+                             ' PRIMARY KEY (text, category, offer))')
+            self._db.commit()
+            rows = self._db.execute('SELECT text, category, offer, codes, lat,'
+                                    ' lon, stored_at FROM locations')
+            for text, category, offer, codes, lat, lon, stored_at in rows:
+                self._insert(text, (category, offer),
+                             (tuple(json.loads(codes)), lat, lon, stored_at))
+
+    def __len__(self):
+        return self._size
+
+    def _node(self, text, create=False):
+        node = self._root
+        for char in text:
+            child = node.children.get(char)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[char] = _TrieNode()
+            node = child
+        return node
+
+    def _insert(self, text, kind, entry):
+        node = self._node(text, create=True)
+        if node.entries is None:
+            node.entries = {}
+        if kind not in node.entries:
+            self._size += 1
+        node.entries[kind] = entry
+
+    def get(self, text, category, offer, stale=False, now=None):
+        """
+            The (location_codes, lat, lon) of a text, or None when it is
+            not cached or expired (unless stale).
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            node = self._node(normalize_location_text(text))
+            entry = None
+            if node is not None and node.entries is not None:
+                entry = node.entries.get((str(category), str(offer)))
+            if entry is None:
+                self.misses += 1
+                return None
+            codes, lat, lon, stored_at = entry
+            if not stale:
+                if now - stored_at > self.ttl:
+                    self.expired += 1
+                    return None
+                self.hits += 1
+            return list(codes), lat, lon
+
+    def set(self, text, category, offer, location, now=None):
+        """ stores the (location_codes, lat, lon) of a text """
+        now = time.time() if now is None else now
+        text = normalize_location_text(text)
+        category, offer = str(category), str(offer)
+        codes, lat, lon = location
+        with self._lock:
+            self._insert(text, (category, offer), (tuple(codes), lat, lon, now))
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('INSERT OR REPLACE INTO locations VALUES'
+                                     ' (?, ?, ?, ?, ?, ?, ?)',
+                                     (text, category, offer, json.dumps(list(codes)),
+                                      lat, lon, now))
+
+    def complete(self, prefix, category, offer, limit=10):
+        """
+            (text, location) of the cached texts starting with prefix,
+            shortest first, expired ones included.
+        """
+        kind = (str(category), str(offer))
+        res = []
+        with self._lock:
+            start = self._node(normalize_location_text(prefix))
+            if start is None:
+                return res
+            level = [(normalize_location_text(prefix), start)]
+            # breadth first, so the shorter texts come first
+            while level and len(res) < limit:
+                next_level = []
+                for text, node in level:
+                    if node.entries is not None and kind in node.entries:
+                        codes, lat, lon, _ = node.entries[kind]
+                        res.append((text, (list(codes), lat, lon)))
+                        if len(res) >= limit:
+                            break
+                    for char in sorted(node.children):
+                        next_level.append((text + char, node.children[char]))
+                level = next_level
+        return res
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.expired
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'hit_ratio': self.hits / float(lookups) if lookups else 0.0,
+            'entries': len(self),
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
@@ -0,0 +1,199 @@
+# -*- encoding: utf8 -*-
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+metrics_log = logging.getLogger(__name__)
+
+# seconds, like the default buckets of the prometheus clients
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+TIMINGS = ('latency', 'decode', 'build')
+TIMING_HELP = {
+    'latency': 'Request latency, until the response body is read.',
+    'decode': 'Time decoding the json responses.',
+    'build': 'Time building the result models.',
+}
+
+
+class Histogram(object):
+    """ cumulative histogram of the observed values, by upper bound """
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is for the values over every bucket (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """ the (upper_bound, count) pairs, +Inf being float('inf') """
+        res = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            res.append((bound, total))
+        return res
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                        for bound, count in self.cumulative()],
+        }
+
+
+class EndpointMetrics(object):
+    """ the numbers of a single endpoint """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.requests = 0
+        self.response_bytes = 0
+        self.errors = {}
+        self.timings = dict((name, Histogram(buckets)) for name in TIMINGS)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'response_bytes': self.response_bytes,
+            'errors': dict(self.errors),
+            'timings': dict((name, hist.as_dict())
+                            for name, hist in self.timings.items()),
+        }
+
+
+class Metrics(object):
+    """
+        Per endpoint instrumentation of the API clients, shared by any
+        number of them through their `metrics` option:
+
+            metrics = Metrics()
+            fapi = FotocasaAPI(imei, metrics=metrics)
+            iapi = IdealistaAPI(metrics=metrics)
+            ...
+            print(metrics.to_prometheus())
+
+        For every endpoint (like 'fotocasa/BoundingBoxSearchV2' or
+        'idealista/search') it keeps the number of requests, the response
+        bytes, the errors by kind, and histograms of the request latency,
+        the json decoding time and the result models build time.
+
+        Hooks are called with (endpoint, metric, value) for every recorded
+        value, to forward them to another collector. metric is one of
+        'latency', 'decode', 'build', 'response_bytes' or 'error' (with the
+        error kind as value).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, hooks=None, log=metrics_log):
+        self.buckets = tuple(buckets)
+        self.hooks = list(hooks or [])
+        self.log = log
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _endpoint(self, endpoint):
+        metrics = self.endpoints.get(endpoint)
+        if metrics is None:
+            metrics = self.endpoints[endpoint] = EndpointMetrics(self.buckets)
+        return metrics
+
+    def _notify(self, endpoint, metric, value):
+        for hook in self.hooks:
+            try:
+                hook(endpoint, metric, value)
+            except Exception:
+                self.log.exception('Metrics hook %r failed', hook)
+
+    def record_request(self, endpoint, latency, response_bytes, status=200):
+        """ a response, counting statuses from 400 up as errors """
+        with self._lock:
+            metrics = self._endpoint(endpoint)
+            metrics.requests += 1
+            metrics.response_bytes += response_bytes
+            metrics.timings['latency'].observe(latency)
+        self._notify(endpoint, 'latency', latency)
+        self._notify(endpoint, 'response_bytes', response_bytes)
+        if status >= 400:
+            self.record_error(endpoint, 'http_' + str(status))
+
+    def record_error(self, endpoint, kind):
+        with self._lock:
+            errors = self._endpoint(endpoint).errors
+            errors[kind] = errors.get(kind, 0) + 1
+        self._notify(endpoint, 'error', kind)
+
+    def observe(self, endpoint, timing, seconds):
+        """ a 'decode' or 'build' time """
+        with self._lock:
+            self._endpoint(endpoint).timings[timing].observe(seconds)
+        self._notify(endpoint, timing, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((endpoint, metrics.as_dict())
+                        for endpoint, metrics in self.endpoints.items())
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self, prefix='pyappapi'):
+        """ the metrics in the prometheus text exposition format """
+        snapshot = self.snapshot()
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+
+        header('requests_total', 'counter', 'Responses received.')
+        for endpoint, metrics in sorted(snapshot.items()):
+            lines.append('{}_requests_total{{endpoint="{}"}} {}'.format(
+                prefix, endpoint, metrics['requests']))
+        header('response_bytes_total', 'counter', 'Bytes of the response bodies.')
+        for endpoint, metrics in sorted(snapshot.items()):
+            lines.append('{}_response_bytes_total{{endpoint="{}"}} {}'.format(
+                prefix, endpoint, metrics['response_bytes']))
+        header('errors_total', 'counter', 'Failed requests, by kind.')
+        for endpoint, metrics in sorted(snapshot.items()):
+            for kind, count in sorted(metrics['errors'].items()):
+                lines.append('{}_errors_total{{endpoint="{}",kind="{}"}} {}'.format(
+                    prefix, endpoint, kind, count))
+        for timing in TIMINGS:
+            name = '{}_seconds'.format(timing)
+            header(name, 'histogram', TIMING_HELP[timing])
+            for endpoint, metrics in sorted(snapshot.items()):
+                hist = metrics['timings'][timing]
+                for bound, count in hist['buckets']:
+                    lines.append('{}_{}_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                        prefix, name, endpoint, bound, count))
+                lines.append('{}_{}_sum{{endpoint="{}"}} {}'.format(
+                    prefix, name, endpoint, hist['sum']))
+                lines.append('{}_{}_count{{endpoint="{}"}} {}'.format(
+                    prefix, name, endpoint, hist['count']))
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timed(metrics, endpoint, timing):
+    """ records the time spent in the `with` block, when metrics is not None """
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(endpoint, timing, time.perf_counter() - start)
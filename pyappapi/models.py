@@ -0,0 +1,77 @@
+# -*- encoding: utf8 -*-
+
+SLOT_SOURCES = ('required', 'optional', 'extra_fields')
+
+
+def compile_field_loader(class_name, required, optional):
+    """
+        Builds the function that copies the `required` and `optional`
+        fields of a json dict into a model instance, as straight line
+        code instead of a loop of setattr calls. A missing required field
+        raises KeyError with the field name.
+    """
+    lines = ['def _load_fields(self, json_dict):']
+    for field in required:
+        lines.append('    self.{0} = json_dict[{0!r}]'.format(field))
+    if optional:
+        lines.append('    get = json_dict.get')
+    for field in optional:
+        lines.append('    self.{0} = get({0!r})'.format(field))
+    if len(lines) == 1:
+        lines.append('    pass')
+    namespace = {}
+    code = compile('\n'.join(lines), '<{} loader>'.format(class_name), 'exec')
+    exec(code, namespace)
+    return namespace['_load_fields']
+
+
+class SlottedDataMeta(type):
+    """
+        Metaclass of the result models: the `__slots__` of every class are
+        generated from its `required`, `optional` and `extra_fields` lists
+        (so instances carry no `__dict__`), and its `_load_fields` is
+        compiled from the `required` and `optional` lists.
+
+        `_fields` keeps every slotted field of the class, inherited ones
+        included, in declaration order.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        inherited = []
+        for base in bases:
+            for field in getattr(base, '_fields', ()):
+                if field not in inherited:
+                    inherited.append(field)
+        if '__slots__' not in namespace:
+            own = []
+            for source in SLOT_SOURCES:
+                for field in namespace.get(source, ()):
+                    if field not in inherited and field not in own:
+                        own.append(field)
+            namespace['__slots__'] = tuple(own)
+        namespace['_fields'] = tuple(inherited + [f for f in namespace['__slots__']
+                                                  if f not in inherited])
+        cls = super(SlottedDataMeta, mcs).__new__(mcs, name, bases, namespace)
+        if 'required' in namespace or 'optional' in namespace:
+            cls._load_fields = compile_field_loader(name,
+                                                    getattr(cls, 'required', ()),
+                                                    getattr(cls, 'optional', ()))
+        return cls
+
+
+def model_to_dict(value):
+    """
+        json ready copy of a model: its slotted fields (unset ones as
+        None), with the nested models and lists converted too.
+    """
+    if isinstance(value, (list, tuple)):
+        return [model_to_dict(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, model_to_dict(item)) for key, item in value.items())
+    fields = getattr(type(value), '_fields', None)
+    if fields is None:
+        fields = getattr(type(value), '__slots__', None)
+    if fields is None:
+        return value
+    return dict((field, model_to_dict(getattr(value, field, None)))
+                for field in fields)
@@ -0,0 +1,315 @@
+# -*- encoding: utf8 -*-
+import csv
+import io
+import json
+import logging
+import queue
+import sqlite3
+import threading
+
+from pyappapi.models import model_to_dict
+from pyappapi.prefetch import PageReport
+
+pipeline_log = logging.getLogger(__name__)
+
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 4
+CSV_FIELDS = ('provider', 'key', 'lat', 'lon', 'price', 'size', 'rooms')
+
+# end of a stage output
+_DONE = object()
+
+
+def listing_record(client, listing):
+    """ the (provider, key, lat, lon, price, size, rooms) of a listing """
+    lat, lon = client.listing_coords(listing)
+    price, size, rooms = client.listing_features(listing)
+    return (client.PROVIDER, client.listing_key(listing), lat, lon, price,
+            size, rooms)
+
+
+class _FileSink(object):
+    """ writes to a path (opened and closed by the sink) or a file object """
+
+    def __init__(self, output, newline=None):
+        self._owned = isinstance(output, str)
+        if self._owned:
+            output = io.open(output, 'w', encoding='utf-8', newline=newline)
+        self.output = output
+        self.written = 0
+
+    def close(self):
+        if self._owned:
+            self.output.close()
+        else:
+            self.output.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NDJSONSink(_FileSink):
+    """
+        One json line per listing:
+        {"provider": "fotocasa", "key": 123, "listing": {...}}
+
+        `extra` fields are added to every line. Sinks sharing an output
+        (and writing from different threads) share a `lock`, so that the
+        lines of a page are written together.
+    """
+
+    def __init__(self, output, extra=None, lock=None):
+        super(NDJSONSink, self).__init__(output)
+        self.extra = extra
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def write(self, client, listings):
+        lines = []
+        for listing in listings:
+            record = dict(self.extra) if self.extra else {}
+            record['provider'] = client.PROVIDER
+            record['key'] = client.listing_key(listing)
+            record['listing'] = model_to_dict(listing)
+            lines.append(json.dumps(record))
+        if lines:
+            with self.lock:
+                self.output.write('\n'.join(lines) + '\n')
+        self.written += len(lines)
+
+
+class CSVSink(_FileSink):
+    """
+        One row per listing, with the CSV_FIELDS columns and then the
+        model attributes listed in `fields`.
+    """
+
+    def __init__(self, output, fields=()):
+        super(CSVSink, self).__init__(output, newline='')
+        self.fields = tuple(fields)
+        self.writer = csv.writer(self.output)
+        self.writer.writerow(CSV_FIELDS + self.fields)
+
+    def write(self, client, listings):
+        rows = [listing_record(client, listing) +
+                tuple(getattr(listing, field, None) for field in self.fields)
+                for listing in listings]
+        self.writer.writerows(rows)
+        self.written += len(rows)
+
+
+class SQLiteSink(object):
+    """
+        Upserts the listings in a sqlite table keyed on (provider,
+        listing_key), with the position, price, size and rooms as columns
+        and the whole listing as json in `data`. A transaction per page.
+    """
+
+    def __init__(self, path, table='listings'):
+        self.path = path
+        self.table = table
+        self.written = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS {} ('
+                         ' provider TEXT NOT NULL,'
+                         ' listing_key TEXT NOT NULL,'
+                         ' lat REAL, lon REAL, price REAL, size REAL,'
+                         ' rooms INTEGER,'
+                         ' data TEXT NOT NULL,'
+                         ' PRIMARY KEY (provider, listing_key))'.format(table))
+        self._db.commit()
+        self._insert = ('INSERT OR REPLACE INTO {} VALUES'
+                        ' (?, ?, ?, ?, ?, ?, ?, ?)'.format(table))
+
+    def write(self, client, listings):
+        rows = []
+        for listing in listings:
+            record = listing_record(client, listing)
+            rows.append((record[0], str(record[1])) + record[2:] +
+                        (json.dumps(model_to_dict(listing)),))
+        with self._db:
+            self._db.executemany(self._insert, rows)
+        self.written += len(rows)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ListingPipeline(object):
+    """
+        Crawls a search into a sink with a constant memory footprint.
+
+        Fetching, decoding, model building and writing run as separate
+        stages joined by queues of `queue_size` pages: `fetch_workers`
+        threads request the pages, one thread decodes their json (client
+        decode_page), one builds the listing models (client build_page),
+        and the calling thread writes them to the sink. A full queue
+        blocks the stage feeding it, so a slow sink slows down the
+        requests instead of piling pages up in memory:
+
+            with NDJSONSink('barcelona.ndjson') as sink:
+                pipeline = ListingPipeline(fapi, sink, fetch_workers=8)
+                report = pipeline.run_bounding_box(41.35, 2.1, 41.45, 2.22)
+
+        Page 1 goes through every stage in the calling thread first, as
+        the number of pages is only known after it. Pages reach the sink
+        in the order they are fetched, not in page order. A page that
+        fails in any stage is logged and skipped; the other pages go on,
+        and the returned PageReport is not complete. Decoding and building
+        are CPU bound, so a single thread each is as fast as it gets.
+    """
+
+    def __init__(self, client, sink, fetch_workers=DEFAULT_FETCH_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE, max_pages=None,
+                 log=pipeline_log):
+        self.client = client
+        self.sink = sink
+        self.fetch_workers = max(1, fetch_workers)
+        self.queue_size = max(1, queue_size)
+        self.max_pages = max_pages
+        self.log = log
+        self.stats = {}
+
+    def run_bounding_box(self, lat_0, lon_0, lat_1, lon_1, report=None):
+        def fetch_page(page_num):
+            return self.client.bounding_box_page_text(lat_0, lon_0, lat_1,
+                                                      lon_1, page_num=page_num)
+        return self.run(fetch_page, report=report,
+                        endpoint=self.client.page_endpoint('bbox'))
+
+    def run_location(self, location_name, report=None):
+        fetch_page = self.client.location_page_fetcher(location_name)
+        if fetch_page is None:
+            self.log.warning('Location not found: %s', location_name)
+            return report if report is not None else PageReport()
+        return self.run(fetch_page, report=report,
+                        endpoint=self.client.page_endpoint('loc'))
+
+    def _fetch(self, fetch_page, page_num):
+        try:
+            return fetch_page(page_num)
+        except Exception:
+            self.log.exception('Error fetching page %d', page_num)
+            return None
+
+    def _decode(self, page_num, text, endpoint=None):
+        if text is None:
+            return None
+        try:
+            return self.client.decode_page(text, endpoint=endpoint)
+        except Exception:
+            self.log.exception('Error decoding page %d', page_num)
+            return None
+
+    def _build(self, page_num, decoded, endpoint=None):
+        if decoded is None:
+            return None
+        try:
+            return self.client.build_page(decoded, endpoint=endpoint)
+        except Exception:
+            self.log.exception('Error building page %d', page_num)
+            return None
+
+    def run(self, fetch_page, report=None, endpoint=None):
+        """
+            Runs every page of fetch_page(page_num) -> undecoded response
+            through the stages, returns the PageReport. endpoint is the
+            metrics name of the pages (client page_endpoint).
+        """
+        report = report if report is not None else PageReport()
+        stats = {'pages': 0, 'failed_pages': 0, 'listings': 0}
+        self.stats = stats
+        first = self._build(1, self._decode(1, self._fetch(fetch_page, 1),
+                                            endpoint), endpoint)
+        if first is None:
+            stats['failed_pages'] += 1
+            return report
+        elements, total_pages = first
+        report.total_pages = total_pages
+        if self.max_pages is not None:
+            total_pages = min(total_pages, self.max_pages)
+        # an empty first page is an empty search, not a failed page
+        self._write(elements, stats, allow_empty=True)
+        if total_pages > 1:
+            self._run_stages(fetch_page, range(2, total_pages + 1), stats,
+                             endpoint)
+        report.pages = stats['pages']
+        report.complete = report.pages >= report.total_pages
+        return report
+
+    def _write(self, elements, stats, allow_empty=False):
+        if elements is None or (not elements and not allow_empty):
+            stats['failed_pages'] += 1
+            return
+        if elements:
+            self.sink.write(self.client, elements)
+        stats['pages'] += 1
+        stats['listings'] += len(elements)
+
+    def _run_stages(self, fetch_page, page_nums, stats, endpoint=None):
+        pages = queue.Queue()
+        for page_num in page_nums:
+            pages.put(page_num)
+        fetched = queue.Queue(self.queue_size)
+        decoded = queue.Queue(self.queue_size)
+        built = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        live_fetchers = [self.fetch_workers]
+        lock = threading.Lock()
+
+        def fetcher():
+            try:
+                while not stop.is_set():
+                    try:
+                        page_num = pages.get_nowait()
+                    except queue.Empty:
+                        break
+                    fetched.put((page_num, self._fetch(fetch_page, page_num)))
+            finally:
+                with lock:
+                    live_fetchers[0] -= 1
+                    last = live_fetchers[0] == 0
+                if last:
+                    fetched.put(_DONE)
+
+        def stage(source, target, work):
+            while True:
+                item = source.get()
+                if item is _DONE:
+                    target.put(_DONE)
+                    return
+                page_num, value = item
+                if stop.is_set():
+                    continue
+                target.put((page_num, work(page_num, value, endpoint)))
+
+        threads = [threading.Thread(target=fetcher, daemon=True)
+                   for _ in range(self.fetch_workers)]
+        threads.append(threading.Thread(target=stage, daemon=True,
+                                        args=(fetched, decoded, self._decode)))
+        threads.append(threading.Thread(target=stage, daemon=True,
+                                        args=(decoded, built, self._build)))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = built.get()
+                if item is _DONE:
+                    break
+                page_num, parsed = item
+                self._write(parsed[0] if parsed is not None else None, stats)
+        finally:
+            # on a sink error, the stages are drained so that every thread ends
+            stop.set()
+            while item is not _DONE:
+                item = built.get()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,113 @@
+# -*- encoding: utf8 -*-
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+DEFAULT_PREFETCH = 2
+DEFAULT_WORKERS = 8
+
+
+class PageReport(object):
+    """
+        How far a paginated search went: complete is only set when every
+        page up to total_pages came with elements, so that callers can
+        tell the whole result set from a search cut by a failed page.
+    """
+    def __init__(self):
+        self.pages = 0
+        self.total_pages = None
+        self.complete = False
+
+
+def iter_prefetched_pages(fetch_page, parse_page, prefetch=DEFAULT_PREFETCH,
+                          max_pages=None, first_page=None, report=None):
+    """
+        Yields the elements of a paginated search, page after page, while
+        the next pages are downloaded in background threads.
+
+        fetch_page(page_num): performs the request of a page and returns
+            its raw response (runs in a worker thread).
+        parse_page(raw_response): returns a (elements, total_pages) tuple,
+            or None when the response is not usable.
+        prefetch: max number of pages requested ahead of the one being
+            consumed, this bounds the memory used by the buffer.
+        max_pages: optional cap on the number of pages.
+        first_page: the already parsed (elements, total_pages) of page 1,
+            when the caller has it.
+        report: an optional PageReport, filled as the pages are consumed.
+
+        The first page is fetched in the calling thread, because the total
+        number of pages is only known after it.
+    """
+    parsed = first_page
+    if parsed is None:
+        parsed = parse_page(fetch_page(1))
+    if parsed is None:
+        return
+    elements, total_pages = parsed
+    if report is not None:
+        report.pages = 1
+        report.total_pages = total_pages
+    if max_pages is not None:
+        total_pages = min(total_pages, max_pages)
+    prefetch = max(1, prefetch)
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    pending = deque()
+    next_page = 2
+    try:
+        while next_page <= total_pages and len(pending) < prefetch:
+            pending.append(executor.submit(fetch_page, next_page))
+            next_page += 1
+        for element in elements:
+            yield element
+        while pending:
+            raw_response = pending.popleft().result()
+            if next_page <= total_pages:
+                pending.append(executor.submit(fetch_page, next_page))
+                next_page += 1
+            parsed = parse_page(raw_response)
+            if parsed is None or not parsed[0]:
+                break
+            if report is not None:
+                report.pages += 1
+            for element in parsed[0]:
+                yield element
+        if report is not None and report.pages >= report.total_pages:
+            report.complete = True
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def iter_completed(function, items, workers=DEFAULT_WORKERS, in_flight=None):
+    """
+        Yields the (item, function(item)) of every item as they complete,
+        running function in `workers` threads. Items are taken from the
+        iterable as the calls end, at most `in_flight` (twice the workers
+        by default) pending at a time, so a long or endless iterable does
+        not pile up futures.
+    """
+    workers = max(1, workers)
+    in_flight = in_flight or workers * 2
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+    try:
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(function, item)] = item
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
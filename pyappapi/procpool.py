@@ -0,0 +1,209 @@
+# -*- encoding: utf8 -*-
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from pyappapi.pipeline import NDJSONSink
+from pyappapi.prefetch import PageReport
+
+procpool_log = logging.getLogger(__name__)
+
+COLUMNS = 'columns'
+NDJSON = 'ndjson'
+# location searches whose page fetcher a worker keeps
+MAX_WORKER_SEARCHES = 64
+
+# client of the worker process, built by _init_worker
+_worker_client = None
+_worker_fetchers = {}
+
+
+class ClientFactory(object):
+    """
+        Picklable recipe of the client of each worker process:
+
+            ClientFactory(FotocasaAPI, imei=FAKE_IMEI, page_size=200)
+            ClientFactory(IdealistaAPI, token_manager=IdealistaTokenManager(storage))
+
+        An idealista client without a token manager is authorized once
+        when it is built.
+    """
+
+    def __init__(self, client_class, **kwargs):
+        self.client_class = client_class
+        self.kwargs = kwargs
+
+    def __call__(self):
+        client = self.client_class(**self.kwargs)
+        if (hasattr(client, 'authorize') and
+                getattr(client, 'token_manager', None) is None):
+            client.load_authorization(client.authorize())
+        return client
+
+
+def _init_worker(client_factory):
+    global _worker_client
+    _worker_client = client_factory()
+    _worker_fetchers.clear()
+
+
+def _page_fetcher(search):
+    """ the page_num -> response text function of a search, in a worker """
+    fetch_page = _worker_fetchers.get(search)
+    if fetch_page is not None:
+        return fetch_page
+    kind, args = search
+    client = _worker_client
+    if kind == 'bbox':
+        def fetch_page(page_num):
+            return client.bounding_box_page_text(*args, page_num=page_num)
+    else:
+        # fotocasa resolves the location with a request, done once per search
+        fetch_page = client.location_page_fetcher(args[0])
+    if len(_worker_fetchers) >= MAX_WORKER_SEARCHES:
+        _worker_fetchers.clear()
+    _worker_fetchers[search] = fetch_page
+    return fetch_page
+
+
+def _crawl_page(search, page_num, output):
+    """
+        Fetches, decodes and builds a page in the worker, returns its
+        (page_num, payload, listings, total_pages), with a None payload
+        when the page failed.
+    """
+    client = _worker_client
+    try:
+        fetch_page = _page_fetcher(search)
+        text = fetch_page(page_num) if fetch_page is not None else None
+        if text is None:
+            return page_num, None, 0, None
+        endpoint = client.page_endpoint(search[0])
+        decoded = client.decode_page(text, endpoint=endpoint)
+        if output == COLUMNS:
+            parsed = client.build_page_columns(decoded, endpoint=endpoint)
+        else:
+            parsed = client.build_page(decoded, endpoint=endpoint)
+        if parsed is None:
+            return page_num, None, 0, None
+        payload, total_pages = parsed
+        count = len(payload)
+        if output == NDJSON:
+            buffer = io.StringIO()
+            NDJSONSink(buffer).write(client, payload)
+            payload = buffer.getvalue().encode('utf-8')
+        return page_num, payload, count, total_pages
+    except Exception:
+        client.log.exception('Error crawling page %d of %s', page_num, str(search))
+        return page_num, None, 0, None
+
+
+class ProcessPoolCrawler(object):
+    """
+        Crawls bounding boxes and location searches with a pool of worker
+        processes, so that decoding and building the listings (pure python
+        CPU work, serialised on the GIL by threads) runs on every core.
+
+        Each process builds its own client with `client_factory` (a
+        ClientFactory, or any picklable callable), so it owns its
+        connection pool, fotocasa signer or idealista token. A worker
+        fetches, decodes and builds a whole page, and sends back a compact
+        form instead of the pickled models:
+
+        - output='columns': a pyappapi.columns.ResultColumns per page
+          (typed arrays and dictionary encoded strings).
+        - output='ndjson': the utf-8 bytes of the NDJSON lines of the page
+          (pyappapi.pipeline.NDJSONSink), ready to be written.
+
+            factory = ClientFactory(FotocasaAPI, imei=FAKE_IMEI, page_size=200)
+            with ProcessPoolCrawler(factory, processes=8) as crawler:
+                batches = crawler.crawl_bounding_box(41.35, 2.1, 41.45, 2.22)
+                columns = ResultColumns.concat(batches)
+
+        Pages are yielded as they complete, at most `in_flight` pages
+        (twice the processes by default) are pending at a time. Page 1 is
+        crawled first, as the number of pages is only known after it.
+    """
+
+    def __init__(self, client_factory, processes=None, output=COLUMNS,
+                 max_pages=None, in_flight=None, log=procpool_log):
+        if output not in (COLUMNS, NDJSON):
+            raise ValueError('unknown output {!r}'.format(output))
+        self.client_factory = client_factory
+        self.processes = processes or os.cpu_count() or 1
+        self.output = output
+        self.max_pages = max_pages
+        self.in_flight = in_flight or self.processes * 2
+        self.log = log
+        self.stats = {}
+        self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                 initializer=_init_worker,
+                                                 initargs=(self.client_factory,))
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def crawl_bounding_box(self, lat_0, lon_0, lat_1, lon_1, report=None):
+        return self.crawl(('bbox', (lat_0, lon_0, lat_1, lon_1)), report=report)
+
+    def crawl_location(self, location_name, report=None):
+        return self.crawl(('loc', (location_name,)), report=report)
+
+    def crawl(self, search, report=None):
+        """
+            Yields the payload of every page of a ('bbox', coords) or
+            ('loc', (location_name,)) search. report is an optional
+            PageReport.
+        """
+        report = report if report is not None else PageReport()
+        stats = {'pages': 0, 'failed_pages': 0, 'listings': 0}
+        self.stats = stats
+        pool = self._pool()
+        _, payload, count, total_pages = pool.submit(_crawl_page, search, 1,
+                                                     self.output).result()
+        if payload is None:
+            self.log.warning('First page of %s failed', str(search))
+            return
+        report.total_pages = total_pages
+        if self.max_pages is not None:
+            total_pages = min(total_pages, self.max_pages)
+        report.pages = stats['pages'] = 1
+        stats['listings'] = count
+        if count:
+            yield payload
+        pending = set()
+        next_page = 2
+        try:
+            while next_page <= total_pages or pending:
+                while next_page <= total_pages and len(pending) < self.in_flight:
+                    pending.add(pool.submit(_crawl_page, search, next_page,
+                                            self.output))
+                    next_page += 1
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page_num, payload, count, _ = future.result()
+                    if payload is None or not count:
+                        stats['failed_pages'] += 1
+                        continue
+                    stats['pages'] += 1
+                    stats['listings'] += count
+                    report.pages = stats['pages']
+                    yield payload
+            report.complete = report.pages >= report.total_pages
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,217 @@
+# -*- encoding: utf8 -*-
+import logging
+import threading
+import time
+from collections import deque
+
+ratelimit_log = logging.getLogger(__name__)
+
+BACKOFF_STATUS = frozenset([429, 500, 502, 503, 504])
+RATE_WINDOW = 10.0
+
+
+class RequestSlot(object):
+    """
+        One request going through a limiter: the client reports the http
+        status with record_status(), the latency is measured by the slot,
+        and an exception raised inside the `with` block counts as a
+        failure (timeouts and connection errors).
+    """
+    __slots__ = ('limiter', 'start', 'status')
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.start = None
+        self.status = None
+
+    def record_status(self, status):
+        self.status = status
+
+    def __enter__(self):
+        self.limiter._acquire()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        latency = time.time() - self.start
+        self.limiter._release(latency, self.status, exc_type is not None)
+        return False
+
+
+class _NoLimit(object):
+
+    def record_status(self, status):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_LIMIT = _NoLimit()
+
+
+def limited(limiter):
+    """ the slot of a request, for clients whose limiter is optional """
+    if limiter is None:
+        return NO_LIMIT
+    return limiter.request()
+
+
+class RateLimiter(object):
+    """
+        Token bucket (`rate` requests per second, bursts of up to `burst`)
+        plus an optional cap on the requests in flight. A single limiter
+        can be shared by many client instances and threads:
+
+            limiter = RateLimiter(rate=20, max_concurrency=10)
+            fapi = FotocasaAPI(imei, rate_limiter=limiter)
+            iapi = IdealistaAPI(rate_limiter=limiter)
+    """
+
+    def __init__(self, rate=10.0, burst=None, max_concurrency=None,
+                 log=ratelimit_log):
+        self.log = log
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.concurrency = max_concurrency
+        self._tokens = self.burst
+        self._last_refill = time.time()
+        self._in_flight = 0
+        self._completed = deque()
+        self.successes = 0
+        self.failures = 0
+        self._cond = threading.Condition()
+
+    def request(self):
+        return RequestSlot(self)
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                self._refill(now)
+                if self.concurrency is not None and self._in_flight >= self.concurrency:
+                    self._cond.wait()
+                    continue
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    self._in_flight += 1
+                    return
+                self._cond.wait((1.0 - self._tokens) / self.rate)
+
+    def _release(self, latency, status, failed):
+        with self._cond:
+            now = time.time()
+            self._in_flight -= 1
+            self._completed.append(now)
+            while self._completed and self._completed[0] < now - RATE_WINDOW:
+                self._completed.popleft()
+            if failed or status in BACKOFF_STATUS:
+                self.failures += 1
+                self._on_failure(now, latency, status, failed)
+            else:
+                self.successes += 1
+                self._on_success(now, latency)
+            self._cond.notify_all()
+
+    def _on_success(self, now, latency):
+        pass
+
+    def _on_failure(self, now, latency, status, failed):
+        pass
+
+    def effective_rate(self):
+        """ requests completed per second over the last RATE_WINDOW seconds """
+        with self._cond:
+            now = time.time()
+            recent = [t for t in self._completed if t >= now - RATE_WINDOW]
+            return len(recent) / RATE_WINDOW
+
+    def snapshot(self):
+        with self._cond:
+            state = {
+                'rate': self.rate,
+                'burst': self.burst,
+                'concurrency': self.concurrency,
+                'in_flight': self._in_flight,
+                'tokens': self._tokens,
+                'successes': self.successes,
+                'failures': self.failures,
+            }
+        state['effective_rate'] = self.effective_rate()
+        return state
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+        RateLimiter tuned with AIMD from the observed responses.
+
+        Every `concurrency` successful responses whose latency stays under
+        `latency_tolerance` times the latency average, the rate grows by
+        `increase` and the concurrency by one. A timeout, connection error,
+        429 or 5xx multiplies both by `decrease_factor`. Failures of the
+        requests that were already in flight when backing off are not
+        counted again during `cooldown` seconds.
+    """
+
+    def __init__(self, rate=5.0, min_rate=0.5, max_rate=100.0,
+                 concurrency=4, min_concurrency=1, max_concurrency=256,
+                 increase=1.0, decrease_factor=0.5, latency_tolerance=2.0,
+                 cooldown=1.0, log=ratelimit_log):
+        super(AdaptiveRateLimiter, self).__init__(rate=rate, burst=concurrency,
+                                                  max_concurrency=concurrency,
+                                                  log=log)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.latency_avg = None
+        self.backoffs = 0
+        self._good_in_window = 0
+        self._last_backoff = 0.0
+
+    def _on_success(self, now, latency):
+        if self.latency_avg is None:
+            self.latency_avg = latency
+        stable = latency <= self.latency_avg * self.latency_tolerance
+        self.latency_avg = 0.8 * self.latency_avg + 0.2 * latency
+        if not stable:
+            return
+        self._good_in_window += 1
+        if self._good_in_window >= self.concurrency:
+            self._good_in_window = 0
+            self.rate = min(self.max_rate, self.rate + self.increase)
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.burst = float(self.concurrency)
+
+    def _on_failure(self, now, latency, status, failed):
+        if now - self._last_backoff < self.cooldown:
+            return
+        self._last_backoff = now
+        self.backoffs += 1
+        self._good_in_window = 0
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.concurrency = max(self.min_concurrency,
+                               int(self.concurrency * self.decrease_factor))
+        self.burst = float(self.concurrency)
+        self._tokens = min(self._tokens, self.burst)
+        self.log.info('Backing off to %.2f req/s, concurrency %d (status %s)',
+                      self.rate, self.concurrency, str(status))
+
+    def snapshot(self):
+        state = super(AdaptiveRateLimiter, self).snapshot()
+        state['latency_avg'] = self.latency_avg
+        state['backoffs'] = self.backoffs
+        return state
@@ -0,0 +1,213 @@
+# -*- encoding: utf8 -*-
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+retry_log = logging.getLogger(__name__)
+
+RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+DEFAULT_LATENCY_WINDOW = 200
+DEFAULT_HEDGE_WORKERS = 32
+
+
+class LatencyTracker(object):
+    """ latencies of the last `window` responses, to compute quantiles """
+
+    def __init__(self, window=DEFAULT_LATENCY_WINDOW, min_samples=20):
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def quantile(self, q):
+        """ the q quantile (0.95 for the p95), None without enough samples """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class RetryPolicy(object):
+    """
+        Retries a request raising one of `retry_exceptions` or answered
+        with one of `retry_statuses`, up to `max_attempts` sends, sleeping
+        a random time between 0 and backoff * 2 ** retry (capped at
+        max_backoff) before each retry: full jitter, so that clients
+        failing together do not retry together. A numeric Retry-After
+        header is honoured when it is longer.
+
+        With hedge, a request still unanswered after the `hedge_quantile`
+        latency of the previous ones is sent again, and the first of both
+        responses is used. Hedges are limited to `hedge_budget` of the
+        requests, so the load only grows by that fraction at most.
+
+        A policy can be shared by several clients:
+
+            policy = RetryPolicy(max_attempts=4, hedge=True)
+            fapi = FotocasaAPI(imei, retry_policy=policy)
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.2, max_backoff=5.0,
+                 retry_statuses=RETRY_STATUS,
+                 retry_exceptions=RETRY_EXCEPTIONS,
+                 hedge=False, hedge_quantile=0.95, hedge_budget=0.1,
+                 hedge_workers=DEFAULT_HEDGE_WORKERS,
+                 latencies=None, rnd=None, log=retry_log):
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = frozenset(retry_statuses)
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_budget = hedge_budget
+        self.hedge_workers = hedge_workers
+        self.latencies = latencies if latencies is not None else LatencyTracker()
+        self.rnd = rnd if rnd is not None else random.Random()
+        self.log = log
+        self.requests = 0
+        self.sends = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.giveups = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def backoff_delay(self, retry, response=None):
+        delay = self.rnd.uniform(0, min(self.max_backoff,
+                                        self.backoff * (2 ** retry)))
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, float(retry_after)))
+        return delay
+
+    def call(self, attempt, log=None):
+        """
+            Sends a request with attempt(n) until it gets a response not
+            to be retried, and returns it. `n` is the number of sends
+            done before, so attempt can rebuild what must not be replayed,
+            like a time based signature. When every attempt raised, the
+            last exception is raised.
+        """
+        log = log or self.log
+        counter = [0]
+
+        def send():
+            with self._lock:
+                n = counter[0]
+                counter[0] += 1
+                self.sends += 1
+            return attempt(n)
+
+        with self._lock:
+            self.requests += 1
+        retry = 0
+        while True:
+            response = None
+            try:
+                response = self._send(send)
+            except self.retry_exceptions as exc:
+                if retry + 1 >= self.max_attempts:
+                    with self._lock:
+                        self.giveups += 1
+                    raise
+                log.warning('Retrying after %s (attempt %d of %d)',
+                            type(exc).__name__, retry + 1, self.max_attempts)
+            else:
+                if response.status_code not in self.retry_statuses:
+                    return response
+                if retry + 1 >= self.max_attempts:
+                    with self._lock:
+                        self.giveups += 1
+                    return response
+                log.warning('Retrying after status %d (attempt %d of %d)',
+                            response.status_code, retry + 1, self.max_attempts)
+            time.sleep(self.backoff_delay(retry, response))
+            retry += 1
+            with self._lock:
+                self.retries += 1
+
+    def _hedge_delay(self):
+        if not self.hedge:
+            return None
+        with self._lock:
+            if self.hedges >= self.hedge_budget * self.requests:
+                return None
+        return self.latencies.quantile(self.hedge_quantile)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers)
+            return self._executor
+
+    def _send(self, send):
+        """
+            Sends the request, hedging it when it is slow. The latency
+            recorded is the one seen by the caller, so slow requests that
+            were hedged do not push the hedging delay up.
+        """
+        start = time.time()
+        response = self._hedged_send(send)
+        if response.status_code not in self.retry_statuses:
+            self.latencies.add(time.time() - start)
+        return response
+
+    def _hedged_send(self, send):
+        delay = self._hedge_delay()
+        if delay is None:
+            return send()
+        executor = self._get_executor()
+        first = executor.submit(send)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        with self._lock:
+            self.hedges += 1
+        hedged = executor.submit(send)
+        pending = [first, hedged]
+        failed = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                if future.exception() is not None:
+                    failed = future
+                    continue
+                if future is hedged:
+                    with self._lock:
+                        self.hedge_wins += 1
+                # the slower request completes in background, and its
+                # connection goes back to the pool
+                return future.result()
+        return failed.result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'sends': self.sends,
+                'retries': self.retries,
+                'giveups': self.giveups,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'hedge_delay': self.latencies.quantile(self.hedge_quantile),
+            }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,64 @@
+# -*- encoding: utf8 -*-
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+
+def create_session(pool_connections=DEFAULT_POOL_CONNECTIONS,
+                   pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                   pool_block=False,
+                   keep_alive=True):
+    """
+        Creates a requests session with its own connection pool.
+
+        pool_connections: number of per host pools kept alive.
+        pool_maxsize: max number of connections kept open to a single host.
+        pool_block: when True, requests wait for a free connection instead
+            of opening a new one beyond pool_maxsize.
+        keep_alive: when False the server is asked to close the connection
+            after every response (this is the old behaviour).
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          pool_block=pool_block)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+class PooledSessionMixin(object):
+    """
+        Gives an API client its own pooled session, with a close() and
+        context manager lifecycle. A session passed from outside is
+        shared and is not closed by the client.
+    """
+
+    def _init_session(self, session=None,
+                      pool_connections=DEFAULT_POOL_CONNECTIONS,
+                      pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                      pool_block=False,
+                      keep_alive=True):
+        self._owns_session = session is None
+        if session is None:
+            session = create_session(pool_connections=pool_connections,
+                                     pool_maxsize=pool_maxsize,
+                                     pool_block=pool_block,
+                                     keep_alive=keep_alive)
+        self.session = session
+
+    def close(self):
+        if self._owns_session and self.session is not None:
+            self.session.close()
+        self.session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
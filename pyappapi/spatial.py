@@ -0,0 +1,263 @@
+# -*- encoding: utf8 -*-
+import logging
+import math
+import threading
+import time
+from array import array
+
+from pyappapi.prefetch import PageReport
+
+spatial_log = logging.getLogger(__name__)
+
+# degrees, about 1.1km of latitude
+DEFAULT_CELL_SIZE = 0.01
+DEFAULT_COVERAGE_TTL = 600.0
+# boxes thinner than this (in degrees) are float noise of the subtractions
+MIN_SIDE = 1e-9
+
+
+class _Cell(object):
+    __slots__ = ('position', 'lats', 'lons', 'keys')
+
+    def __init__(self, position):
+        self.position = position
+        self.lats = array('d')
+        self.lons = array('d')
+        self.keys = []
+
+    def remove(self, key):
+        i = self.keys.index(key)
+        del self.keys[i]
+        del self.lats[i]
+        del self.lons[i]
+
+
+class GridIndex(object):
+    """
+        Listings by position, in a grid of `cell_size` degrees cells.
+
+        Every cell keeps the coordinates of its listings in two arrays of
+        doubles (a million points over Barcelona take about 140MB with the
+        default cells, listings aside). A query takes the cells in the
+        inner part of the box as they are, and only filters the points of
+        the border cells, well under a millisecond for city blocks.
+        Inserting a key again replaces its listing (and moves it when its
+        position changed).
+    """
+
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self._cells = {}
+        # key -> (_Cell, listing)
+        self._items = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        item = self._items.get(key)
+        return item[1] if item is not None else None
+
+    def cell_of(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lon / self.cell_size)))
+
+    def insert(self, key, lat, lon, listing=None):
+        if key in self._items:
+            self.remove(key)
+        position = self.cell_of(lat, lon)
+        cell = self._cells.get(position)
+        if cell is None:
+            cell = self._cells[position] = _Cell(position)
+        cell.keys.append(key)
+        cell.lats.append(lat)
+        cell.lons.append(lon)
+        self._items[key] = (cell, listing)
+
+    def remove(self, key):
+        item = self._items.pop(key, None)
+        if item is None:
+            return False
+        cell = item[0]
+        cell.remove(key)
+        if not cell.keys:
+            del self._cells[cell.position]
+        return True
+
+    def _cells_in(self, row_0, col_0, row_1, col_1):
+        if (row_1 - row_0 + 1) * (col_1 - col_0 + 1) > len(self._cells):
+            for (row, col), cell in self._cells.items():
+                if row_0 <= row <= row_1 and col_0 <= col <= col_1:
+                    yield row, col, cell
+            return
+        for row in range(row_0, row_1 + 1):
+            for col in range(col_0, col_1 + 1):
+                cell = self._cells.get((row, col))
+                if cell is not None:
+                    yield row, col, cell
+
+    def query_keys(self, lat_0, lon_0, lat_1, lon_1):
+        """ keys of the listings in the bounding box (borders included) """
+        row_0, col_0 = self.cell_of(lat_0, lon_0)
+        row_1, col_1 = self.cell_of(lat_1, lon_1)
+        keys = []
+        for row, col, cell in self._cells_in(row_0, col_0, row_1, col_1):
+            if row_0 < row < row_1 and col_0 < col < col_1:
+                keys.extend(cell.keys)
+                continue
+            for key, lat, lon in zip(cell.keys, cell.lats, cell.lons):
+                if lat_0 <= lat <= lat_1 and lon_0 <= lon <= lon_1:
+                    keys.append(key)
+        return keys
+
+    def query(self, lat_0, lon_0, lat_1, lon_1):
+        """ listings in the bounding box """
+        items = self._items
+        return [items[key][1]
+                for key in self.query_keys(lat_0, lon_0, lat_1, lon_1)]
+
+
+def subtract_box(box, hole):
+    """ the up to four boxes covering box minus hole """
+    lat_0, lon_0, lat_1, lon_1 = box
+    h_lat_0, h_lon_0, h_lat_1, h_lon_1 = hole
+    if h_lat_0 >= lat_1 or h_lat_1 <= lat_0 or h_lon_0 >= lon_1 or h_lon_1 <= lon_0:
+        return [box]
+    parts = []
+    if h_lat_0 > lat_0:
+        parts.append((lat_0, lon_0, h_lat_0, lon_1))
+    if h_lat_1 < lat_1:
+        parts.append((h_lat_1, lon_0, lat_1, lon_1))
+    mid_lat_0 = max(lat_0, h_lat_0)
+    mid_lat_1 = min(lat_1, h_lat_1)
+    if h_lon_0 > lon_0:
+        parts.append((mid_lat_0, lon_0, mid_lat_1, h_lon_0))
+    if h_lon_1 < lon_1:
+        parts.append((mid_lat_0, h_lon_1, mid_lat_1, lon_1))
+    return [part for part in parts
+            if part[2] - part[0] > MIN_SIDE and part[3] - part[1] > MIN_SIDE]
+
+
+class Coverage(object):
+    """ the boxes already fetched, for `ttl` seconds after fetching them """
+
+    def __init__(self, ttl=DEFAULT_COVERAGE_TTL):
+        self.ttl = ttl
+        # (box, fetched_at)
+        self._boxes = []
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def _prune(self, now):
+        self._boxes = [(box, fetched_at) for box, fetched_at in self._boxes
+                       if now - fetched_at <= self.ttl]
+
+    def add(self, box, now=None):
+        now = time.time() if now is None else now
+        self._prune(now)
+        # boxes inside the new one are not needed anymore
+        self._boxes = [(old, fetched_at) for old, fetched_at in self._boxes
+                       if not (box[0] <= old[0] and box[1] <= old[1] and
+                               old[2] <= box[2] and old[3] <= box[3])]
+        self._boxes.append((box, now))
+
+    def uncovered(self, box, now=None):
+        """ the boxes of box not covered by a fresh fetched box """
+        now = time.time() if now is None else now
+        self._prune(now)
+        parts = [box]
+        for covered, _ in self._boxes:
+            parts = [piece for part in parts
+                     for piece in subtract_box(part, covered)]
+            if not parts:
+                break
+        return parts
+
+    def covers(self, box, now=None):
+        return not self.uncovered(box, now)
+
+
+class LocalAreaSearch(object):
+    """
+        Answers bounding box searches from the listings already fetched.
+
+        Listings are kept in a GridIndex by their position (client
+        listing_coords: Fotocasa Y/X, Idealista latitude/longitude), and
+        the fetched boxes in a Coverage. A search only requests the parts
+        of the box not fetched during the last `ttl` seconds (widened to
+        the grid cells, so that later searches line up with them), and
+        filters the rest locally:
+
+            local = LocalAreaSearch(fapi, ttl=600)
+            listings = local.search(41.38, 2.15, 41.40, 2.18)
+            listings = local.search(41.385, 2.16, 41.395, 2.17)  # no requests
+
+        A part is only marked as covered when all its pages were read.
+        Listings of a refetched part that did not come again are removed.
+    """
+
+    def __init__(self, client, ttl=DEFAULT_COVERAGE_TTL,
+                 cell_size=DEFAULT_CELL_SIZE, index=None, prefetch=1,
+                 log=spatial_log):
+        self.client = client
+        self.index = index if index is not None else GridIndex(cell_size)
+        self.coverage = Coverage(ttl)
+        self.prefetch = prefetch
+        self.log = log
+        self.fetched_parts = 0
+        self.local_hits = 0
+        self._lock = threading.Lock()
+
+    def _snap(self, box):
+        size = self.index.cell_size
+        return (math.floor(box[0] / size) * size,
+                math.floor(box[1] / size) * size,
+                math.ceil(box[2] / size) * size,
+                math.ceil(box[3] / size) * size)
+
+    def insert(self, listing):
+        lat, lon = self.client.listing_coords(listing)
+        self.index.insert(self.client.listing_key(listing), lat, lon, listing)
+
+    def fetch(self, lat_0, lon_0, lat_1, lon_1):
+        """ requests every listing in the box, returns if it was complete """
+        report = PageReport()
+        seen = set()
+        for listing in self.client.iter_bounding_box(lat_0, lon_0, lat_1, lon_1,
+                                                     prefetch=self.prefetch,
+                                                     report=report):
+            seen.add(self.client.listing_key(listing))
+            with self._lock:
+                self.insert(listing)
+        if not report.complete:
+            self.log.warning('Incomplete fetch of %s, not marking it as covered',
+                             str((lat_0, lon_0, lat_1, lon_1)))
+            return False
+        with self._lock:
+            for key in self.index.query_keys(lat_0, lon_0, lat_1, lon_1):
+                if key not in seen:
+                    self.index.remove(key)
+            self.coverage.add((lat_0, lon_0, lat_1, lon_1))
+        return True
+
+    def search(self, lat_0, lon_0, lat_1, lon_1):
+        box = (min(lat_0, lat_1), min(lon_0, lon_1),
+               max(lat_0, lat_1), max(lon_0, lon_1))
+        with self._lock:
+            parts = self.coverage.uncovered(box)
+        if not parts:
+            self.local_hits += 1
+        for part in parts:
+            part = self._snap(part)
+            with self._lock:
+                # a previous widened part can cover this one
+                if self.coverage.covers(part):
+                    continue
+            self.fetched_parts += 1
+            self.fetch(*part)
+        with self._lock:
+            return self.index.query(*box)
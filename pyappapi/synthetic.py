@@ -0,0 +1,242 @@
+# -*- encoding: utf8 -*-
+"""
+Synthetic api responses, modelled on the fields the result models read.
+Used by the benchmarks and the fake api server.
+"""
+import random
+
+PROVINCES = [
+    (u'Barcelona', [u'Barcelona', u'Badalona', u"L'Hospitalet de Llobregat",
+                    u'Sabadell', u'Terrassa']),
+    (u'Madrid', [u'Madrid', u'Alcalá de Henares', u'Getafe', u'Móstoles']),
+    (u'Valencia', [u'Valencia', u'Gandia', u'Torrent']),
+    (u'Sevilla', [u'Sevilla', u'Dos Hermanas']),
+]
+DISTRICTS = [u'Eixample', u'Gràcia', u'Sants-Montjuïc', u'Sant Martí',
+             u'Centro', u'Chamberí', u'Ruzafa', u'Triana']
+DEFAULT_BOUNDING_BOX = (41.35, 2.10, 41.45, 2.22)
+
+
+def _point(rnd, bounding_box):
+    lat_0, lon_0, lat_1, lon_1 = bounding_box
+    return (round(rnd.uniform(lat_0, lat_1), 7),
+            round(rnd.uniform(lon_0, lon_1), 7))
+
+
+def _image_url(code, variant=u'WEB_LISTING-M'):
+    return (u'https://img3.idealista.com/blur/{}/0/id.pro.es.image.master/'
+            u'{:02x}/{:02x}/{:02x}/{}.jpg').format(variant, code % 256,
+                                                  (code // 256) % 256,
+                                                  (code // 65536) % 256, code)
+
+
+def fotocasa_property(listing_id, rnd=None, bounding_box=DEFAULT_BOUNDING_BOX):
+    rnd = rnd or random.Random(listing_id)
+    lat, lon = _point(rnd, bounding_box)
+    price = rnd.randrange(400, 4000, 25)
+    rooms = rnd.randint(0, 5)
+    photo = u'https://static.fotocasa.es/images/anuncio/2018/01/01/{}/{}.jpg'
+    return {
+        'Id': listing_id,
+        'PriceDescription': u'{:,} €/mes'.format(price).replace(',', '.'),
+        'X': lon,
+        'Y': lat,
+        'Surface': rnd.randint(25, 250),
+        'Bathrooms': rnd.randint(1, 3),
+        'OfferTypeId': 3,
+        'ListDate': u'/Date({})/'.format(1500000000000 + listing_id),
+        'LocationDescription': rnd.choice(DISTRICTS),
+        'NRooms': rooms,
+        'PromotionId': 0,
+        'IsDevelopment': False,
+        'TitleDescription': u'Piso en alquiler de {} habitaciones'.format(rooms),
+        'Phone': u'93{:07d}'.format(rnd.randrange(10 ** 7)),
+        'Photo': photo.format(listing_id, 1),
+        'PhotoSmall': photo.format(listing_id, 's1'),
+        'PhotoLarge': photo.format(listing_id, 'l1'),
+        'PhotoMedium': photo.format(listing_id, 'm1'),
+        'MediaList': [{'Url': photo.format(listing_id, i), 'TypeId': 1}
+                      for i in range(rnd.randint(1, 8))],
+        'SubTitleDescription': rnd.choice(DISTRICTS),
+        'ProductList': [],
+        'Distance': rnd.randint(0, 3000),
+        'PeriodicityId': 3,
+        'ShowPoi': False,
+        'Comments': u'Luminoso piso reformado, cerca del metro. ' * rnd.randint(1, 4),
+    }
+
+
+def fotocasa_details(listing):
+    """ GetProperty details of a fotocasa_property listing """
+    listing_id = listing['Id']
+    rnd = random.Random(listing_id)
+    price = int(listing['PriceDescription'].split()[0].replace('.', ''))
+    return {
+        'Id': listing_id,
+        'Price': price,
+        'PriceDescription': listing['PriceDescription'],
+        'OriginalPrice': price,
+        'DiffPrice': 0,
+        'X': listing['X'],
+        'Y': listing['Y'],
+        'Surface': listing['Surface'],
+        'NRooms': listing['NRooms'],
+        'NBathrooms': listing['Bathrooms'],
+        'OfferTypeId': listing['OfferTypeId'],
+        'CategoryId': 2,
+        'SubcategoryId': 1,
+        'Floor': str(rnd.randint(0, 9)),
+        'Street': u'Carrer de la Prova, {}'.format(rnd.randint(1, 200)),
+        'ZipCode': u'080{:02d}'.format(rnd.randint(1, 42)),
+        'Title': listing['TitleDescription'],
+        'Description': listing['Comments'],
+        'MediaList': listing['MediaList'],
+        'MainPhoto': listing['Photo'],
+        'AgencyName': u'Inmobiliaria {}'.format(rnd.randint(1, 500)),
+        'IsProfessional': True,
+        'Characteristics': [{'Key': u'Ascensor', 'Value': u'Sí'}],
+    }
+
+
+def fotocasa_data_layer(results_number, rnd=None):
+    rnd = rnd or random.Random(results_number)
+    params = [
+        ('language_id', 3), ('country_id', 724), ('region_level1_id', 9),
+        ('region_level2_id', 8), ('county_id', 0), ('city_zone_id', 0),
+        ('city_id', 19), ('locality_id', 0), ('district_id', 0),
+        ('neighbourhood_id', 0), ('price_min', 0), ('price_max', 0),
+        ('mts2_min', 0), ('mts2_max', 0), ('bathrooms_min', 0),
+        ('rooms_min', 0), ('rooms_max', 0), ('transaction', 'alquiler'),
+        ('transaction_id', 3), ('property', 'vivienda'), ('property_id', 2),
+        ('property_sub_id', 0), ('search_results_position', 0),
+        ('search_results_number', results_number),
+    ]
+    return '&'.join('{}={}'.format(k, v) for k, v in params)
+
+
+def fotocasa_search_page(items, results_number=None, first_id=1, seed=0,
+                         bounding_box=DEFAULT_BOUNDING_BOX):
+    rnd = random.Random(seed)
+    if results_number is None:
+        results_number = items
+    return {'d': {
+        'DataLayer': fotocasa_data_layer(results_number, rnd),
+        'Properties': [fotocasa_property(first_id + i, rnd, bounding_box)
+                       for i in range(items)],
+    }}
+
+
+def idealista_element(property_code, rnd=None, bounding_box=DEFAULT_BOUNDING_BOX):
+    rnd = rnd or random.Random(property_code)
+    lat, lon = _point(rnd, bounding_box)
+    province, municipalities = rnd.choice(PROVINCES)
+    size = float(rnd.randint(25, 250))
+    price = float(rnd.randrange(400, 4000, 25))
+    rooms = rnd.randint(0, 5)
+    images = [{'url': _image_url(property_code * 10 + i, u'WEB_DETAIL-L-L'),
+               'multimediaTag': rnd.choice([u'livingRoom', u'kitchen',
+                                            u'bedroom', u'bathroom'])}
+              for i in range(rnd.randint(1, 12))]
+    return {
+        'propertyCode': str(property_code),
+        'propertyType': u'flat',
+        'url': u'https://www.idealista.com/inmueble/{}/'.format(property_code),
+        'latitude': lat,
+        'longitude': lon,
+        'address': u'Calle de la Prueba, {}'.format(rnd.randint(1, 200)),
+        'country': u'es',
+        'province': province,
+        'municipality': rnd.choice(municipalities),
+        'price': price,
+        'operation': u'rent',
+        'numPhotos': len(images),
+        'hasVideo': rnd.random() < 0.1,
+        'floor': str(rnd.randint(0, 9)),
+        'bathrooms': rnd.randint(1, 3),
+        'exterior': rnd.random() < 0.7,
+        'hasLift': rnd.random() < 0.6,
+        'size': size,
+        'distance': str(rnd.randint(0, 3000)),
+        'status': u'good',
+        'topHighlight': False,
+        'urgentVisualHighlight': False,
+        'visualHighlight': False,
+        'preferenceHighlight': False,
+        'showAddress': rnd.random() < 0.5,
+        'rooms': rooms,
+        'priceByArea': round(price / size, 1),
+        'newDevelopment': False,
+        'newProperty': False,
+        'favourite': False,
+        'firstActivationDate': 1500000000000 + property_code,
+        'externalReference': u'REF{}'.format(property_code),
+        'neighborhood': rnd.choice(DISTRICTS),
+        'district': rnd.choice(DISTRICTS),
+        'thumbnail': _image_url(property_code * 10),
+        'contactInfo': {
+            'inVirtualMicrosite': False,
+            'contactMethod': u'all',
+            'contactName': u'Inmobiliaria {}'.format(rnd.randint(1, 500)),
+            'userType': u'professional',
+            'phone1': {
+                'phoneNumberForMobileDialing': u'+34932000000',
+                'formattedPhone': u'932 00 00 00',
+                'nationalNumber': True,
+                'phoneNumber': u'932000000',
+            },
+        },
+        'multimedia': {'images': images},
+        'suggestedTexts': {'title': u'Piso en {}'.format(rnd.choice(DISTRICTS)),
+                           'subtitle': u'{}, {}'.format(rnd.choice(DISTRICTS),
+                                                        province)},
+        'detailedType': {'typology': u'flat'},
+    }
+
+
+def idealista_detail(element):
+    """ detail response of an idealista_element """
+    return {
+        'adid': int(element['propertyCode']),
+        'propertyCode': element['propertyCode'],
+        'price': element['price'],
+        'priceInfo': {'amount': element['price'], 'currencySuffix': u'€/mes'},
+        'operation': element['operation'],
+        'propertyType': element['propertyType'],
+        'extendedPropertyType': element['propertyType'],
+        'homeType': element['propertyType'],
+        'state': u'active',
+        'country': element['country'],
+        'ubication': {'latitude': element['latitude'],
+                      'longitude': element['longitude'],
+                      'title': element['address']},
+        'moreCharacteristics': {'roomNumber': element['rooms'],
+                                'bathNumber': element['bathrooms'],
+                                'constructedArea': element['size'],
+                                'exterior': element['exterior'],
+                                'lift': element['hasLift']},
+        'propertyComment': u'Piso luminoso y reformado, cerca del metro.',
+        'detailWebLink': element['url'],
+        'modificationDate': element['firstActivationDate'],
+        'contactInfo': element['contactInfo'],
+        'multimedia': element['multimedia'],
+        'detailedType': element['detailedType'],
+        'suggestedTexts': element['suggestedTexts'],
+    }
+
+
+def idealista_search_page(items, total=None, page=1, first_code=1, seed=0,
+                          bounding_box=DEFAULT_BOUNDING_BOX, page_size=None):
+    rnd = random.Random(seed)
+    if total is None:
+        total = items
+    if page_size is None:
+        page_size = max(items, 1)
+    total_pages = max(1, -(-total // page_size))
+    return {
+        'elementList': [idealista_element(first_code + i, rnd, bounding_box)
+                        for i in range(items)],
+        'total': total,
+        'totalPages': total_pages,
+        'actualPage': page,
+        'upperRangePosition': min(total, page * page_size),
+    }
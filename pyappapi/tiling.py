@@ -0,0 +1,166 @@
+# -*- encoding: utf8 -*-
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+tiling_log = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 1000
+DEFAULT_MAX_DEPTH = 8
+DEFAULT_WORKERS = 8
+
+
+def split_bounding_box(lat_0, lon_0, lat_1, lon_1):
+    """ splits a bounding box in its four quadrants """
+    lat_m = (lat_0 + lat_1) / 2.0
+    lon_m = (lon_0 + lon_1) / 2.0
+    return [(lat_0, lon_0, lat_m, lon_m),
+            (lat_0, lon_m, lat_m, lon_1),
+            (lat_m, lon_0, lat_1, lon_m),
+            (lat_m, lon_m, lat_1, lon_1)]
+
+
+class CrawlReport(object):
+    """
+        Numbers of a quadtree crawl.
+
+        grid_tiles is the size of the fixed grid needed to reach the same
+        resolution as the deepest leaf (4 ** max_depth), and grid_requests
+        a lower bound of the requests such a grid would use: one per tile
+        plus the extra pages the leaves needed.
+    """
+    def __init__(self):
+        self.probes = 0
+        self.failed_probes = 0
+        self.split_tiles = 0
+        self.leaf_tiles = 0
+        self.truncated_tiles = 0
+        self.page_requests = 0
+        self.extra_pages = 0
+        self.max_depth = 0
+        self.listings = 0
+        self.duplicates = 0
+
+    @property
+    def requests(self):
+        return self.probes + self.page_requests
+
+    @property
+    def grid_tiles(self):
+        return 4 ** self.max_depth
+
+    @property
+    def grid_requests(self):
+        return self.grid_tiles + self.extra_pages
+
+    def as_dict(self):
+        res = dict(vars(self))
+        res['requests'] = self.requests
+        res['grid_tiles'] = self.grid_tiles
+        res['grid_requests'] = self.grid_requests
+        return res
+
+
+class QuadtreeCrawler(object):
+    """
+        Crawls a large bounding box splitting it in quadrants only where
+        it is needed.
+
+        Every tile is probed first (probe_bounding_box of the client), and
+        when its result count is over `threshold` it is split in four
+        quadrants, up to `max_depth` levels. The leaf tiles are fetched
+        concurrently with `workers` threads, reusing the probed first page.
+        With count_only (Idealista only) tiles are probed with the zero
+        items count request instead of the first page.
+        Listings are deduplicated with the client listing_key (Fotocasa Id,
+        Idealista propertyCode).
+
+        Works with FotocasaAPI and IdealistaAPI:
+
+            crawler = QuadtreeCrawler(fapi, threshold=fapi.page_size * 10)
+            for listing in crawler.crawl(lat_0, lon_0, lat_1, lon_1):
+                ...
+            print(crawler.report.as_dict())
+    """
+
+    def __init__(self, client, threshold=DEFAULT_THRESHOLD,
+                 max_depth=DEFAULT_MAX_DEPTH, workers=DEFAULT_WORKERS,
+                 prefetch=1, count_only=False, log=tiling_log):
+        self.client = client
+        self.threshold = threshold
+        self.max_depth = max_depth
+        self.workers = workers
+        self.prefetch = prefetch
+        self.count_only = count_only
+        self.log = log
+        self.report = CrawlReport()
+
+    def _probe(self, bbox):
+        if self.count_only:
+            return self.client.probe_bounding_box(*bbox, count_only=True)
+        return self.client.probe_bounding_box(*bbox)
+
+    def _fetch_leaf(self, bbox, first_page):
+        return list(self.client.iter_bounding_box(*bbox,
+                                                  prefetch=self.prefetch,
+                                                  first_page=first_page))
+
+    def _leaf_pages(self, count):
+        return max(1, int(math.ceil(count / float(self.client.page_size))))
+
+    def crawl(self, lat_0, lon_0, lat_1, lon_1):
+        self.report = CrawlReport()
+        report = self.report
+        seen = set()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = {}
+        try:
+            root = (lat_0, lon_0, lat_1, lon_1)
+            pending[executor.submit(self._probe, root)] = ('probe', root, 0)
+            while pending:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, bbox, depth = pending.pop(future)
+                    if kind == 'probe':
+                        report.probes += 1
+                        probe = future.result()
+                        if probe is None:
+                            report.failed_probes += 1
+                            self.log.warning('Probe failed for tile %s', str(bbox))
+                            continue
+                        count, first_page = probe
+                        if count > self.threshold and depth < self.max_depth:
+                            report.split_tiles += 1
+                            for quadrant in split_bounding_box(*bbox):
+                                qfuture = executor.submit(self._probe, quadrant)
+                                pending[qfuture] = ('probe', quadrant, depth + 1)
+                            continue
+                        if count > self.threshold:
+                            report.truncated_tiles += 1
+                            self.log.warning('Tile %s still has %d results at max depth',
+                                             str(bbox), count)
+                        report.leaf_tiles += 1
+                        report.max_depth = max(report.max_depth, depth)
+                        if count == 0:
+                            continue
+                        pages = self._leaf_pages(count)
+                        report.extra_pages += pages - 1
+                        if first_page is not None:
+                            # page 1 came with the probe
+                            pages -= 1
+                        report.page_requests += pages
+                        lfuture = executor.submit(self._fetch_leaf, bbox, first_page)
+                        pending[lfuture] = ('leaf', bbox, depth)
+                    else:
+                        for listing in future.result():
+                            key = self.client.listing_key(listing)
+                            if key in seen:
+                                report.duplicates += 1
+                                continue
+                            seen.add(key)
+                            report.listings += 1
+                            yield listing
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)